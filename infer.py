@@ -1,61 +1,76 @@
-import sys
+import os
 import json
+import time
+from itertools import islice
 
 import fire
 import torch
-from peft import PeftModel
-from transformers import GenerationConfig, LlamaForCausalLM, LlamaTokenizer
+from tqdm import tqdm
+from transformers import GenerationConfig
 
+from utils.adapters import AdapterManager
+from utils.cache import ResponseCache, normalize_instruction
+from utils.engine import GenerationEngine
+from utils.loader import get_device, load_model
 from utils.prompter import Prompter
+from utils.speculative import build_drafter, load_statute_texts
 
-if torch.cuda.is_available():
-    device = "cuda"
+device = get_device()
 
 
 class Infer():
     def __init__(
         self,
         load_8bit: bool = False,
+        quantize: str = "",  # "int8" or "int4" weight-only quantization for CPU inference
+        cpu_dtype: str = "auto",  # "bfloat16" or "float32" on CPU; auto picks bf16 where the CPU supports it
+        autotune: bool = False,  # time a short decode per CPU dtype on first start and cache the fastest
+        num_threads: int = 0,  # torch threads on CPU, 0 = physical cores
         base_model: str = "",
         lora_weights: str = "",
         prompt_template: str = "",  # The prompt template to use, will default to alpaca.
+        max_batch_size: int = 8,
+        cache_size: int = 1024,  # in-memory cached answers, 0 disables
+        cache_ttl: float = 3600,
+        cache_db: str = "",  # optional SQLite file so the cache survives restarts
+        adapters: dict = None,  # extra LoRA adapters selectable by name
+        adapter_budget_mb: float = 0,
+        draft_model: str = "",  # small model sharing the tokenizer, for speculative decoding
+        prompt_lookup: bool = False,  # draft by copying n-gram continuations from the context
+        statute_lookup: bool = False,  # draft quotes of statutes and charge names
+        law_files: str = "",  # glob of law .md files (tools/clear_law.py format) to quote from
     ):
         prompter = Prompter(prompt_template)
-        tokenizer = LlamaTokenizer.from_pretrained(base_model)
-        model = LlamaForCausalLM.from_pretrained(
-            base_model,
-            load_in_8bit=load_8bit,
-            torch_dtype=torch.float16,
-            device_map="auto",
+        model, tokenizer, _ = load_model(
+            base_model, lora_weights, load_8bit=load_8bit, device=device, quantize=quantize,
+            cpu_dtype=cpu_dtype, autotune=autotune, num_threads=num_threads,
         )
-        
-        try:
-            print(f"Using lora {lora_weights}")
-            model = PeftModel.from_pretrained(
-                model,
-                lora_weights,
-                torch_dtype=torch.float16,
-            )
-        except:
-            print("*"*50, "\n Attention! No Lora Weights \n", "*"*50)
-            
-        # unwind broken decapoda-research config
-        model.config.pad_token_id = tokenizer.pad_token_id = 0  # unk
-        model.config.bos_token_id = 1
-        model.config.eos_token_id = 2
-        if not load_8bit:
-            model.half()  # seems to fix bugs for some users.
-
-        model.eval()
-
-        if torch.__version__ >= "2" and sys.platform != "win32":
-            model = torch.compile(model)
-        
+
         self.base_model = base_model
         self.lora_weights = lora_weights
         self.model = model
         self.prompter = prompter
         self.tokenizer = tokenizer
+        adapter_manager = None
+        if adapters:
+            adapter_manager = AdapterManager(model, adapters, adapter_budget_mb)
+        self.engine = GenerationEngine(
+            model,
+            device=device,
+            eos_token_id=tokenizer.eos_token_id,
+            max_batch_size=max_batch_size,
+            adapters=adapter_manager,
+            drafter=build_drafter(
+                draft_model,
+                prompt_lookup,
+                device,
+                tokenizer,
+                load_statute_texts(law_files) if statute_lookup else None,
+            ),
+        )
+        self.engine.add_template_prefixes(tokenizer, prompter)
+        self.template = prompter.compile(tokenizer)
+        self.response_cache = ResponseCache(cache_size, cache_ttl, cache_db)
 
     def generate_output(
         self,
@@ -66,11 +81,38 @@ class Infer():
         top_k=40,
         num_beams=1,
         max_new_tokens=256,
+        adapter=None,
         **kwargs,
     ):
-        prompt = self.prompter.generate_prompt(instruction, input)
-        inputs = self.tokenizer(prompt, return_tensors="pt")
-        input_ids = inputs["input_ids"].to(device)
+        cache_key = self.response_cache.make_key(
+            self.prompter.generate_prompt(normalize_instruction(instruction), input),
+            f"{self.base_model}|{self.lora_weights}|{adapter or 'default'}",
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            num_beams=num_beams,
+            max_new_tokens=max_new_tokens,
+            **kwargs,
+        )
+        cached = self.response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        prompt_ids = self.template.encode(instruction, input)
+        if num_beams == 1:
+            request = self.engine.submit(
+                prompt_ids,
+                max_new_tokens=max_new_tokens,
+                do_sample=kwargs.get("do_sample", False),
+                temperature=temperature,
+                top_p=top_p,
+                top_k=top_k,
+                adapter=adapter,
+            )
+            response = self.template.decode_response(request.result())
+            self.response_cache.put(cache_key, response)
+            return response
+        input_ids = torch.tensor([prompt_ids], device=device)
         generation_config = GenerationConfig(
             temperature=temperature,
             top_p=top_p,
@@ -79,7 +121,7 @@ class Infer():
             # repetition_penalty=10.0,
             **kwargs,
         )
-        with torch.no_grad():
+        with torch.no_grad(), self.engine.exclusive(adapter):
             generation_output = self.model.generate(
                 input_ids=input_ids,
                 generation_config=generation_config,
@@ -88,8 +130,9 @@ class Infer():
                 max_new_tokens=max_new_tokens,
             )
         s = generation_output.sequences[0]
-        output = self.tokenizer.decode(s)
-        return self.prompter.get_response(output)
+        response = self.template.decode_response(s, len(prompt_ids))
+        self.response_cache.put(cache_key, response)
+        return response
 
     def infer_from_file(self, infer_data_path):
         with open(infer_data_path) as f:
@@ -105,21 +148,164 @@ class Infer():
                 print("Ground Truth:\n", output)
                 print('=' * 100)
 
+    def generate_batch(
+        self,
+        prompt_ids,
+        temperature=0.1,
+        top_p=0.75,
+        top_k=40,
+        num_beams=1,
+        max_new_tokens=256,
+        **kwargs,
+    ):
+        """Generates for a list of already tokenized prompts in one left-padded batch."""
+        # the tokenizer is shared with the engine's callers; pad left for this batch only
+        padding_side, self.tokenizer.padding_side = self.tokenizer.padding_side, "left"
+        try:
+            batch = self.tokenizer.pad(
+                {"input_ids": prompt_ids}, padding=True, return_tensors="pt"
+            )
+        finally:
+            self.tokenizer.padding_side = padding_side
+        generation_config = GenerationConfig(
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            num_beams=num_beams,
+            **kwargs,
+        )
+        with torch.no_grad(), self.engine.exclusive():
+            sequences = self.model.generate(
+                input_ids=batch["input_ids"].to(device),
+                attention_mask=batch["attention_mask"].to(device),
+                generation_config=generation_config,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+        outputs, completion_tokens = [], []
+        for g in sequences[:, batch["input_ids"].shape[1]:].tolist():
+            if self.tokenizer.eos_token_id in g:
+                g = g[:g.index(self.tokenizer.eos_token_id)]
+            outputs.append(self.template.decode_response(g))
+            completion_tokens.append(len(g))
+        return outputs, completion_tokens
+
+    def infer_batch_file(
+        self,
+        infer_data_path,
+        output_path,
+        batch_size=8,
+        sort_window=16,
+        **generate_kwargs,
+    ):
+        """
+        Batched version of infer_from_file for large regression runs.
+
+        Lines are read lazily, `batch_size * sort_window` at a time, sorted by
+        prompt length within that window so each batch pads to similar
+        lengths, and results are appended to `output_path` as JSONL keyed by
+        input line number. Lines already present in `output_path` are skipped,
+        so an interrupted run resumes where it stopped.
+        """
+        done = set()
+        truncated = False
+        if os.path.exists(output_path):
+            with open(output_path) as f:
+                for line in f:
+                    truncated = not line.endswith("\n")
+                    try:
+                        done.add(json.loads(line)["line"])
+                    except (ValueError, KeyError):
+                        pass  # partially written record from a killed run
+        if done:
+            print(f"Resuming: {len(done)} lines already in {output_path}")
+
+        def pending():
+            with open(infer_data_path) as f:
+                for line_no, line in enumerate(f):
+                    if line_no in done or not line.strip():
+                        continue
+                    yield line_no, json.loads(line)
+
+        lines = pending()
+        pbar = tqdm(unit="line", initial=len(done))
+        with open(output_path, "a") as out:
+            if truncated:
+                out.write("\n")  # don't glue onto a partially written record
+            while True:
+                window = list(islice(lines, batch_size * sort_window))
+                if not window:
+                    break
+                encoded = self.template.encode_batch(
+                    [data["instruction"] for _, data in window],
+                    [data.get("input") for _, data in window],
+                )
+                items = [
+                    (line_no, data, ids) for (line_no, data), ids in zip(window, encoded)
+                ]
+                items.sort(key=lambda item: len(item[2]))
+                for i in range(0, len(items), batch_size):
+                    batch = items[i:i + batch_size]
+                    start = time.time()
+                    outputs, completion_tokens = self.generate_batch(
+                        [ids for _, _, ids in batch], **generate_kwargs
+                    )
+                    latency = time.time() - start
+                    for (line_no, data, ids), output, n_tokens in zip(
+                        batch, outputs, completion_tokens
+                    ):
+                        record = {
+                            "line": line_no,
+                            "instruction": data["instruction"],
+                            "model_output": output,
+                            "ground_truth": data.get("output"),
+                            "latency": latency,
+                            "batch_size": len(batch),
+                            "prompt_tokens": len(ids),
+                            "completion_tokens": n_tokens,
+                        }
+                        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    out.flush()
+                    pbar.update(len(batch))
+        pbar.close()
+
 
 def main(
     load_8bit: bool = False,
+    quantize: str = "",  # "int8" or "int4" weight-only quantization for CPU inference
+    cpu_dtype: str = "auto",  # "bfloat16" or "float32" on CPU; auto picks bf16 where the CPU supports it
+    autotune: bool = False,  # time a short decode per CPU dtype on first start and cache the fastest
+    num_threads: int = 0,  # torch threads on CPU, 0 = physical cores
     base_model: str = "",
     lora_weights: str = "",
     prompt_template: str = "",  # The prompt template to use, will default to alpaca.
     infer_data_path: str = "",
+    output_path: str = "",  # if set, run batched file inference and write JSONL here
+    batch_size: int = 8,
+    draft_model: str = "",
+    prompt_lookup: bool = False,
+    statute_lookup: bool = False,
+    law_files: str = "",
 ):
     infer = Infer(
         load_8bit=load_8bit,
+        quantize=quantize,
+        cpu_dtype=cpu_dtype,
+        autotune=autotune,
+        num_threads=num_threads,
         base_model=base_model,
         lora_weights=lora_weights,
-        prompt_template=prompt_template
+        prompt_template=prompt_template,
+        draft_model=draft_model,
+        prompt_lookup=prompt_lookup,
+        statute_lookup=statute_lookup,
+        law_files=law_files,
     )
     
+    if infer_data_path and output_path:
+        infer.infer_batch_file(infer_data_path, output_path, batch_size=batch_size)
+        return
+
     try:
         infer.infer_from_file(infer_data_path)
     except Exception as e:
@@ -192,8 +192,9 @@ const PROJECT_INFO = {
 
 // ===== Configuration =====
 const API_CONFIG = {
-    baseURL: 'http://localhost:7860', // Change this to your API endpoint
-    endpoint: '/api/predict' // Adjust based on your backend API
+    // Same origin when served by `webapp.py --api_port`; otherwise point at that port
+    baseURL: window.location.protocol.startsWith('http') ? window.location.origin : 'http://localhost:8000',
+    endpoint: '/v1/chat/completions' // OpenAI-compatible chat endpoint
 };
 
 // ===== DOM Elements =====
@@ -210,7 +211,20 @@ const elements = {
     loadingOverlay: document.getElementById('loading-overlay'),
     toast: document.getElementById('toast'),
     toastMessage: document.getElementById('toast-message'),
-    projectContent: document.getElementById('project-content')
+    projectContent: document.getElementById('project-content'),
+    queryInput: document.getElementById('query-input'),
+    toggleParams: document.getElementById('toggle-params'),
+    paramsContent: document.getElementById('params-content'),
+    temperature: document.getElementById('temperature'),
+    topP: document.getElementById('top-p'),
+    topK: document.getElementById('top-k'),
+    maxTokens: document.getElementById('max-tokens'),
+    streamOutput: document.getElementById('stream-output'),
+    submitBtn: document.getElementById('submit-btn'),
+    stopBtn: document.getElementById('stop-btn'),
+    clearBtn: document.getElementById('clear-btn'),
+    copyBtn: document.getElementById('copy-btn'),
+    outputContent: document.getElementById('output-content')
 };
 
 // ===== Utility Functions =====
@@ -405,6 +419,141 @@ function renderProjectIntroduction() {
 }
 
 
+// ===== Legal Consultation =====
+// Aborting the fetch closes the connection, which makes the server cancel
+// the generation before its next decode step.
+let activeRequest = null;
+
+function renderEmptyOutput() {
+    elements.outputContent.innerHTML = `
+        <div class="empty-state">
+            <div class="empty-icon">⚖️</div>
+            <p>AI-generated legal analysis will appear here...</p>
+        </div>
+    `;
+}
+
+function readParams() {
+    return {
+        temperature: parseFloat(elements.temperature.value),
+        top_p: parseFloat(elements.topP.value),
+        top_k: parseInt(elements.topK.value, 10),
+        max_tokens: parseInt(elements.maxTokens.value, 10)
+    };
+}
+
+// Parses the `data: {...}` server-sent events of a streamed completion
+async function readEventStream(response, onDelta) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) return;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const event of events) {
+            const data = event.replace(/^data: /, '');
+            if (data === '[DONE]') return;
+            const chunk = JSON.parse(data);
+            if (chunk.error) throw new Error(chunk.error.message);
+            const delta = chunk.choices[0].delta.content;
+            if (delta) onDelta(delta);
+        }
+    }
+}
+
+async function submitQuery() {
+    const query = elements.queryInput.value.trim();
+    if (!query) {
+        showToast('Please enter a legal question', true);
+        return;
+    }
+
+    const stream = elements.streamOutput.checked;
+    activeRequest = new AbortController();
+    elements.submitBtn.disabled = true;
+    elements.stopBtn.disabled = false;
+    // no loading overlay: it would cover the Stop button
+    elements.outputContent.textContent = stream ? '' : 'Analyzing legal query...';
+
+    try {
+        const response = await fetch(API_CONFIG.baseURL + API_CONFIG.endpoint, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            signal: activeRequest.signal,
+            body: JSON.stringify({
+                messages: [{ role: 'user', content: query }],
+                stream,
+                ...readParams()
+            })
+        });
+        if (!response.ok) {
+            const body = await response.json().catch(() => ({}));
+            if (response.status === 429) {
+                throw new Error(`Server is busy, please retry in ${response.headers.get('Retry-After') || 1}s`);
+            }
+            throw new Error(body.error ? body.error.message : `HTTP ${response.status}`);
+        }
+        if (stream) {
+            await readEventStream(response, delta => {
+                elements.outputContent.textContent += delta;
+                elements.outputContent.scrollTop = elements.outputContent.scrollHeight;
+            });
+        } else {
+            const body = await response.json();
+            elements.outputContent.textContent = body.choices[0].message.content;
+        }
+    } catch (error) {
+        if (error.name === 'AbortError') {
+            showToast('Generation stopped');
+        } else {
+            showToast(`Request failed: ${error.message}`, true);
+        }
+        if (!stream || !elements.outputContent.textContent) renderEmptyOutput();
+    } finally {
+        activeRequest = null;
+        elements.submitBtn.disabled = false;
+        elements.stopBtn.disabled = true;
+    }
+}
+
+function initConsultation() {
+    renderEmptyOutput();
+
+    elements.toggleParams.addEventListener('click', () => {
+        elements.toggleParams.classList.toggle('active');
+        elements.paramsContent.classList.toggle('active');
+    });
+
+    [elements.temperature, elements.topP, elements.topK, elements.maxTokens].forEach(slider => {
+        const label = document.getElementById(`${slider.id}-value`);
+        slider.addEventListener('input', () => {
+            label.textContent = slider.value;
+        });
+    });
+
+    elements.submitBtn.addEventListener('click', submitQuery);
+    elements.stopBtn.addEventListener('click', () => {
+        if (activeRequest) activeRequest.abort();
+    });
+    elements.queryInput.addEventListener('keydown', (e) => {
+        if (e.key === 'Enter' && (e.ctrlKey || e.metaKey)) submitQuery();
+    });
+
+    elements.clearBtn.addEventListener('click', () => {
+        elements.queryInput.value = '';
+        renderEmptyOutput();
+    });
+
+    elements.copyBtn.addEventListener('click', () => {
+        navigator.clipboard.writeText(elements.outputContent.textContent.trim())
+            .then(() => showToast('Copied to clipboard'))
+            .catch(() => showToast('Copy failed', true));
+    });
+}
+
 // ===== Legal Provisions =====
 function renderProvisions(category = 'all') {
     elements.provisionsContainer.innerHTML = '';
@@ -480,6 +629,7 @@ function init() {
     initProvisions();
     renderCases();
     renderProjectIntroduction();
+    initConsultation();
     initEventListeners();
     
     // Show initial section
@@ -0,0 +1,88 @@
+"""
+Micro-benchmark for streaming detokenization.
+
+Replays an answer token by token and compares the per-token cost of the old
+path (decode prompt+output, then `Prompter.get_response`) with
+`utils.callbacks.StreamDetokenizer`, averaged over the 64 tokens before each
+length checkpoint. The old cost grows with answer length, the incremental one
+should stay flat. Also checks both produce the same text.
+
+    python tools/bench_detokenize.py --tokenizer minlik/American-alpaca-plus-7b-merged
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from transformers import LlamaTokenizer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.callbacks import StreamDetokenizer  # noqa: E402
+from utils.prompter import Prompter  # noqa: E402
+
+
+def load_answer_text(path):
+    with open(path) as f:
+        data = json.load(f)
+    return "\n".join(item["output"] for item in data)
+
+
+def replay(tokenizer, prompter, prompt_ids, answer_ids):
+    """Returns per-token seconds for both paths plus their final texts."""
+    old_cost, new_cost = [], []
+
+    full = list(prompt_ids)
+    for token in answer_ids:
+        start = time.perf_counter()
+        full.append(token)
+        old_text = prompter.get_response(tokenizer.decode(full))
+        old_cost.append(time.perf_counter() - start)
+
+    detokenizer = StreamDetokenizer(tokenizer, prompt_ids)
+    response = ""
+    for token in answer_ids:
+        start = time.perf_counter()
+        delta = detokenizer.put([token])
+        if delta:
+            response += delta if response else delta.lstrip()
+        new_cost.append(time.perf_counter() - start)
+    response += detokenizer.flush()
+    return old_cost, new_cost, old_text, response.strip()
+
+
+def mean_around(costs, n, window=64):
+    chunk = costs[max(n - window, 0):n]
+    return sum(chunk) / len(chunk)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", default="minlik/American-alpaca-plus-7b-merged", type=str)
+    parser.add_argument("--data_path", default="./resources/example_instruction_tune.json", type=str)
+    parser.add_argument("--max_tokens", default=2048, type=int)
+    args = parser.parse_args()
+
+    tokenizer = LlamaTokenizer.from_pretrained(args.tokenizer)
+    prompter = Prompter("alpaca")
+    prompt_ids = tokenizer(prompter.generate_prompt("请问加班工资怎么算？"))["input_ids"]
+    answer = load_answer_text(args.data_path)
+    answer_ids = tokenizer(answer, add_special_tokens=False)["input_ids"]
+    while len(answer_ids) < args.max_tokens:
+        answer_ids = answer_ids + answer_ids
+    answer_ids = answer_ids[:args.max_tokens]
+
+    old_cost, new_cost, old_text, new_text = replay(
+        tokenizer, prompter, prompt_ids, answer_ids
+    )
+    print(f"{'tokens':>8} {'full decode':>16} {'incremental':>16}")
+    for n in (128, 256, 512, 1024, 2048, 4096):
+        if n > len(answer_ids):
+            break
+        print(
+            f"{n:>8} {mean_around(old_cost, n) * 1e6:13.1f} us "
+            f"{mean_around(new_cost, n) * 1e6:13.1f} us"
+        )
+    print("outputs identical:", old_text == new_text)
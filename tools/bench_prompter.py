@@ -0,0 +1,74 @@
+"""
+Per-request prompt overhead: whole-prompt tokenization and marker search
+versus utils.prompter.CompiledTemplate.
+
+For the instructions in the example file, times building prompt ids one by
+one (generate_prompt + tokenizer) and as one `encode_batch` call, and
+extracting the response from prompt + answer ids by decoding everything and
+splitting on the response marker versus decoding from the prompt offset.
+Also checks both give the same ids and answers.
+
+    python tools/bench_prompter.py --tokenizer minlik/American-alpaca-plus-7b-merged
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from transformers import LlamaTokenizer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.prompter import Prompter  # noqa: E402
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeat
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", default="minlik/American-alpaca-plus-7b-merged", type=str)
+    parser.add_argument("--data_path", default="./resources/example_instruction_tune.json", type=str)
+    parser.add_argument("--prompt_template", default="law_template", type=str)
+    parser.add_argument("--repeat", default=5, type=int)
+    args = parser.parse_args()
+
+    tokenizer = LlamaTokenizer.from_pretrained(args.tokenizer)
+    prompter = Prompter(args.prompt_template)
+    with open(args.data_path) as f:
+        data = json.load(f)
+    instructions = [item["instruction"] for item in data]
+    inputs = [item.get("input") for item in data]
+    answers = [tokenizer(item["output"], add_special_tokens=False)["input_ids"] for item in data]
+
+    template, compile_seconds = timed(lambda: prompter.compile(tokenizer), 1)
+    print(f"compiled in {compile_seconds * 1000:.1f} ms, exact concatenation: {template.exact}")
+
+    old_ids, old_encode = timed(
+        lambda: [
+            tokenizer(prompter.generate_prompt(i, x))["input_ids"] for i, x in zip(instructions, inputs)
+        ],
+        args.repeat,
+    )
+    new_ids, new_encode = timed(lambda: template.encode_batch(instructions, inputs), args.repeat)
+
+    sequences = [ids + answer for ids, answer in zip(new_ids, answers)]
+    old_text, old_decode = timed(
+        lambda: [prompter.get_response(tokenizer.decode(s)) for s in sequences], args.repeat
+    )
+    new_text, new_decode = timed(
+        lambda: [template.decode_response(s, len(ids)) for s, ids in zip(sequences, new_ids)],
+        args.repeat,
+    )
+
+    n = len(instructions)
+    print(f"prompt ids: {old_encode / n * 1e6:8.1f} us/request -> {new_encode / n * 1e6:8.1f} us/request")
+    print(f"responses:  {old_decode / n * 1e6:8.1f} us/request -> {new_decode / n * 1e6:8.1f} us/request")
+    print(f"same ids: {sum(a == b for a, b in zip(old_ids, new_ids))}/{n}, "
+          f"same answers: {sum(a == b for a, b in zip(old_text, new_text))}/{n}")
@@ -0,0 +1,98 @@
+"""
+Memory, speed and accuracy of utils.quantize's weight-only CPU modes.
+
+Loads the model once per mode (fp32, int8, int4), then reports the bytes held
+by weights, greedy decode tokens/sec and perplexity on the sample judgments
+in resources/example_instruction_train.json, with the perplexity change and
+largest logit difference relative to fp32.
+
+    python tools/bench_quantize.py --model_dir ./models/base_models/legal_base-7b
+
+Without --model_dir a tiny random Llama reads the judgments as bytes, which
+checks the kernels and the relative error but not real perplexity.
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+import torch
+from transformers import LlamaForCausalLM, LlamaTokenizer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_engine import tiny_llama  # noqa: E402
+from utils.quantize import quantize_model, weight_bytes  # noqa: E402
+
+
+def load(model_dir, mode, group_size):
+    if model_dir:
+        model = LlamaForCausalLM.from_pretrained(
+            model_dir, torch_dtype=torch.float32, low_cpu_mem_usage=True
+        ).eval()
+    else:
+        model = tiny_llama()
+    if mode != "fp32":
+        quantize_model(model, 8 if mode == "int8" else 4, group_size)
+    return model
+
+
+def perplexity(model, sequences):
+    nll, count = 0.0, 0
+    for ids in sequences:
+        input_ids = torch.tensor([ids])
+        nll += model(input_ids=input_ids, labels=input_ids).loss.item() * (len(ids) - 1)
+        count += len(ids) - 1
+    return math.exp(nll / count)
+
+
+def decode_speed(model, prompts, max_new_tokens):
+    start = time.perf_counter()
+    for ids in prompts:
+        model.generate(
+            torch.tensor([ids]), max_new_tokens=max_new_tokens,
+            do_sample=False, eos_token_id=None, pad_token_id=0,
+        )
+    return len(prompts) * max_new_tokens / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir", default="", type=str, help="merged checkpoint; a tiny random model if empty")
+    parser.add_argument("--data_path", default="./resources/example_instruction_train.json", type=str)
+    parser.add_argument("--modes", default="fp32,int8,int4", type=str)
+    parser.add_argument("--group_size", default=0, type=int, help="int4 group size, 128 (32 for the tiny model) if 0")
+    parser.add_argument("--max_length", default=512, type=int, help="tokens per judgment for perplexity")
+    parser.add_argument("--limit", default=8, type=int, help="judgments to read")
+    parser.add_argument("--max_new_tokens", default=32, type=int)
+    args = parser.parse_args()
+    group_size = args.group_size or (128 if args.model_dir else 32)
+    torch.manual_seed(0)
+
+    with open(args.data_path, encoding="utf-8") as f:
+        texts = [record["content"] for record in json.load(f)[: args.limit]]
+    if args.model_dir:
+        tokenizer = LlamaTokenizer.from_pretrained(args.model_dir)
+        sequences = [tokenizer(text)["input_ids"][: args.max_length] for text in texts]
+    else:
+        sequences = [[1] + [3 + b for b in text.encode("utf-8")][: args.max_length - 1] for text in texts]
+    prompts = [ids[:32] for ids in sequences]
+
+    baseline = None
+    for mode in args.modes.split(","):
+        model = load(args.model_dir, mode, group_size)
+        with torch.no_grad():
+            logits = model(input_ids=torch.tensor([sequences[0]])).logits
+            ppl = perplexity(model, sequences)
+            speed = decode_speed(model, prompts, args.max_new_tokens)
+        if baseline is None:
+            baseline = (ppl, logits)
+        print(
+            f"{mode:<5} weights={weight_bytes(model) / 2**20:9.1f} MiB "
+            f"tokens/sec={speed:8.1f} perplexity={ppl:9.3f} "
+            f"(delta {ppl - baseline[0]:+.3f}, {(ppl / baseline[0] - 1):+.2%}) "
+            f"max logit diff={(logits - baseline[1]).abs().max():.3g}"
+        )
+        del model
@@ -0,0 +1,102 @@
+"""
+Tokenization throughput for finetune.py's instruction data.
+
+Runs the former per-example path (tokenize the full prompt, tokenize the
+user prompt again for its length, build labels by list concatenation) and
+utils.tokenization.tokenize_instructions over the same rows with the same
+number of worker processes, then prints examples/sec for both and how many
+rows get identical input ids and labels.
+
+    python tools/bench_tokenize.py --tokenizer minlik/American-alpaca-plus-7b-merged \
+        --data_path ./data/finetune_law_data.json --num_proc 8
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from datasets import load_dataset
+from transformers import LlamaTokenizer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.prompter import Prompter  # noqa: E402
+from utils.tokenization import tokenize_instructions  # noqa: E402
+
+
+def reference_tokenize(data_point, tokenizer, prompter, cutoff_len, train_on_inputs):
+    def tokenize(prompt, add_eos_token=True):
+        result = tokenizer(prompt, truncation=True, max_length=cutoff_len, padding=False)
+        if (
+            result["input_ids"][-1] != tokenizer.eos_token_id
+            and len(result["input_ids"]) < cutoff_len
+            and add_eos_token
+        ):
+            result["input_ids"].append(tokenizer.eos_token_id)
+            result["attention_mask"].append(1)
+        result["labels"] = result["input_ids"].copy()
+        return result
+
+    full_prompt = prompter.generate_prompt(
+        data_point["instruction"], data_point["input"], data_point["output"]
+    )
+    result = tokenize(full_prompt)
+    if not train_on_inputs:
+        user_prompt = prompter.generate_prompt(data_point["instruction"], data_point["input"])
+        user_prompt_len = len(tokenize(user_prompt)["input_ids"]) - 1
+        result["labels"] = [-100] * user_prompt_len + result["labels"][user_prompt_len:]
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", required=True)
+    parser.add_argument("--data_path", required=True)
+    parser.add_argument("--prompt_template_name", default="alpaca")
+    parser.add_argument("--cutoff_len", default=256, type=int)
+    parser.add_argument("--train_on_inputs", action="store_true")
+    parser.add_argument("--num_proc", default=1, type=int)
+    parser.add_argument("--limit", default=0, type=int)
+    args = parser.parse_args()
+
+    tokenizer = LlamaTokenizer.from_pretrained(args.tokenizer)
+    prompter = Prompter(args.prompt_template_name)
+    data = load_dataset("json", data_files=args.data_path)["train"]
+    if args.limit:
+        data = data.select(range(min(args.limit, len(data))))
+    columns = data.column_names
+    common = dict(num_proc=args.num_proc, remove_columns=columns, load_from_cache_file=False)
+
+    start = time.perf_counter()
+    reference = data.map(
+        reference_tokenize,
+        fn_kwargs=dict(
+            tokenizer=tokenizer, prompter=prompter, cutoff_len=args.cutoff_len,
+            train_on_inputs=args.train_on_inputs,
+        ),
+        **common,
+    )
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = data.map(
+        tokenize_instructions,
+        batched=True,
+        fn_kwargs=dict(
+            tokenizer=tokenizer, prompter=prompter, cutoff_len=args.cutoff_len,
+            train_on_inputs=args.train_on_inputs,
+        ),
+        **common,
+    )
+    batched_time = time.perf_counter() - start
+
+    same_ids = sum(a == b for a, b in zip(reference["input_ids"], batched["input_ids"]))
+    same_labels = sum(a == b for a, b in zip(reference["labels"], batched["labels"]))
+    print(f"{len(data)} examples, num_proc={args.num_proc}, cutoff_len={args.cutoff_len}")
+    print(f"per-example  {len(data) / reference_time:9.1f} examples/sec")
+    print(
+        f"batched      {len(data) / batched_time:9.1f} examples/sec "
+        f"({reference_time / batched_time:.2f}x)"
+    )
+    print(f"identical input_ids: {same_ids}/{len(data)}, identical labels: {same_labels}/{len(data)}")
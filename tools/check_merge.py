@@ -0,0 +1,76 @@
+"""
+Equivalence check for utils.lora_merge against PEFT's merge_and_unload.
+
+Saves a tiny randomly initialised Llama as several small safetensors shards,
+attaches a LoRA adapter with random (non-zero) factors, then merges it both
+ways and compares every tensor plus the logits of the reloaded streaming
+merge with the unmerged PEFT model. In float32 the difference should be at
+rounding level; in float16 within one unit in the last place.
+
+    python tools/check_merge.py --dtype float32 --workers 2
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+import torch
+from peft import LoraConfig, PeftModel, get_peft_model
+from transformers import LlamaForCausalLM
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_engine import tiny_llama  # noqa: E402
+from utils.lora_merge import merge_lora  # noqa: E402
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--rank", default=8, type=int)
+    parser.add_argument("--workers", default=1, type=int)
+    args = parser.parse_args()
+    dtype = getattr(torch, args.dtype)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base_dir, lora_dir, out_dir = (os.path.join(tmp, d) for d in ("base", "lora", "merged"))
+        tiny_llama().save_pretrained(base_dir, safe_serialization=True, max_shard_size="200KB")
+
+        torch.manual_seed(0)
+        peft_model = get_peft_model(
+            tiny_llama(),
+            LoraConfig(
+                r=args.rank, lora_alpha=2 * args.rank, lora_dropout=0.0,
+                target_modules=["q_proj", "k_proj", "v_proj", "o_proj"], task_type="CAUSAL_LM",
+            ),
+        )
+        with torch.no_grad():
+            for name, param in peft_model.named_parameters():
+                if "lora_B" in name:
+                    param.normal_(std=0.02)
+        peft_model.save_pretrained(lora_dir)
+
+        base = LlamaForCausalLM.from_pretrained(base_dir, torch_dtype=dtype)
+        reference_model = PeftModel.from_pretrained(base, lora_dir, torch_dtype=dtype).eval()
+        input_ids = torch.randint(3, 512, (2, 16))
+        with torch.no_grad():
+            reference_logits = reference_model(input_ids=input_ids).logits.float()
+        reference = reference_model.merge_and_unload().state_dict()
+
+        merged_names = merge_lora(
+            base_dir, lora_dir, out_dir, dtype=args.dtype, max_shard_mb=1, workers=args.workers
+        )
+        streamed_model = LlamaForCausalLM.from_pretrained(out_dir, torch_dtype=dtype).eval()
+        streamed = streamed_model.state_dict()
+        with torch.no_grad():
+            streamed_logits = streamed_model(input_ids=input_ids).logits.float()
+
+    assert set(streamed) == set(reference), set(streamed) ^ set(reference)
+    worst = max(
+        ((reference[k].float() - streamed[k].float()).abs().max().item(), k) for k in reference
+    )
+    unchanged = sum(
+        torch.equal(reference[k], streamed[k]) for k in reference if k not in merged_names
+    )
+    print(f"{len(merged_names)} merged weights, {unchanged}/{len(reference) - len(merged_names)} others identical")
+    print(f"largest weight difference: {worst[0]:.3g} ({worst[1]})")
+    print(f"largest logit difference vs. unmerged PEFT model: {(reference_logits - streamed_logits).abs().max():.3g}")
@@ -0,0 +1,68 @@
+"""
+Consistency check for streamed beam search (utils.callbacks.stream_beam_search).
+
+For each instruction in the example file, runs a streamed beam-search request
+the way webapp.py does (caching only its last value), then the same request
+non-streamed, and checks that both answers and the cached one are identical.
+Uses a tiny random Llama with the real tokenizer's vocabulary.
+
+    python tools/check_stream.py --tokenizer minlik/American-alpaca-plus-7b-merged
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import torch
+from transformers import GenerationConfig, LlamaTokenizer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_engine import tiny_llama  # noqa: E402
+from utils.cache import ResponseCache  # noqa: E402
+from utils.callbacks import stream_beam_search  # noqa: E402
+from utils.prompter import Prompter  # noqa: E402
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", default="minlik/American-alpaca-plus-7b-merged", type=str)
+    parser.add_argument("--data_path", default="./resources/example_instruction_tune.json", type=str)
+    parser.add_argument("--prompt_template", default="law_template", type=str)
+    parser.add_argument("--num_beams", default=4, type=int)
+    parser.add_argument("--max_new_tokens", default=32, type=int)
+    parser.add_argument("--limit", default=4, type=int)
+    args = parser.parse_args()
+
+    tokenizer = LlamaTokenizer.from_pretrained(args.tokenizer)
+    model = tiny_llama(vocab_size=len(tokenizer))
+    template = Prompter(args.prompt_template).compile(tokenizer)
+    response_cache = ResponseCache(16, 3600)
+    with open(args.data_path) as f:
+        data = json.load(f)[: args.limit]
+
+    failures = 0
+    for item in data:
+        prompt_ids = template.encode(item["instruction"], item.get("input"))
+        generate_params = dict(
+            input_ids=torch.tensor([prompt_ids]),
+            generation_config=GenerationConfig(num_beams=args.num_beams),
+            return_dict_in_generate=True,
+            max_new_tokens=args.max_new_tokens,
+        )
+        key = response_cache.make_key(
+            item["instruction"], "tiny", num_beams=args.num_beams, max_new_tokens=args.max_new_tokens
+        )
+
+        # streamed first, caching its last value as webapp.evaluate does
+        streamed = list(stream_beam_search(model, tokenizer, template, prompt_ids, dict(generate_params)))
+        response_cache.put(key, streamed[-1])
+        with torch.no_grad():
+            output = model.generate(**generate_params)
+        answer = template.decode_response(output.sequences[0], len(prompt_ids))
+
+        same = streamed[-1] == answer == response_cache.get(key)
+        failures += not same
+        print(f"{len(streamed) - 1:3d} partial values, streamed == non-streamed == cached: {same}")
+    print("all consistent" if not failures else f"{failures}/{len(data)} inconsistent")
+    sys.exit(1 if failures else 0)
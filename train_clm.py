@@ -15,7 +15,12 @@ from peft import (
     set_peft_model_state_dict,
 )
 from transformers import LlamaForCausalLM, LlamaTokenizer
+from utils.batching import TokenBudgetBatchSampler, TokenBudgetTrainer, dataset_lengths
+from utils.dataset_cache import tokenized_dataset
+from utils.packing import PackedCollator, PackedDataset, report_packing
 from utils.prompter import Prompter
+from utils.streaming import StreamingCollator, StreamingDataset, StreamStateCallback, load_stream_state
+from utils.throughput import ThroughputCallback
 
 
 def train(
@@ -54,6 +59,19 @@ def train(
 
     # The prompt template to use, will default to alpaca.
     prompt_template_name: str = "alpaca",
+
+    # data preprocessing
+    dataset_cache_dir: str = "",  # store and reuse pre-tokenized splits here, e.g. ./data/tokenized; "" tokenizes every launch
+    tokenize_num_proc: int = 8,  # tokenizer worker processes when building the cache
+    prepare_only: bool = False,  # build the tokenized cache and exit without training
+    pack_sequences: bool = False,  # concatenate documents into cutoff_len blocks, no padding or truncation
+    mask_documents: bool = False,  # with packing, keep attention within each document
+    streaming: bool = False,  # read and tokenize data on the fly instead of loading it, needs max_steps
+    stream_buffer_size: int = 10000,  # records in the streaming shuffle buffer
+    stream_num_workers: int = 2,  # dataloader processes tokenizing the stream
+    max_steps: int = -1,  # if > 0, train for this many steps instead of num_epochs
+    max_batch_tokens: int = 0,  # if > 0, fill micro batches up to this many padded tokens instead of micro_batch_size
+    throughput_log: str = "throughput.jsonl",  # per-step timings, tokens and memory in output_dir (.jsonl or .csv), "" to disable
 ):
     if int(os.environ.get("LOCAL_RANK", 0)) == 0:
         print(
@@ -80,6 +98,17 @@ def train(
             f"wandb_log_model: {wandb_log_model}\n"
             f"resume_from_checkpoint: {resume_from_checkpoint or False}\n"
             f"prompt template: {prompt_template_name}\n"
+            f"dataset_cache_dir: {dataset_cache_dir}\n"
+            f"tokenize_num_proc: {tokenize_num_proc}\n"
+            f"prepare_only: {prepare_only}\n"
+            f"pack_sequences: {pack_sequences}\n"
+            f"mask_documents: {mask_documents}\n"
+            f"streaming: {streaming}\n"
+            f"stream_buffer_size: {stream_buffer_size}\n"
+            f"stream_num_workers: {stream_num_workers}\n"
+            f"max_steps: {max_steps}\n"
+            f"max_batch_tokens: {max_batch_tokens}\n"
+            f"throughput_log: {throughput_log}\n"
         )
     gradient_accumulation_steps = batch_size // micro_batch_size
 
@@ -105,13 +134,6 @@ def train(
     if len(wandb_log_model) > 0:
         os.environ["WANDB_LOG_MODEL"] = wandb_log_model
 
-    model = LlamaForCausalLM.from_pretrained(
-        base_model,
-        load_in_8bit=True,
-        torch_dtype=torch.float16,
-        device_map=device_map,
-    )
-
     tokenizer = LlamaTokenizer.from_pretrained(base_model)
     tokenizer.bos_token_id = 1
     tokenizer.eos_token_id = 2
@@ -154,6 +176,65 @@ def train(
         tokenized_full_prompt = tokenize(text)
         return tokenized_full_prompt
 
+    def tokenize_document(data_point):
+        # packing cuts blocks from whole documents, so nothing is truncated
+        input_ids = tokenizer(data_point["content"])["input_ids"] + [tokenizer.eos_token_id]
+        return {"input_ids": input_ids, "labels": input_ids}
+
+    def prepare(split):
+        if pack_sequences:
+            documents = tokenized_dataset(
+                split, tokenize_document, tokenizer, dataset_cache_dir,
+                num_proc=tokenize_num_proc, text_column="content", cutoff_len=None)
+            packed = PackedDataset(documents, cutoff_len)
+            if int(os.environ.get("LOCAL_RANK", 0)) == 0:
+                report_packing(documents.lengths, micro_batch_size, cutoff_len, packed)
+            return packed
+        if not dataset_cache_dir:
+            return split.shuffle().map(generate_and_tokenize_prompt)
+        # the Trainer's sampler shuffles; a shuffled split would never hit the cache
+        documents = tokenized_dataset(
+            split, generate_and_tokenize_prompt, tokenizer, dataset_cache_dir,
+            num_proc=tokenize_num_proc, text_column="content", cutoff_len=cutoff_len)
+        if int(os.environ.get("LOCAL_RANK", 0)) == 0:
+            report_packing(documents.lengths, micro_batch_size, cutoff_len)
+        return documents
+
+    assert dataset_cache_dir or not prepare_only, "--prepare_only needs a --dataset_cache_dir"
+    assert dataset_cache_dir or not pack_sequences, "--pack_sequences needs a --dataset_cache_dir"
+    assert not (streaming and pack_sequences), "--pack_sequences does not support --streaming"
+    assert not (streaming or pack_sequences) or not max_batch_tokens, \
+        "--max_batch_tokens does not support --streaming or --pack_sequences"
+
+    if streaming:
+        assert max_steps > 0, "Streaming has no epochs, please specify --max_steps"
+        # records are tokenized by the data collator, in the dataloader workers
+        train_data = StreamingDataset(data_path, stream_buffer_size, holdout=val_set_size)
+        val_data = train_data.heldout() if val_set_size > 0 else None
+    else:
+        if data_path.endswith(".json") or data_path.endswith(".jsonl"):
+            data = load_dataset("json", data_files=data_path)
+        else:
+            data = load_dataset(data_path)
+
+        if val_set_size > 0:
+            train_val = data["train"].train_test_split(test_size=val_set_size, shuffle=True, seed=42)
+            train_data = prepare(train_val["train"])
+            val_data = prepare(train_val["test"])
+        else:
+            train_data = prepare(data["train"])
+            val_data = None
+
+    if prepare_only:
+        return
+
+    model = LlamaForCausalLM.from_pretrained(
+        base_model,
+        load_in_8bit=True,
+        torch_dtype=torch.float16,
+        device_map=device_map,
+    )
+
     model = prepare_model_for_int8_training(model)
 
     config = LoraConfig(
@@ -166,11 +247,6 @@ def train(
     )
     model = get_peft_model(model, config)
 
-    if data_path.endswith(".json") or data_path.endswith(".jsonl"):
-        data = load_dataset("json", data_files=data_path)
-    else:
-        data = load_dataset(data_path)
-
     if resume_from_checkpoint:
         # Check the available weights and load them
         checkpoint_name = os.path.join(
@@ -194,20 +270,47 @@ def train(
     # Be more transparent about the % of trainable params.
     model.print_trainable_parameters()
 
-    if val_set_size > 0:
-        train_val = data["train"].train_test_split(test_size=val_set_size, shuffle=True, seed=42)
-        train_data = (train_val["train"].shuffle().map(generate_and_tokenize_prompt))
-        val_data = (train_val["test"].shuffle().map(generate_and_tokenize_prompt))
-    else:
-        train_data = data["train"].shuffle().map(generate_and_tokenize_prompt)
-        val_data = None
+    stream_state = load_stream_state(resume_from_checkpoint) if streaming else None
+    if stream_state:
+        print(f"Resuming the data stream after step {stream_state['global_step']}")
+        train_data.resume(stream_state)
 
     if not ddp and torch.cuda.device_count() > 1:
         # keeps Trainer from trying its own DataParallelism when more than 1 gpu is available
         model.is_parallelizable = True
         model.model_parallel = True
 
-    trainer = transformers.Trainer(
+    if pack_sequences:
+        data_collator = PackedCollator(tokenizer.eos_token_id, mask_documents)
+    else:
+        data_collator = transformers.DataCollatorForSeq2Seq(
+            tokenizer, pad_to_multiple_of=8, return_tensors="pt", padding=True
+        )
+    if streaming:
+        data_collator = StreamingCollator(generate_and_tokenize_prompt, data_collator)
+
+    batch_sampler = None
+    if max_batch_tokens > 0:
+        batch_sampler = TokenBudgetBatchSampler(
+            dataset_lengths(train_data), max_batch_tokens
+        )
+        # keep about batch_size examples' worth of tokens per optimizer step
+        gradient_accumulation_steps = batch_sampler.accumulation_steps(
+            batch_size, world_size
+        )
+        if int(os.environ.get("LOCAL_RANK", 0)) == 0:
+            print(
+                f"{len(batch_sampler)} token-budget batches of up to {max_batch_tokens} tokens, "
+                f"gradient_accumulation_steps: {gradient_accumulation_steps}"
+            )
+
+    callbacks = []
+    if streaming:
+        callbacks.append(StreamStateCallback())
+    if throughput_log:
+        callbacks.append(ThroughputCallback(throughput_log))
+
+    trainer = TokenBudgetTrainer(
         model=model,
         train_dataset=train_data,
         eval_dataset=val_data,
@@ -216,6 +319,7 @@ def train(
             gradient_accumulation_steps=gradient_accumulation_steps,
             warmup_steps=100,
             num_train_epochs=num_epochs,
+            max_steps=max_steps,
             learning_rate=learning_rate,
             fp16=True,
             logging_steps=10,
@@ -228,13 +332,18 @@ def train(
             save_total_limit=3,
             load_best_model_at_end=True if val_set_size > 0 else False,
             ddp_find_unused_parameters=False if ddp else None,
-            group_by_length=group_by_length,
+            group_by_length=group_by_length and not (pack_sequences or streaming or max_batch_tokens),
+            dataloader_num_workers=stream_num_workers if streaming else 0,
+            # raw streamed records only become model inputs in the collator
+            remove_unused_columns=not streaming,
+            # the stream skips trained records itself, without tokenizing them
+            ignore_data_skip=streaming,
             report_to="wandb" if use_wandb else None,
             run_name=wandb_run_name if use_wandb else None,
         ),
-        data_collator=transformers.DataCollatorForSeq2Seq(
-            tokenizer, pad_to_multiple_of=8, return_tensors="pt", padding=True
-        ),
+        data_collator=data_collator,
+        callbacks=callbacks,
+        batch_sampler=batch_sampler,
     )
     model.config.use_cache = False
 
@@ -0,0 +1,122 @@
+"""
+Several LoRA adapters resident on one base model.
+
+Adapters are loaded into a single PeftModel on first use and evicted in LRU
+order once their combined size exceeds a memory budget. Adapters pinned by
+in-flight requests are never evicted, and neither is the one loaded at
+startup. With PEFT >= 0.10 rows of one forward pass can use different
+adapters (`adapter_names=`), so requests for different adapters still share
+the engine's decode batch; older PEFT falls back to switching the active
+adapter between batches.
+"""
+
+import threading
+from collections import Counter, OrderedDict
+
+from packaging import version
+
+
+def _peft_supports_mixed_batches():
+    import peft
+
+    return version.parse(peft.__version__) >= version.parse("0.10.0")
+
+
+class AdapterManager:
+    def __init__(self, model, adapters=None, budget_mb: float = 0, default: str = "default"):
+        if not hasattr(model, "peft_config"):
+            raise ValueError(
+                "Multi-LoRA serving needs a LoRA adapter loaded at startup, "
+                "please pass --lora_weights"
+            )
+        self.model = model
+        self.default = default
+        self.paths = dict(adapters or {})
+        self.budget = budget_mb * 2**20
+        self.loaded = OrderedDict()
+        self.refs = Counter()
+        self.active = None
+        self.mixed_batches = _peft_supports_mixed_batches()
+        self.lock = threading.Lock()
+        for name in model.peft_config:
+            self.loaded[name] = self._adapter_bytes(name)
+
+    @property
+    def names(self):
+        return list(dict.fromkeys(list(self.loaded) + list(self.paths)))
+
+    def resolve(self, name):
+        name = name or self.default
+        if name not in self.loaded and name not in self.paths:
+            raise KeyError(f"Unknown LoRA adapter {name!r}, known: {self.names}")
+        return name
+
+    def _adapter_bytes(self, name):
+        return sum(
+            p.numel() * p.element_size()
+            for n, p in self.model.named_parameters()
+            if f".{name}." in n
+        )
+
+    def acquire(self, name):
+        """
+        Pin an adapter for one request, loading it if needed. Must be called
+        with the engine lock held since it may change the model. Returns
+        (name, newly_loaded, evicted_names).
+        """
+        with self.lock:
+            self.refs[name] += 1
+            if name in self.loaded:
+                self.loaded.move_to_end(name)
+                return name, False, []
+        try:
+            self.model.load_adapter(self.paths[name], adapter_name=name)
+        except Exception:
+            self.release(name)
+            raise
+        with self.lock:
+            self.loaded[name] = self._adapter_bytes(name)
+            evicted = self._evict()
+        print(f"Loaded LoRA adapter {name} ({self.loaded[name] / 2**20:.1f} MB)")
+        return name, True, evicted
+
+    def release(self, name):
+        with self.lock:
+            self.refs[name] -= 1
+
+    def _evict(self):
+        evicted = []
+        if not self.budget:
+            return evicted
+        for name in list(self.loaded):
+            if sum(self.loaded.values()) <= self.budget:
+                break
+            if name == self.default or self.refs[name] > 0:
+                continue
+            self.model.delete_adapter(name)
+            del self.loaded[name]
+            if self.active == name:
+                self.active = None
+            evicted.append(name)
+            print(f"Evicted LoRA adapter {name}")
+        return evicted
+
+    def activate(self, name):
+        """Make `name` the adapter used by forwards without `adapter_names`."""
+        if self.active != name:
+            self.model.set_adapter(name)
+            self.active = name
+
+    def forward_kwargs(self, names):
+        if self.mixed_batches:
+            return {"adapter_names": list(names)}
+        return {}
+
+    def stats(self):
+        with self.lock:
+            return {
+                "loaded": list(self.loaded),
+                "loaded_mb": sum(self.loaded.values()) / 2**20,
+                "budget_mb": self.budget / 2**20,
+                "in_use": {n: c for n, c in self.refs.items() if c > 0},
+            }
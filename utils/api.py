@@ -0,0 +1,444 @@
+"""
+OpenAI-compatible HTTP API served next to the Gradio UI.
+
+`create_app` exposes /v1/completions and /v1/chat/completions (optionally
+streamed as server-sent events), /v1/models and /metrics on top of the same
+engine, prompter and response cache as `webapp.evaluate`. Generation never
+runs on the event loop: engine requests are drained by the fixed pool of a
+`GenerationExecutor` into bounded buffers, which handlers read without
+blocking the loop. At most `max_pending` requests are in flight; the
+rest are turned away with 429 and a Retry-After header so callers back off
+instead of piling onto the decode batch.
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+
+from utils.cache import normalize_instruction
+from utils.callbacks import StreamDetokenizer, default_executor
+
+# engine finish reasons -> OpenAI finish reasons
+_FINISH_REASONS = {"eos": "stop", "length": "length"}
+
+
+class APIError(Exception):
+    def __init__(self, status, message, type="invalid_request_error", headers=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.type = type
+        self.headers = headers or {}
+
+
+def chat_to_instruction(messages):
+    """
+    Maps chat messages onto the instruction template: the last user message
+    is the instruction, earlier turns become the template's input.
+    """
+    if not messages or messages[-1].get("role") != "user":
+        raise APIError(400, "messages must end with a user message")
+    history = "\n".join(
+        f"{m.get('role', 'user')}: {m.get('content', '')}" for m in messages[:-1]
+    )
+    return messages[-1].get("content", ""), history or None
+
+
+def generation_params(body, default_max_tokens=512):
+    """Engine parameters for one request; temperature 0 (the default) is greedy."""
+    try:
+        temperature = float(body.get("temperature") or 0)
+        params = dict(
+            max_new_tokens=int(body.get("max_tokens") or default_max_tokens),
+            do_sample=temperature > 0,
+            temperature=temperature or 1.0,
+            top_p=float(body.get("top_p", 1.0)),
+            top_k=int(body.get("top_k", 0)),
+        )
+        n = int(body.get("n", 1))
+    except (TypeError, ValueError) as e:
+        raise APIError(400, f"Invalid generation parameter: {e}")
+    if n != 1:
+        raise APIError(400, "Only n=1 is supported")
+    if params["max_new_tokens"] <= 0:
+        raise APIError(400, "max_tokens must be positive")
+    return params
+
+
+class AnswerStream:
+
+    """
+    Streamed chat deltas cut the way `CompiledTemplate.answer` cuts a whole
+    answer: nothing from the response marker on and no surrounding
+    whitespace. Text that may still turn out to start the marker, or to be
+    trailing whitespace, is held back until a later delta settles it.
+    """
+
+    def __init__(self, marker):
+        self.marker = marker
+        self.pending = ""
+        self.started = False
+        self.stopped = False
+
+    def put(self, delta, final=False) -> str:
+        if self.stopped:
+            return ""
+        self.pending += delta
+        if not self.started:
+            self.pending = self.pending.lstrip()
+        cut = self.pending.find(self.marker)
+        if cut >= 0:
+            text, self.stopped = self.pending[:cut], True
+        elif final:
+            text = self.pending
+        else:
+            text = self.pending[:max(0, len(self.pending) - len(self.marker) + 1)]
+        text = text.rstrip()
+        self.pending = "" if self.stopped or final else self.pending[len(text):]
+        self.started = self.started or bool(text)
+        return text
+
+
+def create_app(
+    engine,
+    tokenizer,
+    prompter,
+    response_cache=None,
+    model_id: str = "",
+    max_pending: int = 32,
+    default_max_tokens: int = 512,
+    static_dir: str = "",
+    executor=None,
+):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+    from starlette.background import BackgroundTask
+
+    app = FastAPI(title="Legal-GPT API")
+    template = prompter.compile(tokenizer)
+    executor = executor or default_executor()
+    # handlers all run on the event loop, so a plain counter needs no lock
+    counters = {
+        "requests": 0,
+        "in_flight": 0,
+        "rejected": 0,
+        "streamed": 0,
+        "cached": 0,
+        "errors": 0,
+        "disconnected": 0,
+    }
+
+    def adapter_names():
+        names = ["default"]
+        if engine.adapters is not None:
+            names += [n for n in engine.adapters.names if n != "default"]
+        return names
+
+    def resolve_adapter(body):
+        if engine.adapters is None:
+            return "default"  # a single model answers whatever `model` says
+        try:
+            return engine.adapters.resolve(body.get("model") or "default")
+        except KeyError as e:
+            raise APIError(404, str(e.args[0]), type="model_not_found")
+
+    async def tokens(request):
+        """Token ids of an engine request, drained by an executor worker."""
+
+        def drain(callback=None):
+            for token in request:
+                callback(token)
+
+        try:
+            with executor.iterate(drain) as generator:
+                async for token in generator:
+                    yield token
+        finally:
+            # Left early: the client disconnected (the streaming response is
+            # cancelled) or gave up. Free the engine slot on the next step.
+            request.cancel()
+
+    async def cancel_on_disconnect(http_request, request):
+        # Non-streaming handlers are not cancelled when the client goes
+        # away, so poll for it while the answer is being generated.
+        while not request.done.is_set():
+            if await http_request.is_disconnected():
+                request.cancel()
+                counters["disconnected"] += 1
+                return
+            await asyncio.sleep(0.25)
+
+    def error_response(error, request_id=None):
+        headers = dict(error.headers)
+        if request_id:
+            headers["X-Request-ID"] = request_id
+        return JSONResponse(
+            {"error": {"message": error.message, "type": error.type, "code": error.status}},
+            status_code=error.status,
+            headers=headers,
+        )
+
+    async def complete(http_request, chat):
+        request_id = http_request.headers.get("X-Request-ID") or (
+            f"{'chatcmpl' if chat else 'cmpl'}-{uuid.uuid4().hex}"
+        )
+        counters["requests"] += 1
+        if counters["in_flight"] >= max_pending:
+            counters["rejected"] += 1
+            return error_response(
+                APIError(
+                    429,
+                    f"Server is busy ({max_pending} requests in flight), retry later",
+                    type="rate_limit_exceeded",
+                    headers={"Retry-After": "1"},
+                ),
+                request_id,
+            )
+        counters["in_flight"] += 1
+        released = False
+        try:
+            try:
+                body = await http_request.json()
+            except ValueError:
+                body = None
+            if not isinstance(body, dict):
+                raise APIError(400, "Request body must be a JSON object")
+            params = generation_params(body, default_max_tokens)
+            adapter = resolve_adapter(body)
+            if chat:
+                instruction, input = chat_to_instruction(body.get("messages"))
+                input_ids = template.encode(instruction, input)
+                key_prompt = prompter.generate_prompt(
+                    normalize_instruction(instruction), input
+                )
+            else:
+                prompt = body.get("prompt")
+                if isinstance(prompt, list) and len(prompt) == 1:
+                    prompt = prompt[0]
+                if not isinstance(prompt, str):
+                    raise APIError(400, "prompt must be a single string")
+                key_prompt = prompt
+                input_ids = tokenizer(prompt)["input_ids"]
+
+            # Same key as webapp.evaluate, so UI and API share cached answers.
+            cache_key = None
+            if response_cache is not None:
+                cache_key = response_cache.make_key(
+                    key_prompt,
+                    f"{model_id}|{adapter}",
+                    num_beams=1,
+                    max_new_tokens=params["max_new_tokens"],
+                    **({"do_sample": True} if params["do_sample"] else {}),
+                )
+            cached = response_cache.get(cache_key) if cache_key else None
+
+            request = None
+            if cached is None:
+                request = engine.submit(input_ids, adapter=adapter, **params)
+            else:
+                counters["cached"] += 1
+
+            meta = dict(
+                request_id=request_id,
+                created=int(time.time()),
+                model=body.get("model") or adapter,
+                chat=chat,
+                prompt_tokens=len(input_ids),
+            )
+            headers = {"X-Request-ID": request_id}
+            if body.get("stream"):
+                counters["streamed"] += 1
+                # the stream releases the slot when it ends; the background
+                # task covers clients that leave before it is iterated at all
+                released = True
+                slot = {"held": True}
+                return StreamingResponse(
+                    stream(request, cached, cache_key, input_ids, meta, slot),
+                    media_type="text/event-stream",
+                    headers=dict(headers, **{"Cache-Control": "no-cache"}),
+                    background=BackgroundTask(release, request, slot),
+                )
+            if cached is not None:
+                text, finish_reason, completion_tokens = cached, "stop", None
+            else:
+                watcher = asyncio.ensure_future(
+                    cancel_on_disconnect(http_request, request)
+                )
+                try:
+                    text, finish_reason, completion_tokens = await collect(
+                        request, input_ids, chat
+                    )
+                finally:
+                    watcher.cancel()
+                if request.finish_reason == "cancelled":
+                    # nobody is listening any more; don't cache a partial answer
+                    return error_response(
+                        APIError(499, "Client closed request", type="cancelled"),
+                        request_id,
+                    )
+                if response_cache is not None:
+                    response_cache.put(cache_key, text)
+            return JSONResponse(
+                response_body(meta, text, finish_reason, completion_tokens),
+                headers=headers,
+            )
+        except APIError as e:
+            return error_response(e, request_id)
+        except Exception as e:
+            counters["errors"] += 1
+            return error_response(APIError(500, str(e), type="server_error"), request_id)
+        finally:
+            if not released:
+                counters["in_flight"] -= 1
+
+    async def collect(request, input_ids, chat):
+        detokenizer = StreamDetokenizer(tokenizer, input_ids)
+        text = ""
+        async for token in tokens(request):
+            text += detokenizer.put([token])
+        text += detokenizer.flush()
+        if chat:
+            text = template.answer(text)
+        return text, _FINISH_REASONS.get(request.finish_reason), len(request.output_ids)
+
+    def response_body(meta, text, finish_reason, completion_tokens):
+        if completion_tokens is None:
+            completion_tokens = len(tokenizer(text, add_special_tokens=False)["input_ids"])
+        if meta["chat"]:
+            choice = {"index": 0, "message": {"role": "assistant", "content": text}}
+        else:
+            choice = {"index": 0, "text": text, "logprobs": None}
+        choice["finish_reason"] = finish_reason
+        return {
+            "id": meta["request_id"],
+            "object": "chat.completion" if meta["chat"] else "text_completion",
+            "created": meta["created"],
+            "model": meta["model"],
+            "choices": [choice],
+            "usage": {
+                "prompt_tokens": meta["prompt_tokens"],
+                "completion_tokens": completion_tokens,
+                "total_tokens": meta["prompt_tokens"] + completion_tokens,
+            },
+        }
+
+    def chunk(meta, text=None, finish_reason=None, first=False):
+        if meta["chat"]:
+            delta = {"role": "assistant"} if first else {}
+            if text:
+                delta["content"] = text
+            choice = {"index": 0, "delta": delta}
+        else:
+            choice = {"index": 0, "text": text or "", "logprobs": None}
+        choice["finish_reason"] = finish_reason
+        payload = {
+            "id": meta["request_id"],
+            "object": "chat.completion.chunk" if meta["chat"] else "text_completion",
+            "created": meta["created"],
+            "model": meta["model"],
+            "choices": [choice],
+        }
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    async def release(request, slot):
+        # once per streamed request, from whichever of the stream's finally
+        # and the response's background task runs first
+        if not slot["held"]:
+            return
+        slot["held"] = False
+        if request is not None and request.finish_reason is None:
+            # the response was cancelled because the client disconnected
+            counters["disconnected"] += 1
+            request.cancel()
+        counters["in_flight"] -= 1
+
+    async def stream(request, cached, cache_key, input_ids, meta, slot):
+        try:
+            yield chunk(meta, first=True)
+            if cached is not None:
+                yield chunk(meta, cached)
+                yield chunk(meta, finish_reason="stop")
+                yield "data: [DONE]\n\n"
+                return
+            detokenizer = StreamDetokenizer(tokenizer, input_ids)
+            # chat answers are cut at the response marker, as when not streamed
+            answer = AnswerStream(template.marker) if meta["chat"] else None
+            text = ""
+            try:
+                async for token in tokens(request):
+                    delta = detokenizer.put([token])
+                    text += delta
+                    if answer is not None:
+                        delta = answer.put(delta)
+                    if delta:
+                        yield chunk(meta, delta)
+                tail = detokenizer.flush()
+            except Exception as e:
+                counters["errors"] += 1
+                error = {"message": str(e), "type": "server_error", "code": 500}
+                yield f"data: {json.dumps({'error': error})}\n\n"
+                return
+            text += tail
+            if answer is not None:
+                tail = answer.put(tail, final=True)
+            if tail:
+                yield chunk(meta, tail)
+            if response_cache is not None:
+                response_cache.put(cache_key, template.answer(text) if meta["chat"] else text)
+            yield chunk(meta, finish_reason=_FINISH_REASONS.get(request.finish_reason))
+            yield "data: [DONE]\n\n"
+        finally:
+            await release(request, slot)
+
+    @app.post("/v1/completions")
+    async def completions(http_request: Request):
+        return await complete(http_request, chat=False)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(http_request: Request):
+        return await complete(http_request, chat=True)
+
+    @app.get("/v1/models")
+    async def models():
+        return {
+            "object": "list",
+            "data": [
+                {"id": name, "object": "model", "owned_by": "legal-gpt"}
+                for name in adapter_names()
+            ],
+        }
+
+    @app.get("/metrics")
+    async def metrics():
+        stats = {
+            "api": dict(counters, max_pending=max_pending),
+            "engine": engine.stats(),
+        }
+        if response_cache is not None:
+            stats["cache"] = response_cache.stats()
+        if engine.adapters is not None:
+            stats["adapters"] = engine.adapters.stats()
+        return stats
+
+    if static_dir and os.path.isdir(static_dir):
+        from fastapi.staticfiles import StaticFiles
+
+        # mounted last so the /v1 routes above take precedence
+        app.mount("/", StaticFiles(directory=static_dir, html=True), name="static")
+
+    return app
+
+
+def serve(app, host: str = "0.0.0.0", port: int = 8000):
+    """Runs the API with uvicorn in a daemon thread next to the Gradio server."""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    server.install_signal_handlers = lambda: None  # only possible on the main thread
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    print(f"OpenAI-compatible API on http://{host}:{port}/v1")
+    return server
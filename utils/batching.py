@@ -0,0 +1,128 @@
+"""
+Token-budget batching for finetune.py and train_clm.py.
+
+Instead of a fixed `micro_batch_size`, every micro batch holds as many
+examples as fit `max_tokens` padded tokens, so short Q&A pairs come in
+large batches, long judgments in small ones, and the memory peak is the
+same for both. Examples are sorted by length (ties broken at random each
+epoch) and cut into batches greedily; the order of the batches is then
+shuffled, so consecutive steps see unrelated lengths instead of the
+longest-first sweep of `group_by_length` that bends the loss curve.
+
+Since batch composition only depends on the length ranking, the number of
+batches is the same every epoch. Gradient accumulation is set from the mean
+real tokens per batch, keeping the tokens per optimizer step close to what
+`batch_size` examples used to give.
+"""
+
+import random
+
+import numpy as np
+import torch
+import transformers
+
+
+def dataset_lengths(dataset):
+    if hasattr(dataset, "lengths"):
+        return np.asarray(dataset.lengths, dtype=np.int64)
+    return np.fromiter((len(ids) for ids in dataset["input_ids"]), dtype=np.int64)
+
+
+class TokenBudgetBatchSampler(torch.utils.data.Sampler):
+    def __init__(
+        self,
+        lengths,
+        max_tokens: int,
+        max_batch_size: int = 0,
+        pad_to_multiple_of: int = 8,
+        seed: int = 42,
+    ):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.seed = seed
+        self.epoch = 0
+        self.num_batches = len(self._batches(np.argsort(self.lengths, kind="stable")))
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _batches(self, order):
+        multiple = self.pad_to_multiple_of
+        padded = -(-self.lengths // multiple) * multiple
+        batches, batch, longest = [], [], 0
+        for index in order.tolist():
+            width = max(longest, int(padded[index]))
+            full = self.max_batch_size and len(batch) >= self.max_batch_size
+            if batch and (width * (len(batch) + 1) > self.max_tokens or full):
+                batches.append(batch)
+                batch, width = [], int(padded[index])
+            batch.append(index)
+            longest = width
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        # sorted by length, random among equal lengths
+        order = np.lexsort((rng.random(len(self.lengths)), self.lengths))
+        batches = self._batches(order)
+        random.Random(f"{self.seed}-{self.epoch}").shuffle(batches)
+        self.epoch += 1
+        yield from batches
+
+    def __len__(self):
+        return self.num_batches
+
+    def accumulation_steps(self, examples_per_step: int, world_size: int = 1) -> int:
+        """Accumulation that keeps `examples_per_step` average examples' tokens per update."""
+        step_tokens = examples_per_step * self.lengths.mean()
+        batch_tokens = self.lengths.sum() / max(self.num_batches, 1)
+        return max(1, round(step_tokens / (batch_tokens * world_size)))
+
+
+class TokenBudgetTrainer(transformers.Trainer):
+
+    """
+    Trainer that draws training batches from a `batch_sampler` when given
+    one. With `group_by_length` it groups a dataset that knows its `lengths`
+    (a TokenizedDataset) by those, instead of reading every example for them.
+    """
+
+    def __init__(self, *args, batch_sampler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_sampler = batch_sampler
+
+    def _get_train_sampler(self, *args, **kwargs):
+        dataset = args[0] if args else kwargs.get("train_dataset")
+        if dataset is None:
+            dataset = self.train_dataset
+        if self.args.group_by_length and hasattr(dataset, "lengths"):
+            from transformers.trainer_pt_utils import LengthGroupedSampler
+
+            return LengthGroupedSampler(
+                self.args.train_batch_size * self.args.gradient_accumulation_steps,
+                lengths=[int(n) for n in dataset.lengths],
+            )
+        return super()._get_train_sampler(*args, **kwargs)
+
+    def get_train_dataloader(self):
+        if self.batch_sampler is None:
+            return super().get_train_dataloader()
+        train_dataset = self.train_dataset
+        data_collator = self.data_collator
+        if hasattr(train_dataset, "column_names"):  # a datasets.Dataset
+            train_dataset = self._remove_unused_columns(train_dataset, description="training")
+        else:
+            data_collator = self._get_collator_with_removed_columns(data_collator, description="training")
+        dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_sampler=self.batch_sampler,
+            collate_fn=data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+        # in DDP, accelerate deals the batches out to the ranks in turn
+        return self.accelerator.prepare(dataloader)
@@ -0,0 +1,116 @@
+"""
+Exact-match response cache for repeated questions.
+
+Keys combine the prompt built by `Prompter.generate_prompt` (from a
+whitespace-normalized instruction), the model/LoRA identity and the
+generation parameters. Only deterministic decoding (greedy or beam search)
+is cached. Entries live in an in-memory LRU with a TTL, optionally backed by
+a SQLite file so they survive restarts.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Sampling knobs that do not change greedy/beam output, so they are left out
+# of the key for deterministic requests.
+_SAMPLING_PARAMS = ("temperature", "top_p", "top_k")
+
+
+def normalize_instruction(instruction: str) -> str:
+    return " ".join(instruction.split())
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600, db_path: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "disk_hits": 0, "misses": 0, "skipped": 0}
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, response TEXT, created REAL)"
+            )
+            if ttl:
+                self.db.execute(
+                    "DELETE FROM responses WHERE created < ?", (time.time() - ttl,)
+                )
+            self.db.commit()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 or self.db is not None
+
+    def make_key(self, prompt: str, model_id: str, **params):
+        """Cache key for a request, or None if its output is not deterministic."""
+        if not self.enabled:
+            return None
+        if params.get("do_sample"):
+            self.counters["skipped"] += 1
+            return None
+        params = {k: v for k, v in params.items() if k not in _SAMPLING_PARAMS}
+        payload = json.dumps([prompt, model_id, params], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _expired(self, created):
+        return bool(self.ttl) and time.time() - created > self.ttl
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                response, created = entry
+                if not self._expired(created):
+                    self.entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    return response
+                del self.entries[key]
+            if self.db is not None:
+                row = self.db.execute(
+                    "SELECT response, created FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and not self._expired(row[1]):
+                    self._remember(key, row[0], row[1])
+                    self.counters["disk_hits"] += 1
+                    return row[0]
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, key, response: str):
+        if key is None:
+            return
+        created = time.time()
+        with self.lock:
+            self._remember(key, response, created)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                    (key, response, created),
+                )
+                self.db.commit()
+
+    def _remember(self, key, response, created):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = (response, created)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.counters["hits"] + self.counters["disk_hits"] + self.counters["misses"]
+        hits = self.counters["hits"] + self.counters["disk_hits"]
+        return dict(
+            self.counters,
+            entries=len(self.entries),
+            hit_rate=hits / lookups if lookups else 0.0,
+        )
@@ -3,15 +3,104 @@ Helpers to support streaming generate output.
 Borrowed from https://github.com/oobabooga/text-generation-webui/blob/ad37f396fc8bcbab90e11ecf17c56c97bfbd4a9c/modules/callbacks.py
 """
 
+import asyncio
+import contextlib
 import gc
-import traceback
-from queue import Queue
-from threading import Thread
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Full, Queue
 
 import torch
 import transformers
 
 
+class StreamDetokenizer:
+
+    """
+    Turns a growing sequence of token ids into text deltas.
+
+    Only the tokens since the last emitted boundary are decoded, with a small
+    window of already-emitted tokens kept as context so SentencePiece's
+    leading-space handling stays consistent. A decode ending in U+FFFD means a
+    byte-fallback character (e.g. a CJK glyph split over several tokens) is
+    still incomplete, so nothing is emitted until the remaining bytes arrive.
+
+    With `stop` (e.g. the template's response marker), `follow` returns the
+    text before its first occurrence; only new text is searched for it.
+    """
+
+    def __init__(self, tokenizer, prompt_ids=(), context=5, skip_special_tokens=True, stop=""):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.stop = stop
+        prompt_ids = [int(t) for t in prompt_ids]
+        self.prompt_length = len(prompt_ids)
+        self.context = prompt_ids[-context:] if context else []
+        self._reset()
+
+    def _reset(self):
+        self.ids = list(self.context)
+        self.prefix_offset = 0
+        self.read_offset = len(self.ids)
+        # output ids and text seen by `follow`, and the answer cut at `stop`
+        self.output_ids = []
+        self.text = ""
+        self.answer = None
+
+    def _decode(self, ids):
+        return self.tokenizer.decode(
+            ids,
+            skip_special_tokens=self.skip_special_tokens,
+            clean_up_tokenization_spaces=False,
+        )
+
+    def put(self, token_ids) -> str:
+        """Feed newly generated token ids; returns the text they complete."""
+        self.ids.extend(int(t) for t in token_ids)
+        prefix_text = self._decode(self.ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.ids)
+        return new_text[len(prefix_text):]
+
+    def follow(self, sequence) -> str:
+        """
+        Feed the full prompt+output sequence of a `generate` step; returns
+        the output text so far. Only the new tokens are decoded while the
+        sequence extends the previous one. When beam search switches to
+        another hypothesis, the output is decoded again from the prompt.
+        """
+        output_ids = sequence[self.prompt_length:]
+        output_ids = output_ids.tolist() if hasattr(output_ids, "tolist") else list(output_ids)
+        if output_ids[:len(self.output_ids)] != self.output_ids:
+            self._reset()
+        delta = self.put(output_ids[len(self.output_ids):])
+        self.output_ids = output_ids
+        return self._append(delta)
+
+    def _append(self, delta):
+        if self.answer is not None:
+            return self.answer  # already cut at `stop`; the rest is discarded
+        start = len(self.text)
+        self.text += delta if self.text else delta.lstrip()
+        if self.stop:
+            # a marker may straddle the previous text and the delta
+            cut = self.text.find(self.stop, max(0, start - len(self.stop) + 1))
+            if cut >= 0:
+                self.answer = self.text[:cut].rstrip()
+                return self.answer
+        return self.text.rstrip()
+
+    def flush(self) -> str:
+        """Emit whatever is still buffered, even an incomplete character."""
+        prefix_text = self._decode(self.ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.ids)
+        return new_text[len(prefix_text):]
+
+
 class Stream(transformers.StoppingCriteria):
     def __init__(self, callback_func=None):
         self.callback_func = callback_func
@@ -22,54 +111,180 @@ class Stream(transformers.StoppingCriteria):
         return False
 
 
+class StopGeneration(Exception):
+    """Raised from the streaming callback once the consumer has gone away."""
+
+
+class GenerationExecutor:
+
+    """
+    Fixed pool of worker threads for callback-driven generation.
+
+    Streaming requests queue for one of `max_workers` threads instead of
+    each starting its own, and every request buffers at most `max_queue`
+    values before its producer blocks.
+    """
+
+    def __init__(self, max_workers: int = 2, max_queue: int = 64):
+        self.max_queue = max_queue
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="generate"
+        )
+
+    def iterate(self, func, kwargs={}, callback=None):
+        return Iteratorize(func, kwargs, callback=callback, executor=self)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+
+def default_executor():
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = GenerationExecutor()
+        return _default_executor
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
 class Iteratorize:
 
     """
     Transforms a function that takes a callback
     into a lazy iterator (generator).
+
+    The function runs on a GenerationExecutor worker and hands values over
+    through a bounded queue, so a stalled consumer applies backpressure
+    instead of growing memory. Leaving the `with` block stops the producer
+    at its next callback, and an exception raised by the function is
+    re-raised in the consumer. Usable with `for` and `async for`; an async
+    consumer waits on the event loop, woken by the producer, not in a thread.
     """
 
-    def __init__(self, func, kwargs={}, callback=None):
+    def __init__(self, func, kwargs={}, callback=None, executor=None):
+        executor = executor or default_executor()
         self.mfunc = func
         self.c_callback = callback
-        self.q = Queue()
+        self.q = Queue(maxsize=executor.max_queue)
         self.sentinel = object()
         self.kwargs = kwargs
         self.stop_now = False
+        self.error = None
+        self.waiter = None  # future an async consumer awaits while the queue is empty
+        self.future = executor.pool.submit(self._run)
 
-        def _callback(val):
-            if self.stop_now:
-                raise ValueError
-            self.q.put(val)
-
-        def gentask():
+    def _put(self, obj):
+        # Wait for room, but give up once the consumer has left.
+        while not self.stop_now:
             try:
-                ret = self.mfunc(callback=_callback, **self.kwargs)
-            except ValueError:
-                pass
-            except:
-                traceback.print_exc()
-                pass
+                self.q.put(obj, timeout=0.1)
+            except Full:
+                continue
+            waiter = self.waiter
+            if waiter is not None:
+                waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+            return True
+        return False
 
-            self.q.put(self.sentinel)
-            if self.c_callback:
-                self.c_callback(ret)
+    def _callback(self, val):
+        if not self._put(val):
+            raise StopGeneration
 
-        self.thread = Thread(target=gentask)
-        self.thread.start()
+    def _run(self):
+        if self.stop_now:
+            return  # abandoned while waiting for a worker
+        ret = None
+        try:
+            ret = self.mfunc(callback=self._callback, **self.kwargs)
+        except StopGeneration:
+            pass
+        except Exception as e:
+            self.error = e
+        self._put(self.sentinel)
+        if self.c_callback:
+            self.c_callback(ret)
+
+    def _unwrap(self, obj, stop):
+        if obj is self.sentinel:
+            if self.error is not None:
+                raise self.error
+            raise stop
+        return obj
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        obj = self.q.get(True, None)
-        if obj is self.sentinel:
-            raise StopIteration
-        else:
-            return obj
+        return self._unwrap(self.q.get(True, None), StopIteration)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            try:
+                return self._unwrap(self.q.get_nowait(), StopAsyncIteration)
+            except Empty:
+                pass
+            if self.waiter is None:
+                # set before looking at the queue again, so a value put in
+                # between is either seen there or wakes the waiter
+                self.waiter = asyncio.get_running_loop().create_future()
+                continue
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+
+    def close(self):
+        self.stop_now = True
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.stop_now = True
+        self.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def stream_beam_search(model, tokenizer, template, prompt_ids, generate_kwargs, lock=None, executor=None):
+    """
+    Runs `model.generate(**generate_kwargs)` on an executor worker and
+    yields the answer so far after every step, taken from the first running
+    beam and cut at the template's response marker. Those are partial beams;
+    the last value is generate's finished best sequence decoded with
+    `template.decode_response`, the answer a non-streamed call returns, and
+    the only one to cache. `lock` is held around generate, e.g.
+    `engine.exclusive(adapter)`.
+    """
+    finished = {}
+
+    # This is based on the trick of using 'stopping_criteria' to create an iterator,
+    # from https://github.com/oobabooga/text-generation-webui/blob/ad37f396fc8bcbab90e11ecf17c56c97bfbd4a9c/modules/text_generation.py#L216-L243.
+    def generate_with_callback(callback=None, **kwargs):
+        kwargs.setdefault("stopping_criteria", transformers.StoppingCriteriaList())
+        kwargs["stopping_criteria"].append(Stream(callback_func=callback))
+        with torch.no_grad(), lock if lock is not None else contextlib.nullcontext():
+            finished["output"] = model.generate(**kwargs)
+
+    # Only new tokens are decoded while the first beam keeps extending;
+    # if beam search switches hypotheses the answer is decoded afresh.
+    detokenizer = StreamDetokenizer(tokenizer, prompt_ids, stop=template.marker)
+    with Iteratorize(generate_with_callback, generate_kwargs, executor=executor) as generator:
+        for output in generator:
+            yield detokenizer.follow(output)
+    sequences = getattr(finished["output"], "sequences", finished["output"])
+    yield template.decode_response(sequences[0], len(prompt_ids))
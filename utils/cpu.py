@@ -0,0 +1,151 @@
+"""
+CPU execution profile for inference: compute dtype and thread counts.
+
+fp16 matmuls have no fast path on most CPUs, so CPU models run in bf16 where
+the hardware has bf16 instructions (AVX512-BF16/AMX on x86, the BF16
+extension on Arm) and in fp32 otherwise. Intra-op threads default to the
+physical cores this process may use (affinity and cgroup quota included,
+which `os.cpu_count()` ignores in containers) unless OMP_NUM_THREADS is set;
+inter-op threads to one, since decoding runs one op after another and extra
+pools only compete for the same cores.
+
+`autotune_dtype` times a short greedy decode under each candidate dtype and
+caches the fastest per host, torch version, thread count and model, so only
+the first start of a replica pays for it; the winning model is handed back
+so that start does not load the weights again.
+"""
+
+import json
+import os
+import time
+
+import torch
+
+CANDIDATE_DTYPES = ("bfloat16", "float32")
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "lawgpt", "cpu_profile.json")
+
+
+def _cpuinfo():
+    try:
+        with open("/proc/cpuinfo") as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+def cpu_name() -> str:
+    for line in _cpuinfo().splitlines():
+        if line.startswith(("model name", "CPU part")):
+            return line.split(":", 1)[1].strip()
+    import platform
+
+    return platform.processor() or platform.machine()
+
+
+def bf16_supported() -> bool:
+    """Whether the CPU has native bf16 arithmetic."""
+    flags = set()
+    for line in _cpuinfo().splitlines():
+        if line.startswith(("flags", "Features")):
+            flags.update(line.split(":", 1)[1].split())
+    if flags:
+        return bool(flags & {"avx512_bf16", "amx_bf16", "bf16"})
+    try:  # no /proc/cpuinfo: ask oneDNN
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def default_dtype() -> torch.dtype:
+    return torch.bfloat16 if bf16_supported() else torch.float32
+
+
+def usable_cpus() -> int:
+    """Logical CPUs this process may run on, within its cgroup CPU quota."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        cpus = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def physical_cores() -> int:
+    """Usable CPUs divided by the hyperthreads per core."""
+    siblings = cores = 0
+    for line in _cpuinfo().splitlines():
+        if line.startswith("siblings") and not siblings:
+            siblings = int(line.split(":")[1])
+        elif line.startswith("cpu cores") and not cores:
+            cores = int(line.split(":")[1])
+    threads_per_core = siblings // cores if siblings and cores else 1
+    return max(1, usable_cpus() // max(threads_per_core, 1))
+
+
+def configure_threads(num_threads: int = 0, interop_threads: int = 1):
+    """
+    Sets torch's intra-op (0 = OMP_NUM_THREADS, else physical cores) and
+    inter-op thread counts. Returns the intra-op count in use.
+    """
+    if not num_threads:
+        num_threads = int(os.environ.get("OMP_NUM_THREADS", 0)) or physical_cores()
+    torch.set_num_threads(num_threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            pass  # only possible before the first parallel op; keep the default
+    return num_threads
+
+
+def _time_decode(model, prompt_tokens=64, new_tokens=16):
+    input_ids = torch.ones(1, prompt_tokens, dtype=torch.long)
+    kwargs = dict(do_sample=False, eos_token_id=None, pad_token_id=0)
+    with torch.no_grad():
+        model.generate(input_ids, max_new_tokens=2, **kwargs)  # warm up
+        start = time.perf_counter()
+        model.generate(input_ids, max_new_tokens=new_tokens, **kwargs)
+    return time.perf_counter() - start
+
+
+def autotune_dtype(load_fn, key: str, cache_path: str = DEFAULT_CACHE, candidates=CANDIDATE_DTYPES):
+    """
+    The fastest of `candidates` for `key` as `(dtype, model)`. On a cache
+    miss each one is loaded with `load_fn(dtype)` and timed on a short
+    decode, keeping only the fastest model so far (so at most two are held
+    at once), and the result is stored in `cache_path`. On a hit nothing is
+    loaded and model is None.
+    """
+    key = f"{cpu_name()}|torch {torch.__version__}|{torch.get_num_threads()} threads|{key}"
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+    if key in cache:
+        return getattr(torch, cache[key]["dtype"]), None
+
+    timings = {}
+    best, best_model = None, None
+    for name in candidates:
+        dtype = getattr(torch, name)
+        if dtype == torch.bfloat16 and not bf16_supported():
+            continue  # emulated bf16 is always slower than fp32
+        model = load_fn(dtype)
+        timings[name] = _time_decode(model)
+        if best is None or timings[name] < timings[best]:
+            best, best_model = name, model
+        del model
+    print("CPU dtype autotune: " + ", ".join(f"{n} {s:.2f}s" for n, s in timings.items()) + f" -> {best}")
+
+    cache[key] = {"dtype": best, "seconds": timings}
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    with open(cache_path + ".tmp", "w") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(cache_path + ".tmp", cache_path)
+    return getattr(torch, best), best_model
@@ -0,0 +1,206 @@
+"""
+Pre-tokenized, memory-mapped training data for finetune.py and train_clm.py.
+
+A split is tokenized once with a `datasets.map` worker pool and stored as a
+directory of flat numpy arrays: every example's token ids back to back
+(uint16 when the vocabulary fits, uint32 otherwise), the example offsets
+into that array, and per example the number of leading tokens whose labels
+are masked out (-100). The directory name hashes the split's dataset
+fingerprint, the tokenizer vocabulary and special tokens, and the
+tokenization settings (template, cutoff_len, ...), so a relaunch with the
+same settings loads it instead of tokenizing again.
+
+Arrays are opened with `np.load(mmap_mode="r")`: loading is instant,
+examples are sliced out on access, and DDP ranks on one host share the
+same page cache. Only local rank 0 tokenizes; the other ranks wait for the
+finished directory, which appears atomically.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import torch
+
+_META = "meta.json"
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    payload = json.dumps(
+        [
+            type(tokenizer).__name__,
+            sorted(tokenizer.get_vocab().items()),
+            tokenizer.bos_token_id,
+            tokenizer.eos_token_id,
+            getattr(tokenizer, "add_bos_token", None),
+            getattr(tokenizer, "add_eos_token", None),
+        ]
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def cache_path(cache_dir: str, dataset, tokenizer, **settings) -> str:
+    payload = json.dumps(
+        {
+            "dataset": dataset._fingerprint,
+            "tokenizer": tokenizer_fingerprint(tokenizer),
+            **settings,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return os.path.join(cache_dir, hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16])
+
+
+class TokenizedDataset(torch.utils.data.Dataset):
+
+    """
+    Examples from a cache directory, in the dict-of-lists form the trainers'
+    `DataCollatorForSeq2Seq` expects. `lengths` holds every example's token
+    count without touching the token array.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tokens = np.load(os.path.join(path, "tokens.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.label_starts = np.load(os.path.join(path, "label_starts.npy"), mmap_mode="r")
+        self.lengths = np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = int(self.offsets[index]), int(self.offsets[index + 1])
+        input_ids = self.tokens[start:end].tolist()
+        masked = int(self.label_starts[index])
+        return {
+            "input_ids": input_ids,
+            "attention_mask": [1] * len(input_ids),
+            "labels": [-100] * masked + input_ids[masked:],
+        }
+
+
+def _label_start(labels):
+    masked = 0
+    while masked < len(labels) and labels[masked] == -100:
+        masked += 1
+    return masked
+
+
+def write_tokenized(path: str, tokenized, vocab_size: int, batch_size: int = 1024):
+    """
+    Writes a mapped split with `input_ids` and `label_start` columns to
+    `path`. Files go to a private temporary directory that is renamed into
+    place, so readers never see a partial cache; if another process got
+    there first, its copy is kept.
+    """
+    dtype = np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.uint32
+    lengths = np.asarray(tokenized["length"], dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    tmp = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    tokens = np.lib.format.open_memmap(
+        os.path.join(tmp, "tokens.npy"), mode="w+", dtype=dtype, shape=(int(offsets[-1]),)
+    )
+    for start in range(0, len(lengths), batch_size):
+        end = min(start + batch_size, len(lengths))
+        batch = tokenized[start:end]["input_ids"]
+        tokens[offsets[start]:offsets[end]] = np.fromiter(
+            itertools.chain.from_iterable(batch), dtype=dtype, count=int(offsets[end] - offsets[start])
+        )
+    tokens.flush()
+    del tokens
+    np.save(os.path.join(tmp, "offsets.npy"), offsets)
+    np.save(
+        os.path.join(tmp, "label_starts.npy"),
+        np.asarray(tokenized["label_start"], dtype=np.int32),
+    )
+    with open(os.path.join(tmp, _META), "w") as f:
+        json.dump(
+            {
+                "examples": len(lengths),
+                "tokens": int(offsets[-1]),
+                "dtype": np.dtype(dtype).name,
+                "created": time.time(),
+            },
+            f,
+        )
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def tokenized_dataset(
+    dataset,
+    tokenize_fn,
+    tokenizer,
+    cache_dir: str,
+    num_proc: int = 1,
+    batched: bool = False,
+    **settings,
+):
+    """
+    Cached `dataset.map(tokenize_fn)` as a TokenizedDataset. `tokenize_fn`
+    returns `input_ids` and `labels` for one example (for a batch of them if
+    `batched`), with labels equal to the input ids apart from a masked
+    (-100) prefix; a `label_start` column saves scanning the labels for it.
+    `settings` are everything else that changes its output (template,
+    cutoff_len, ...) and become part of the cache key.
+    """
+    path = cache_path(cache_dir, dataset, tokenizer, batched=batched, **settings)
+    if not os.path.exists(os.path.join(path, _META)):
+        if int(os.environ.get("LOCAL_RANK", 0)) == 0:
+            os.makedirs(cache_dir, exist_ok=True)
+            start = time.perf_counter()
+
+            def encode(example):
+                result = tokenize_fn(example)
+                return {
+                    "input_ids": result["input_ids"],
+                    "label_start": min(_label_start(result["labels"]), len(result["input_ids"])),
+                    "length": len(result["input_ids"]),
+                }
+
+            def encode_batch(batch):
+                result = tokenize_fn(batch)
+                if "label_start" in result:
+                    label_starts = result["label_start"]
+                else:
+                    label_starts = [
+                        min(_label_start(labels), len(ids))
+                        for ids, labels in zip(result["input_ids"], result["labels"])
+                    ]
+                return {
+                    "input_ids": result["input_ids"],
+                    "label_start": label_starts,
+                    "length": [len(ids) for ids in result["input_ids"]],
+                }
+
+            tokenized = dataset.map(
+                encode_batch if batched else encode,
+                batched=batched,
+                num_proc=max(1, min(num_proc, len(dataset))),
+                remove_columns=dataset.column_names,
+                desc="Tokenizing",
+            )
+            write_tokenized(path, tokenized, len(tokenizer))
+            print(
+                f"Tokenized {len(dataset)} examples into {path} "
+                f"in {time.perf_counter() - start:.1f}s"
+            )
+        else:
+            print(f"Waiting for local rank 0 to tokenize into {path}")
+            while not os.path.exists(os.path.join(path, _META)):
+                time.sleep(1)
+    data = TokenizedDataset(path)
+    if int(os.environ.get("LOCAL_RANK", 0)) == 0:
+        print(f"Loaded {len(data)} tokenized examples ({int(data.offsets[-1])} tokens) from {path}")
+    return data
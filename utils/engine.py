@@ -0,0 +1,648 @@
+"""
+Continuous-batching generation engine shared by the web UIs and infer.py.
+
+Requests are prefilled as they arrive and admitted into the running decode
+batch between steps; finished sequences are retired individually, so
+concurrent users share every forward pass instead of queueing behind a
+whole `model.generate` call.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from queue import Empty, Queue
+
+import torch
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # older transformers only know tuple caches
+    DynamicCache = None
+
+
+def _to_legacy(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return tuple(tuple(layer) for layer in past_key_values)
+
+
+def _from_legacy(past_key_values):
+    if DynamicCache is not None and hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(past_key_values)
+    return past_key_values
+
+
+def _pad_left(tensor, length, dim, value=0):
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_full(shape, value), tensor], dim=dim)
+
+
+def _slice_past(past_key_values, length):
+    return tuple(tuple(t[:, :, :length] for t in layer) for layer in past_key_values)
+
+
+class PrefixCache:
+
+    """
+    KV caches of constant prompt prefixes (e.g. a template's preamble).
+
+    Entries are matched on token ids, so a changed template simply stops
+    matching. Each entry carries a tag identifying the weights it was
+    computed with (the LoRA adapter); call `clear(tag)` when those change.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, token_ids, past_key_values, prefill_seconds, tag=None):
+        self.entries.append((list(token_ids), past_key_values, prefill_seconds, tag))
+
+    def clear(self, tag=None):
+        self.entries = [e for e in self.entries if e[3] != tag]
+
+    def match(self, token_ids, tag=None):
+        """Longest cached prefix of `token_ids`: (length, past, seconds saved)."""
+        best = (0, None, 0.0)
+        for ids, past, seconds, entry_tag in self.entries:
+            if entry_tag != tag:
+                continue
+            n = 0
+            for a, b in zip(ids, token_ids):
+                if a != b:
+                    break
+                n += 1
+            # at least one prompt token must still be prefilled for its logits
+            n = min(n, len(token_ids) - 1)
+            if n > best[0]:
+                best = (n, _slice_past(past, n), seconds * n / len(ids))
+        return best
+
+
+def sample_next_token(logits, temperature=1.0, top_k=0, top_p=1.0):
+    """Sample one token id from a 1-D logits row with temperature/top-k/top-p."""
+    logits = logits / max(temperature, 1e-5)
+    if top_k and top_k < logits.shape[-1]:
+        threshold = torch.topk(logits, top_k).values[-1]
+        logits = logits.masked_fill(logits < threshold, float("-inf"))
+    if top_p < 1.0:
+        sorted_logits, sorted_idx = torch.sort(logits, descending=True)
+        cumulative = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+        # keep the first token that crosses top_p, drop everything after it
+        remove = cumulative - torch.softmax(sorted_logits, dim=-1) > top_p
+        logits = logits.scatter(
+            0, sorted_idx, sorted_logits.masked_fill(remove, float("-inf"))
+        )
+    probs = torch.softmax(logits, dim=-1)
+    return int(torch.multinomial(probs, 1))
+
+
+class GenerationRequest:
+
+    """
+    Handle for one submitted prompt. Iterating it yields new token ids as
+    they are decoded; `result()` blocks until the request is finished.
+    `cancel()` makes the engine drop it before its next decode step, after
+    which it finishes with reason "cancelled".
+    """
+
+    def __init__(
+        self,
+        input_ids,
+        max_new_tokens=256,
+        do_sample=False,
+        temperature=1.0,
+        top_p=1.0,
+        top_k=0,
+        eos_token_id=None,
+        adapter=None,
+    ):
+        self.input_ids = [int(t) for t in input_ids]
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.eos_token_id = eos_token_id
+        self.adapter = adapter
+        self.adapter_pinned = False
+        self.output_ids = []
+        self.finish_reason = None
+        self.error = None
+        self.prefix_tokens = 0
+        self.prefill_seconds = None
+        self.prefill_seconds_saved = 0.0
+        self.decode_steps = 0
+        self.draft_tokens = 0
+        self.accepted_draft_tokens = 0
+        self.submitted_at = time.time()
+        self.first_token_at = None
+        self.finished_at = None
+        self.q = Queue()
+        self.sentinel = object()
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+
+    def __iter__(self):
+        while True:
+            obj = self.q.get(True, None)
+            if obj is self.sentinel:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield obj
+
+    def result(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise TimeoutError("generation request did not finish in time")
+        if self.error is not None:
+            raise self.error
+        return self.output_ids
+
+    def cancel(self):
+        if not self.done.is_set():
+            self.cancelled.set()
+
+    def timing_summary(self):
+        if self.prefill_seconds is None:
+            # cancelled or failed before its prompt was prefilled
+            return f"not started ({self.finish_reason or 'pending'})"
+        summary = f"prefill {self.prefill_seconds * 1000:.1f} ms"
+        if self.prefix_tokens:
+            summary += (
+                f" (reused {self.prefix_tokens} cached prefix tokens,"
+                f" saved ~{self.prefill_seconds_saved * 1000:.1f} ms)"
+            )
+        if self.draft_tokens:
+            summary += (
+                f", speculative: accepted {self.accepted_draft_tokens}"
+                f"/{self.draft_tokens} draft tokens,"
+                f" {len(self.output_ids) / (self.decode_steps + 1):.2f} tokens per forward"
+            )
+        return summary
+
+    def _emit(self, token_id):
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+        self.output_ids.append(token_id)
+        self.q.put(token_id)
+
+    def _finish(self, reason, error=None):
+        self.finish_reason = reason
+        self.error = error
+        self.finished_at = time.time()
+        self.q.put(self.sentinel)
+        self.done.set()
+
+
+class GenerationEngine:
+
+    """
+    Iteration-level scheduler around a causal LM.
+
+    A single background thread owns the model. Every loop it prefills newly
+    submitted prompts, merges their KV caches into the in-flight batch
+    (left-padded to a common length), runs one batched decode step, and
+    retires rows that hit EOS or their token budget. Only greedy and
+    sampling decoding are batched; beam search callers should keep using
+    `model.generate` inside `engine.exclusive()`.
+
+    With a drafter (see utils/speculative.py), a greedy request that has the
+    batch to itself is decoded speculatively: drafted tokens are verified in
+    one forward pass. Larger batches already amortise each forward, so they
+    decode normally.
+
+    With an AdapterManager, each request names its LoRA adapter. Rows for
+    different adapters share a batch when PEFT supports mixed-adapter
+    forwards; otherwise requests are only admitted next to rows using the
+    same adapter and wait for the batch to drain.
+    """
+
+    def __init__(
+        self,
+        model,
+        device="cpu",
+        eos_token_id=2,
+        max_batch_size=8,
+        adapters=None,
+        drafter=None,
+        num_draft_tokens=32,  # upper bound, drafters cap their own lengths
+    ):
+        self.model = model
+        self.device = device
+        self.eos_token_id = eos_token_id
+        self.max_batch_size = max_batch_size
+        self.adapters = adapters
+        self.drafter = drafter
+        self.num_draft_tokens = num_draft_tokens
+        # Held for every forward pass; anything else touching the model
+        # (beam search fallbacks) takes it too.
+        self.lock = threading.RLock()
+        self.pending = Queue()
+        self.deferred = []
+        self.active = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.next_tokens = []
+        self.prefixes = PrefixCache()
+        self.prefix_token_ids = []
+        # written only by the engine thread, so plain increments need no lock
+        self.counters = {
+            "requests": 0,
+            "finished": 0,
+            "cancelled": 0,
+            "generated_tokens": 0,
+            "decode_steps": 0,
+            "batched_rows": 0,
+            "prefix_hits": 0,
+            "prefix_tokens_reused": 0,
+            "prefill_seconds_saved": 0.0,
+            "speculative_steps": 0,
+            "draft_tokens": 0,
+            "accepted_draft_tokens": 0,
+        }
+        self.started_at = time.time()
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, input_ids, **params) -> GenerationRequest:
+        params.setdefault("eos_token_id", self.eos_token_id)
+        if self.adapters is not None:
+            params["adapter"] = self.adapters.resolve(params.get("adapter"))
+        else:
+            # callers pass "default" regardless; prefixes are tagged None then
+            params["adapter"] = None
+        request = GenerationRequest(input_ids, **params)
+        self.pending.put(request)
+        return request
+
+    @torch.no_grad()
+    def add_prefix(self, token_ids, tag=None):
+        """Prefill a constant prompt prefix once so requests can start from it."""
+        with self.lock:
+            start = time.perf_counter()
+            out = self.model(
+                input_ids=torch.tensor([list(token_ids)], device=self.device),
+                use_cache=True,
+                **self._adapter_kwargs([tag]),
+            )
+            seconds = time.perf_counter() - start
+            self.prefixes.add(token_ids, _to_legacy(out.past_key_values), seconds, tag)
+        return seconds
+
+    def add_template_prefixes(self, tokenizer, prompter):
+        # prefixes are per adapter: LoRA on k/v projections changes the cache
+        tags = list(self.adapters.loaded) if self.adapters is not None else [None]
+        for prefix in prompter.template_prefixes():
+            token_ids = tokenizer(prefix)["input_ids"]
+            self.prefix_token_ids.append(token_ids)
+            for tag in tags:
+                seconds = self.add_prefix(token_ids, tag)
+            print(
+                f"Cached template prefix: {len(token_ids)} tokens, "
+                f"{seconds * 1000:.1f} ms prefill per request saved"
+            )
+
+    @contextmanager
+    def exclusive(self, adapter=None):
+        """Hold the model (with `adapter` active) for a direct model.generate call."""
+        with self.lock:
+            if self.adapters is None:
+                yield
+                return
+            name, loaded, evicted = self.adapters.acquire(self.adapters.resolve(adapter))
+            for tag in evicted:
+                self.prefixes.clear(tag)
+            try:
+                if loaded:
+                    for token_ids in self.prefix_token_ids:
+                        self.add_prefix(token_ids, name)
+                self.adapters.activate(name)
+                yield
+            finally:
+                self.adapters.release(name)
+
+    def generate(self, input_ids, **params):
+        """Blocking convenience wrapper: returns the generated token ids."""
+        return self.submit(input_ids, **params).result()
+
+    def stats(self):
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        steps = max(self.counters["decode_steps"], 1)
+        drafted = max(self.counters["draft_tokens"], 1)
+        speculative_steps = max(self.counters["speculative_steps"], 1)
+        return dict(
+            self.counters,
+            active=len(self.active),
+            pending=self.pending.qsize() + len(self.deferred),
+            tokens_per_sec=self.counters["generated_tokens"] / elapsed,
+            mean_batch_size=self.counters["batched_rows"] / steps,
+            acceptance_rate=self.counters["accepted_draft_tokens"] / drafted,
+            # main-model forwards saved: 1.0 means drafting never helped
+            tokens_per_speculative_step=(
+                self.counters["accepted_draft_tokens"] / speculative_steps + 1
+            ),
+        )
+
+    def shutdown(self):
+        self._stop.set()
+        self.thread.join()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self._admit(block=not self.active)
+                if self.active:
+                    with self.lock:
+                        self._step()
+            except Exception as e:
+                self._fail_all(e)
+
+    def _admissible(self, request):
+        if self.adapters is None or self.adapters.mixed_batches or not self.active:
+            return True
+        return request.adapter == self.active[0].adapter
+
+    def _next_request(self, block):
+        for i, request in enumerate(self.deferred):
+            if self._admissible(request):
+                return self.deferred.pop(i)
+        while True:
+            request = self.pending.get(block, 0.1 if block else None)
+            self.counters["requests"] += 1
+            if self._admissible(request):
+                return request
+            self.deferred.append(request)
+
+    def _admit(self, block):
+        while len(self.active) < self.max_batch_size:
+            try:
+                request = self._next_request(block)
+            except Empty:
+                return
+            block = False
+            if request.cancelled.is_set():
+                self._finish(request, "cancelled")
+                continue
+            try:
+                with self.lock:
+                    self._prefill(request)
+            except Exception as e:
+                self._finish(request, "error", e)
+
+    def _pin_adapter(self, request):
+        name, loaded, evicted = self.adapters.acquire(request.adapter)
+        request.adapter_pinned = True
+        for tag in evicted:
+            self.prefixes.clear(tag)
+        if loaded:
+            for token_ids in self.prefix_token_ids:
+                self.add_prefix(token_ids, name)
+
+    def _adapter_kwargs(self, names):
+        if self.adapters is None:
+            return {}
+        if not self.adapters.mixed_batches:
+            # admission keeps every row of the batch on the same adapter
+            self.adapters.activate(names[0])
+        return self.adapters.forward_kwargs(names)
+
+    @torch.no_grad()
+    def _prefill(self, request):
+        if self.adapters is not None:
+            self._pin_adapter(request)
+        start = time.perf_counter()
+        input_ids = torch.tensor([request.input_ids], device=self.device)
+        adapter_kwargs = self._adapter_kwargs([request.adapter])
+        n, prefix, saved = self.prefixes.match(request.input_ids, request.adapter)
+        if n:
+            out = self.model(
+                input_ids=input_ids[:, n:],
+                attention_mask=torch.ones_like(input_ids),
+                position_ids=torch.arange(
+                    n, input_ids.shape[1], device=self.device
+                )[None],
+                past_key_values=_from_legacy(prefix),
+                use_cache=True,
+                **adapter_kwargs,
+            )
+            request.prefix_tokens = n
+            request.prefill_seconds_saved = saved
+            self.counters["prefix_hits"] += 1
+            self.counters["prefix_tokens_reused"] += n
+            self.counters["prefill_seconds_saved"] += saved
+        else:
+            out = self.model(input_ids=input_ids, use_cache=True, **adapter_kwargs)
+        request.prefill_seconds = time.perf_counter() - start
+        token = self._select(out.logits[:, -1, :], [request])[0]
+        if self._accept(request, token):
+            return
+        past = _to_legacy(out.past_key_values)
+        mask = torch.ones(1, input_ids.shape[1], dtype=torch.long, device=self.device)
+        self._merge(request, token, past, mask)
+
+    def _merge(self, request, token, past, mask):
+        if self.past_key_values is None:
+            self.past_key_values, self.attention_mask = past, mask
+        else:
+            length = max(self.attention_mask.shape[1], mask.shape[1])
+            self.past_key_values = tuple(
+                tuple(
+                    torch.cat(
+                        [_pad_left(old, length, 2), _pad_left(new, length, 2)]
+                    )
+                    for old, new in zip(old_layer, new_layer)
+                )
+                for old_layer, new_layer in zip(self.past_key_values, past)
+            )
+            self.attention_mask = torch.cat(
+                [
+                    _pad_left(self.attention_mask, length, 1),
+                    _pad_left(mask, length, 1),
+                ]
+            )
+        self.active.append(request)
+        self.next_tokens.append(token)
+
+    def _drop_cancelled(self):
+        for request in [r for r in self.deferred if r.cancelled.is_set()]:
+            self.deferred.remove(request)
+            self._finish(request, "cancelled")
+        keep = [i for i, r in enumerate(self.active) if not r.cancelled.is_set()]
+        if len(keep) < len(self.active):
+            for request in self.active:
+                if request.cancelled.is_set():
+                    self._finish(request, "cancelled")
+            self._retire(keep)
+
+    @torch.no_grad()
+    def _step(self):
+        # abandoned rows leave before the forward pass, not after max_new_tokens
+        self._drop_cancelled()
+        if not self.active:
+            return
+        if (
+            self.drafter is not None
+            and len(self.active) == 1
+            and not self.active[0].do_sample
+            and self._speculative_step()
+        ):
+            return
+        input_ids = torch.tensor(self.next_tokens, device=self.device)[:, None]
+        attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones(len(self.active), 1)],
+            dim=1,
+        )
+        position_ids = attention_mask.cumsum(-1)[:, -1:] - 1
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=_from_legacy(self.past_key_values),
+            use_cache=True,
+            **self._adapter_kwargs([r.adapter for r in self.active]),
+        )
+        self.past_key_values = _to_legacy(out.past_key_values)
+        self.attention_mask = attention_mask
+        self.counters["decode_steps"] += 1
+        self.counters["batched_rows"] += len(self.active)
+        for request in self.active:
+            request.decode_steps += 1
+
+        tokens = self._select(out.logits[:, -1, :], self.active)
+        keep = []
+        for i, (request, token) in enumerate(zip(self.active, tokens)):
+            if not self._accept(request, token):
+                keep.append(i)
+                self.next_tokens[i] = token
+        if len(keep) < len(self.active):
+            self._retire(keep)
+
+    @torch.no_grad()
+    def _speculative_step(self):
+        """
+        Verify a draft for the lone active row. Feeds the pending token plus
+        the draft in one forward, keeps the prefix the model agrees with and
+        emits the model's own token after it. Returns False if there was
+        nothing to draft.
+        """
+        request = self.active[0]
+        budget = request.max_new_tokens - len(request.output_ids) - 1
+        if budget <= 0:
+            return False
+        # output_ids already ends with the pending (not yet cached) token
+        draft = self.drafter.propose(
+            request.input_ids + request.output_ids,
+            min(self.num_draft_tokens, budget),
+        )
+        if not draft:
+            return False
+        past_length = self.attention_mask.shape[1]
+        position = int(self.attention_mask.sum())
+        input_ids = torch.tensor([[self.next_tokens[0]] + draft], device=self.device)
+        attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones(1, input_ids.shape[1])],
+            dim=1,
+        )
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=torch.arange(
+                position, position + input_ids.shape[1], device=self.device
+            )[None],
+            past_key_values=_from_legacy(self.past_key_values),
+            use_cache=True,
+            **self._adapter_kwargs([request.adapter]),
+        )
+        predicted = out.logits[0].float().argmax(dim=-1).tolist()
+        accepted = 0
+        while accepted < len(draft) and draft[accepted] == predicted[accepted]:
+            accepted += 1
+        # cache the pending token and the accepted draft, drop the rest
+        kept = past_length + 1 + accepted
+        self.past_key_values = _slice_past(_to_legacy(out.past_key_values), kept)
+        self.attention_mask = attention_mask[:, :kept]
+
+        self.counters["decode_steps"] += 1
+        self.counters["batched_rows"] += 1
+        self.counters["speculative_steps"] += 1
+        self.counters["draft_tokens"] += len(draft)
+        self.counters["accepted_draft_tokens"] += accepted
+        request.decode_steps += 1
+        request.draft_tokens += len(draft)
+        request.accepted_draft_tokens += accepted
+
+        for token in draft[:accepted] + [predicted[accepted]]:
+            if self._accept(request, token):
+                self._retire([])
+                return True
+            self.next_tokens[0] = token
+        return True
+
+    def _select(self, logits, requests):
+        logits = logits.float()
+        tokens = logits.argmax(dim=-1).tolist()
+        for i, request in enumerate(requests):
+            if request.do_sample:
+                tokens[i] = sample_next_token(
+                    logits[i], request.temperature, request.top_k, request.top_p
+                )
+        return tokens
+
+    def _accept(self, request, token):
+        """Record a decoded token; returns True once the request is finished."""
+        if token == request.eos_token_id:
+            reason = "eos"
+        else:
+            request._emit(token)
+            self.counters["generated_tokens"] += 1
+            if len(request.output_ids) < request.max_new_tokens:
+                return False
+            reason = "length"
+        self._finish(request, reason)
+        return True
+
+    def _finish(self, request, reason, error=None):
+        if request.adapter_pinned:
+            self.adapters.release(request.adapter)
+            request.adapter_pinned = False
+        request._finish(reason, error)
+        self.counters["finished"] += 1
+        if reason == "cancelled":
+            self.counters["cancelled"] += 1
+
+    def _retire(self, keep):
+        self.active = [self.active[i] for i in keep]
+        self.next_tokens = [self.next_tokens[i] for i in keep]
+        if not keep:
+            self.past_key_values = self.attention_mask = None
+            return
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        mask = self.attention_mask.index_select(0, index)
+        # drop leading columns that are padding for every surviving row
+        start = int((mask.sum(0) > 0).nonzero()[0])
+        self.attention_mask = mask[:, start:]
+        self.past_key_values = tuple(
+            tuple(t.index_select(0, index.to(t.device))[:, :, start:] for t in layer)
+            for layer in self.past_key_values
+        )
+
+    def _fail_all(self, error):
+        for request in self.active:
+            self._finish(request, "error", error)
+        self.active, self.next_tokens = [], []
+        self.past_key_values = self.attention_mask = None
+
+
+def gradio_queue_kwargs(queue_fn, concurrency):
+    """Concurrency argument for `demo.queue` across gradio 3.x and 4.x."""
+    import inspect
+
+    params = inspect.signature(queue_fn).parameters
+    if "default_concurrency_limit" in params:
+        return {"default_concurrency_limit": concurrency}
+    return {"concurrency_count": concurrency}
@@ -1,141 +1,334 @@
-import math
+import json
 import os
+import re
+import subprocess
 import sys
+from collections import Counter
 
 import fire
 from tqdm import tqdm
 import pandas as pd
 import torch
-import transformers
-from peft import PeftModel
-import datasets
-from transformers import GenerationConfig, LlamaForCausalLM, LlamaTokenizer
+from transformers import GenerationConfig
 
-from utils.callbacks import Iteratorize, Stream
+from utils.cpu import physical_cores
+from utils.loader import get_device, load_model
 from utils.prompter import Prompter
 
-device = "cuda"
+device = get_device()
+
+# ASCII words count as one token, everything else (CJK) per character.
+_OVERLAP_TOKEN = re.compile(r"[A-Za-z0-9]+|\S")
+
+
+def _is_out_of_memory(error):
+    return isinstance(error, RuntimeError) and "out of memory" in str(error)
+
+
+def generate_sorted(
+    model,
+    tokenizer,
+    prompts,
+    generation_config,
+    max_new_tokens=32,
+    max_batch_size=32,
+    max_batch_tokens=16384,
+    memory_fraction=0.8,
+    on_batch=None,
+    template=None,
+):
+    """
+    Generates answers for all prompts, returns them in the original order.
+
+    Prompts (strings, or token ids from `CompiledTemplate.encode_batch`)
+    are tokenized once and batched longest first, so each batch pads
+    to similar lengths and an OOM shows up on the first batch. A batch takes
+    as many rows as fit `max_batch_tokens` (padded prompt + new tokens). On
+    CUDA the budget grows while peak memory stays under `memory_fraction`
+    and halves on OOM. `on_batch(indices, answers)` is called per batch.
+    With a `template` (CompiledTemplate), answers are cut at a repeated
+    response marker like `Prompter.get_response` does.
+    """
+    prompts = list(prompts)
+    if prompts and isinstance(prompts[0], str):
+        encoded = tokenizer(prompts)["input_ids"]
+    else:
+        encoded = [list(ids) for ids in prompts]
+    order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]), reverse=True)
+    answers = [None] * len(encoded)
+    budget = max_batch_tokens
+    pbar = tqdm(total=len(order), unit="sample")
+    start = 0
+    while start < len(order):
+        longest = len(encoded[order[start]]) + max_new_tokens
+        rows = max(1, min(max_batch_size, budget // longest, len(order) - start))
+        batch = order[start:start + rows]
+        # Allow batched inference, without left-padding for the tokenizer's other users
+        padding_side, tokenizer.padding_side = tokenizer.padding_side, "left"
+        try:
+            inputs = tokenizer.pad(
+                {"input_ids": [encoded[i] for i in batch]}, return_tensors="pt"
+            ).to(device)
+        finally:
+            tokenizer.padding_side = padding_side
+        try:
+            with torch.no_grad():
+                sequences = model.generate(
+                    **inputs,
+                    generation_config=generation_config,
+                    max_new_tokens=max_new_tokens,
+                    pad_token_id=tokenizer.pad_token_id,
+                )
+        except RuntimeError as e:
+            if not _is_out_of_memory(e) or rows == 1:
+                raise
+            budget = max(longest, budget // 2)
+            torch.cuda.empty_cache()
+            continue
+        batch_answers = tokenizer.batch_decode(
+            sequences[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True
+        )
+        if template is not None:
+            batch_answers = [template.answer(a) for a in batch_answers]
+        else:
+            batch_answers = [a.strip() for a in batch_answers]
+        for i, answer in zip(batch, batch_answers):
+            answers[i] = answer
+        if on_batch is not None:
+            on_batch(batch, batch_answers)
+        start += rows
+        pbar.update(rows)
+        pbar.set_description(f"Testing: batch of {rows}")
+
+        if device == "cuda":
+            total = torch.cuda.get_device_properties(0).total_memory
+            if torch.cuda.max_memory_allocated() < memory_fraction * total:
+                budget = int(budget * 1.25)
+            torch.cuda.reset_peak_memory_stats()
+    pbar.close()
+    return answers
+
+
+def load_charge_names(path="resources/criminal_charges.json"):
+    with open(path, encoding="utf-8") as f:
+        return sorted({c["charge"] for c in json.load(f)}, key=len, reverse=True)
+
+
+def _ngram_counts(tokens, n):
+    """(example, n-gram) -> count over a Series of token lists, in one pass."""
+    flat = tokens.explode()  # one row per token, indexed by example
+    grams = flat
+    for k in range(1, n):
+        following = flat.groupby(level=0).shift(-k)
+        grams = grams.str.cat(following.to_numpy(), sep="\x00")  # NaN past the end
+    grams = grams.dropna()
+    return grams.groupby([grams.index, grams]).size()
+
+
+def _rouge_n(pred_tokens, label_tokens, n):
+    """ROUGE-n F1 of every example, from the n-gram counts of the whole column."""
+    pred, label = _ngram_counts(pred_tokens, n), _ngram_counts(label_tokens, n)
+    rows = pred_tokens.index
+    overlap = pd.concat([pred, label], axis=1, join="inner").min(axis=1)
+    overlap = overlap.groupby(level=0).sum().reindex(rows, fill_value=0)
+    precision = overlap / pred.groupby(level=0).sum().reindex(rows)
+    recall = overlap / label.groupby(level=0).sum().reindex(rows)
+    return (2 * precision * recall / (precision + recall)).fillna(0.0)
+
+
+def _lcs_length(a, b):
+    # bit-parallel LCS (Hyyrö): one big-int operation per token of `b`
+    if not a or not b:
+        return 0
+    masks = {}
+    for i, token in enumerate(a):
+        masks[token] = masks.get(token, 0) | (1 << i)
+    full = (1 << len(a)) - 1
+    v = full
+    for token in b:
+        u = v & masks.get(token, 0)
+        v = ((v + u) | (v - u)) & full
+    return len(a) - bin(v).count("1")
+
+
+def _rouge_l(pred, label):
+    lcs = _lcs_length(pred, label)
+    if not lcs:
+        return 0.0
+    precision, recall = lcs / len(pred), lcs / len(label)
+    return 2 * precision * recall / (precision + recall)
+
+
+def compute_metrics(preds, labels, charge_names=()):
+    """
+    Per-example scores (DataFrame) and their means (dict): whitespace-
+    normalized exact match, charge accuracy (the set of charge names found
+    in the answer equals the label's, over labels naming a charge) and
+    ROUGE-1/2/L F1 over characters, with ASCII words as one token.
+    """
+    preds = pd.Series(list(preds), dtype=object).fillna("").astype(str)
+    labels = pd.Series(list(labels), dtype=object).fillna("").astype(str)
+    scores = pd.DataFrame(index=preds.index)
+    scores["exact_match"] = (
+        preds.str.split().str.join(" ") == labels.str.split().str.join(" ")
+    )
+
+    summary = {"examples": len(preds)}
+    if charge_names:
+        pattern = "|".join(map(re.escape, charge_names))
+        label_charges = labels.str.findall(pattern).map(frozenset)
+        pred_charges = preds.str.findall(pattern).map(frozenset)
+        has_charge = label_charges.map(bool)
+        scores["charge_match"] = (label_charges == pred_charges).where(has_charge)
+        summary["charge_examples"] = int(has_charge.sum())
+
+    pred_tokens = preds.str.findall(_OVERLAP_TOKEN)
+    label_tokens = labels.str.findall(_OVERLAP_TOKEN)
+    scores["rouge1"] = _rouge_n(pred_tokens, label_tokens, 1)
+    scores["rouge2"] = _rouge_n(pred_tokens, label_tokens, 2)
+    # LCS is a dynamic program per pair; each one is bit-parallel instead
+    scores["rougeL"] = [_rouge_l(p, l) for p, l in zip(pred_tokens, label_tokens)]
+
+    means = scores.astype(float).mean()  # NaN charge rows are skipped
+    for name in scores.columns:
+        key = "charge_accuracy" if name == "charge_match" else name
+        summary[key] = 0.0 if pd.isna(means[name]) else float(means[name])
+    return scores, summary
+
+
+def shard_path(output_path, shard_index, workers):
+    shard_dir = os.path.splitext(output_path)[0] + "_shards"
+    return os.path.join(shard_dir, f"shard-{shard_index:03d}-of-{workers:03d}.jsonl")
+
+
+def read_shard(path):
+    """
+    {example index: prediction} already checkpointed in a shard file, and
+    whether its last record was cut off by a killed worker.
+    """
+    done, truncated = {}, False
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                truncated = not line.endswith("\n")
+                try:
+                    record = json.loads(line)
+                    done[record["index"]] = record["pred"]
+                except (ValueError, KeyError):
+                    pass  # partially written record
+    return done, truncated
+
+
+def merge_shards(output_path, workers, total):
+    """Predictions of all shards in dataset order, plus the missing indices."""
+    preds = [None] * total
+    for shard_index in range(workers):
+        done, _ = read_shard(shard_path(output_path, shard_index, workers))
+        for index, pred in done.items():
+            preds[index] = pred
+    missing = [i for i, pred in enumerate(preds) if pred is None]
+    return preds, missing
+
+
+def run_workers(params, workers):
+    """
+    Runs `workers` shard processes, one per visible GPU (round robin) or
+    with an equal share of CPU threads. Returns the failed shard indices.
+    """
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    gpus = visible.split(",") if visible else [str(i) for i in range(torch.cuda.device_count())]
+    procs = []
+    for shard_index in range(workers):
+        env = dict(os.environ)
+        if gpus:
+            env["CUDA_VISIBLE_DEVICES"] = gpus[shard_index % len(gpus)]
+        else:
+            env["OMP_NUM_THREADS"] = str(max(1, physical_cores() // workers))
+        # repr() so fire reads every value back unchanged, '' included
+        args = [
+            f"--{name}={value!r}"
+            for name, value in params.items()
+            if value is not None and name != "shard_index"
+        ]
+        cmd = [sys.executable, "-m", "utils.evaluate", *args, f"--shard_index={shard_index}"]
+        procs.append(subprocess.Popen(cmd, env=env))
+    return [i for i, proc in enumerate(procs) if proc.wait() != 0]
 
 
 def main(
     load_8bit: bool = True,
+    quantize: str = "",  # "int8" or "int4" weight-only quantization for CPU inference
+    cpu_dtype: str = "auto",  # "bfloat16" or "float32" on CPU; auto picks bf16 where the CPU supports it
+    autotune: bool = False,  # time a short decode per CPU dtype on first start and cache the fastest
+    num_threads: int = 0,  # torch threads on CPU, 0 = physical cores
     base_model: str = "decapoda-research/llama-7b-hf",
     lora_weights: str = "./lora-alpaca",
     data_path: str = "./data",
     output_path: str = "./output",
     eval_rate: float = 0.1,
-    batch_size: int = 32,
+    batch_size: int = 32,  # most rows per batch
     # The prompt template to use, will default to alpaca.
     prompt_template: str = "alpaca",
+    max_batch_tokens: int = 16384,  # padded prompt + new tokens per batch, adapted on CUDA
+    charges_path: str = "resources/criminal_charges.json",
+    workers: int = 1,  # processes, each evaluating examples i with i % workers == its shard
+    shard_index: int = -1,  # set by the launcher: evaluate only this shard and exit
 ):
+    params = dict(locals())
     base_model = base_model or os.environ.get("BASE_MODEL", "")
     assert (base_model), "Please specify a --base_model, e.g. --base_model='huggyllama/llama-7b'"
 
-    prompter = Prompter(prompt_template)
-    tokenizer = LlamaTokenizer.from_pretrained(base_model)
-    if device == "cuda":
-        model = LlamaForCausalLM.from_pretrained(
-            base_model,
-            load_in_8bit=load_8bit,
-            torch_dtype=torch.float16,
-            device_map="auto",
-        )
-        model = PeftModel.from_pretrained(
-            model,
-            lora_weights,
-            torch_dtype=torch.float16,
-        )
-
-    # unwind broken decapoda-research config
-    model.config.pad_token_id = tokenizer.pad_token_id = 0  # unk
-    model.config.bos_token_id = 1
-    model.config.eos_token_id = 2
+    df = pd.read_json(data_path, orient='records')
+    # df = df.sample(frac=eval_rate).reset_index(drop=True)
 
-    if not load_8bit:
-        model.half()  # seems to fix bugs for some users.
+    def report():
+        preds, missing = merge_shards(output_path, workers, len(df))
+        if missing:
+            print(f"{len(missing)} of {len(df)} examples have no prediction yet, "
+                  "rerun the same command to resume")
+            return None
+        df['pred'] = preds
+        df['pred'].to_csv(output_path, index=False)
 
-    model.eval()
-    if torch.__version__ >= "2" and sys.platform != "win32":
-        model = torch.compile(model)
+        charge_names = load_charge_names(charges_path) if charges_path else ()
+        _, summary = compute_metrics(df['pred'], df['output'], charge_names)
+        print(json.dumps(summary, indent=2))
+        with open(os.path.splitext(output_path)[0] + "_metrics.json", "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
 
-    def evaluate_one(
-        instruction,
-        input=None,
-        temperature=0.1,
-        top_p=0.75,
-        top_k=40,
-        num_beams=2,
-        max_new_tokens=128,
-        **kwargs,
-    ):
-        prompt = prompter.generate_prompt(instruction, input)
-        inputs = tokenizer(prompt, return_tensors="pt")
-        input_ids = inputs["input_ids"].to(device)
-        generation_config = GenerationConfig(
-            temperature=temperature,
-            top_p=top_p,
-            top_k=top_k,
-            num_beams=num_beams,
-            **kwargs,
-        )
+    if workers > 1 and shard_index < 0:
+        # launcher: the shard processes load their own model copies
+        failed = run_workers(params, workers)
+        if failed:
+            print(f"Shards {failed} failed; completed work is checkpointed")
+        return report()
 
-        # Without streaming
-        with torch.no_grad():
-            generation_output = model.generate(
-                input_ids=input_ids,
-                generation_config=generation_config,
-                return_dict_in_generate=True,
-                output_scores=True,
-                max_new_tokens=max_new_tokens,
-            )
-        s = generation_output.sequences[0]
-        output = tokenizer.decode(s, skip_special_tokens=True)
-        return prompter.get_response(output)
-
-    def evaluate_all():
-        # data = datasets.load_dataset("json", data_files=data_path)
-        # data = data["train"]
-        # df = data.to_pandas()
-        df = pd.read_json(data_path, orient='records')
-        print(df.info())
-        # 计算准确率
-        correct = 0
-        total = 0
-        total_step = len(df)
-        pbar = tqdm(total=total_step, unit='batch')
-        error = []
-        for i in range(total_step):
-            instruction = df['instruction'].iloc[i]
-            input = df['input'].iloc[i]
-            label = df['output'].iloc[i]
-            pred = evaluate_one(instruction=instruction, input=input)
-            if pred == label:
-                correct += 1
-            else:
-                error.append((label, pred))
-            total += 1
-            acc = correct / total
-            # 更新进度条
-            # Update the progress bar
-            pbar.set_description(
-                f"Testing: Sample [{total}/{total_step}] Acc: {acc :.4f}")
-            pbar.update(1)
-
-        for e in error:
-            print(e)
+    prompter = Prompter(prompt_template)
+    model, tokenizer, _ = load_model(
+        base_model, lora_weights, load_8bit=load_8bit, device=device, quantize=quantize,
+        cpu_dtype=cpu_dtype, autotune=autotune, num_threads=num_threads,
+    )
+    template = prompter.compile(tokenizer)
 
     def evaluate_by_batch(
+        shard_index,
         temperature=0.1,
         top_p=0.75,
         top_k=40,
         num_beams=1,
         max_new_tokens=32
     ):
-        df = pd.read_json(data_path, orient='records')
-        # df = df.sample(frac=eval_rate).reset_index(drop=True)
-        df['prompt'] = df.apply(lambda x: prompter.generate_prompt(
-            x['instruction'], x['input']), axis=1)
-        tokenizer.padding_side = "left"  # Allow batched inference
+        path = shard_path(output_path, shard_index, workers)
+        done, truncated = read_shard(path)
+        todo = [i for i in range(shard_index, len(df), workers) if i not in done]
+        if done:
+            print(f"Resuming shard {shard_index}: {len(done)} examples already in {path}")
+        if not todo:
+            return
+        prompts = template.encode_batch(
+            [df['instruction'].iloc[i] for i in todo], [df['input'].iloc[i] for i in todo]
+        )
 
         generation_config = GenerationConfig(
             temperature=temperature,
@@ -143,54 +336,51 @@ def main(
             top_k=top_k,
             num_beams=num_beams
         )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            if truncated:
+                f.write("\n")  # don't glue onto a partially written record
 
-        outputs = []
-        total = 0
-        total_step = math.ceil(len(df) / batch_size)
-        pbar = tqdm(total=total_step, unit='batch')
-        # 计算准确率
-        with torch.no_grad():
-            for i in range(total_step):
-                batch = df.iloc[i*batch_size:(i+1)*batch_size]
-                inputs = tokenizer(batch['prompt'].tolist(), return_tensors="pt", padding=True)[
-                    'input_ids'].to(device)
-
-                generation_outputs = model.generate(
-                    input_ids=inputs,
-                    generation_config=generation_config,
-                    max_new_tokens=max_new_tokens,
-                    pad_token_id=tokenizer.pad_token_id
-                )
+            def checkpoint(batch, answers):
+                for j, answer in zip(batch, answers):
+                    record = {"index": todo[j], "pred": answer}
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
 
-                for g in generation_outputs:
-                    decoded_item = tokenizer.decode(
-                        g, skip_special_tokens=True)
-                    try:
-                        output = prompter.get_response(decoded_item)
-                    except:
-                        output = decoded_item
-                    outputs.append(output)
-                    total += 1
-
-                # 更新进度条
-                pbar.set_description(f"Testing: Sample [{total}/{len(df)}] ")
-                pbar.update(1)
-        df['pred'] = outputs
-        df['pred'].to_csv(output_path, index=False)
+            generate_sorted(
+                model,
+                tokenizer,
+                prompts,
+                generation_config,
+                max_new_tokens=max_new_tokens,
+                max_batch_size=batch_size,
+                max_batch_tokens=max_batch_tokens,
+                on_batch=checkpoint,
+                template=template,
+            )
 
-    evaluate_by_batch()
+    if shard_index >= 0:
+        evaluate_by_batch(shard_index)
+        return None
+    evaluate_by_batch(0)
+    return report()
 
 
 if __name__ == "__main__":
-    # fire.Fire(main)
-    import yaml
-    dataset_param = sys.argv[1]
-    with open("./configs/evaluate_params.yaml", "r") as stream:
-        # try:
-        params = yaml.safe_load(stream)
-        print('=' * 80)
-        print(params[dataset_param])
-        print('=' * 80)
-
-    # fire.Fire(train)
-    main(**params[dataset_param])
+    if len(sys.argv) > 1 and not sys.argv[1].startswith("-"):
+        # python -m utils.evaluate <dataset> [--flag=value ...]: params come
+        # from configs/evaluate_params.yaml, flags override them
+        import yaml
+        dataset_param = sys.argv[1]
+        with open("./configs/evaluate_params.yaml", "r") as stream:
+            params = yaml.safe_load(stream)
+            print('=' * 80)
+            print(params[dataset_param])
+            print('=' * 80)
+
+        fire.Fire(
+            lambda **overrides: main(**dict(params[dataset_param], **overrides)),
+            command=sys.argv[2:],
+        )
+    else:
+        fire.Fire(main)
@@ -0,0 +1,244 @@
+"""
+Model loading shared by webapp.py, webui.py, infer.py and utils/evaluate.py.
+
+On CPU, local safetensors checkpoints are memory-mapped instead of read:
+parameters are views into a private (copy-on-write) mapping of the shard
+files, so startup does no weight copies and every worker process on the host
+that maps the same files shares one set of physical pages via the page cache.
+Weights stored in another dtype than the CPU compute dtype (utils/cpu.py)
+are copied on conversion, so merge with `--dtype` matching the replicas.
+"""
+
+import glob
+import json
+import os
+import sys
+import time
+
+import torch
+from peft import PeftModel
+from transformers import AutoConfig, LlamaForCausalLM, LlamaTokenizer
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def get_device():
+    if torch.cuda.is_available():
+        device = "cuda"
+    else:
+        device = "cpu"
+    try:
+        if torch.backends.mps.is_available():
+            device = "mps"
+    except AttributeError:
+        pass
+    return device
+
+
+def mmap_safetensors(path):
+    """Tensors of one .safetensors file as views into a read-only file mapping."""
+    nbytes = os.path.getsize(path)
+    with open(path, "rb") as f:
+        header_len = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_len))
+    header.pop("__metadata__", None)
+    # shared=False maps the file MAP_PRIVATE: pages come from the page cache
+    # and are only copied if something writes to them.
+    buffer = torch.from_file(path, shared=False, size=nbytes, dtype=torch.uint8)
+    data_start = 8 + header_len
+    tensors = {}
+    for name, info in header.items():
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        raw = buffer[data_start + begin:data_start + end]
+        if (data_start + begin) % torch.empty((), dtype=dtype).element_size():
+            raw = raw.clone()  # misaligned; needs its own storage to reinterpret
+        tensors[name] = raw.view(dtype).view(info["shape"])
+    return tensors
+
+
+def _local_safetensors(base_model):
+    if not os.path.isdir(base_model):
+        return []
+    return sorted(glob.glob(os.path.join(base_model, "*.safetensors")))
+
+
+def _load_mmap(base_model, files):
+    from accelerate import init_empty_weights
+
+    config = AutoConfig.from_pretrained(base_model)
+    with init_empty_weights():
+        model = LlamaForCausalLM(config)
+    state_dict = {}
+    for path in files:
+        state_dict.update(mmap_safetensors(path))
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+    missing = [n for n, p in model.named_parameters() if p.device.type == "meta"]
+    if missing:
+        raise ValueError(f"{base_model} has no weights for {missing[:5]}...")
+    return model
+
+
+def _cast_parameters(model, dtype):
+    # parameters only: quantization scales and rotary buffers keep fp32
+    for param in model.parameters():
+        if param.is_floating_point() and param.dtype != dtype:
+            param.data = param.data.to(dtype)
+
+
+def _load_weights(base_model, lora_weights, device, load_8bit, files, quantize, quantized, dtype):
+    from utils import quantize as quant
+
+    timings = {}
+    start = time.perf_counter()
+    if device == "cuda":
+        model = LlamaForCausalLM.from_pretrained(
+            base_model,
+            load_in_8bit=load_8bit,
+            torch_dtype=torch.float16,
+            device_map="auto",
+        )
+    elif device == "mps":
+        model = LlamaForCausalLM.from_pretrained(
+            base_model,
+            device_map={"": device},
+            torch_dtype=torch.float16,
+        )
+    elif quantized:
+        model = quant.load_quantized(base_model, dtype)
+    elif files:
+        model = _load_mmap(base_model, files)
+    else:
+        model = LlamaForCausalLM.from_pretrained(
+            base_model, device_map={"": device}, torch_dtype=dtype, low_cpu_mem_usage=True
+        )
+    timings["base_weights"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    adapter_kwargs = {}
+    if device != "cuda":
+        adapter_kwargs["device_map"] = {"": device}
+    if device != "cpu":
+        adapter_kwargs["torch_dtype"] = torch.float16
+    try:
+        print(f"Using lora {lora_weights}")
+        model = PeftModel.from_pretrained(model, lora_weights, **adapter_kwargs)
+    except Exception:
+        print("*"*50, "\n Attention! No Lora Weights \n", "*"*50)
+    timings["adapter"] = time.perf_counter() - start
+
+    if quantize:
+        start = time.perf_counter()
+        if isinstance(model, PeftModel):
+            model = model.merge_and_unload()
+        quant.quantize_model(model, 8 if quantize == "int8" else 4)
+        timings["quantize"] = time.perf_counter() - start
+
+    if device == "cpu":
+        # fp16 matmuls are emulated on most CPUs
+        _cast_parameters(model, dtype)
+    elif not load_8bit:
+        model.half()  # seems to fix bugs for some users.
+    model.eval()
+    return model, timings
+
+
+def load_model(
+    base_model: str,
+    lora_weights: str = "",
+    load_8bit: bool = False,
+    device: str = None,
+    compile_model: bool = True,
+    mmap: bool = True,
+    quantize: str = "",
+    cpu_dtype: str = "auto",
+    autotune: bool = False,
+    num_threads: int = 0,
+):
+    """
+    Loads tokenizer, base model and optional LoRA adapter the way every
+    entry point used to do inline. Returns (model, tokenizer, timings) where
+    timings holds seconds per phase.
+
+    `quantize="int8"` or `"int4"` quantizes the linear weights on CPU after
+    merging the adapter into them (see utils/quantize.py); checkpoints saved
+    by utils.quantize are recognised and load quantized without it.
+
+    On CPU the model runs in `cpu_dtype`: "auto" is bf16 where the CPU has
+    bf16 instructions and fp32 otherwise, or with `autotune` whichever
+    decodes faster on this host (cached, see utils/cpu.py). `num_threads`
+    sets torch's intra-op threads (0 = physical cores).
+    """
+    from utils import cpu
+    from utils import quantize as quant
+
+    device = device or get_device()
+    timings = {}
+    quantized = os.path.isdir(base_model) and quant.is_quantized(base_model)
+    if quantize not in ("", "int8", "int4"):
+        raise ValueError(f"quantize must be 'int8' or 'int4', not {quantize!r}")
+    if (quantize or quantized) and device != "cpu":
+        raise ValueError("Weight-only quantization is for CPU inference; use --load_8bit on GPU")
+    if quantized and lora_weights:
+        raise ValueError(f"{base_model} is quantized; merge the LoRA weights before quantizing (merge.py)")
+    if cpu_dtype not in ("auto",) + cpu.CANDIDATE_DTYPES:
+        raise ValueError(f"cpu_dtype must be 'auto', 'bfloat16' or 'float32', not {cpu_dtype!r}")
+
+    start = time.perf_counter()
+    tokenizer = LlamaTokenizer.from_pretrained(base_model)
+    timings["tokenizer"] = time.perf_counter() - start
+
+    files = _local_safetensors(base_model) if mmap and device == "cpu" else []
+    dtype = torch.float16
+    model = None
+    if device == "cpu":
+        threads = cpu.configure_threads(num_threads)
+        if cpu_dtype != "auto":
+            dtype = getattr(torch, cpu_dtype)
+        elif autotune:
+            start = time.perf_counter()
+            dtype, model = cpu.autotune_dtype(
+                lambda candidate: _load_weights(
+                    base_model, lora_weights, device, load_8bit, files, quantize, quantized, candidate
+                )[0],
+                key=f"{base_model}|{lora_weights}|{quantize or ('quantized' if quantized else '')}",
+            )
+            timings["autotune"] = time.perf_counter() - start
+        else:
+            dtype = cpu.default_dtype()
+        print(f"CPU inference in {str(dtype).replace('torch.', '')} with {threads} threads")
+
+    if model is None:  # autotune hands back the model it timed fastest
+        model, weight_timings = _load_weights(
+            base_model, lora_weights, device, load_8bit, files, quantize, quantized, dtype
+        )
+        timings.update(weight_timings)
+
+    # unwind broken decapoda-research config
+    model.config.pad_token_id = tokenizer.pad_token_id = 0  # unk
+    model.config.bos_token_id = 1
+    model.config.eos_token_id = 2
+
+    start = time.perf_counter()
+    if compile_model and torch.__version__ >= "2" and sys.platform != "win32":
+        model = torch.compile(model)
+    timings["compile"] = time.perf_counter() - start
+
+    print(
+        "Model loaded in "
+        + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items())
+        + (" (memory-mapped safetensors)" if files or quantized else "")
+    )
+    return model, tokenizer, timings
@@ -0,0 +1,331 @@
+"""
+Streaming LoRA merge with bounded memory, used by merge.py and utils/merge.py.
+
+The PEFT path (load the whole base model, `merge_and_unload`, build a
+second state dict, `save_pretrained`) needs over twice the model size in
+RAM. Here the base checkpoint is read one tensor at a time from
+memory-mapped shards, `W + scale * B @ A` is applied to the LoRA-targeted
+weights only (in float32, then cast to the output dtype), and the result is
+written to safetensors shards as soon as a shard is full. Peak memory is
+about one output shard plus one weight in float32; input pages come from
+the page cache and can be dropped by the kernel at any time.
+
+Several adapters can be merged at once with weights (e.g. the continued
+pretraining adapter from train_clm.py plus the instruction adapter from
+finetune.py): their scaled factors are concatenated along the rank, so each
+targeted weight gets their weighted sum in one matmul.
+"""
+
+import glob
+import json
+import os
+import re
+import shutil
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import torch
+
+from utils.loader import mmap_safetensors
+
+_LORA_KEY = re.compile(r"^base_model\.model\.(.+)\.lora_([AB])(?:\.[^.]+)?\.weight$")
+_COPIED_FILES = (
+    "generation_config.json",
+    "tokenizer.model",
+    "tokenizer.json",
+    "tokenizer_config.json",
+    "special_tokens_map.json",
+)
+
+
+def _local_dir(name_or_path: str, patterns):
+    if os.path.isdir(name_or_path):
+        return name_or_path
+    from huggingface_hub import snapshot_download
+
+    return snapshot_download(name_or_path, allow_patterns=list(patterns))
+
+
+def _load_file(path):
+    if path.endswith(".safetensors"):
+        return mmap_safetensors(path)
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except (TypeError, RuntimeError):
+        # older torch, or a checkpoint not saved in the zip format
+        return torch.load(path, map_location="cpu")
+
+
+def base_weight_files(base_dir: str):
+    files = sorted(glob.glob(os.path.join(base_dir, "*.safetensors")))
+    return files or sorted(glob.glob(os.path.join(base_dir, "pytorch_model*.bin")))
+
+
+def load_lora(lora_model: str, weight: float = 1.0):
+    """
+    LoRA factors of an adapter as `{base weight name: (L, R)}` with the
+    update `L @ R` already scaled by `weight * lora_alpha / r` and laid out
+    like the base weight. Only plain LoRA adapters are supported; anything
+    else in the checkpoint (modules_to_save, biases) would be silently lost,
+    so it is an error.
+    """
+    lora_dir = _local_dir(lora_model, ["adapter_config.json", "adapter_model.*"])
+    with open(os.path.join(lora_dir, "adapter_config.json")) as f:
+        config = json.load(f)
+    if config.get("peft_type", "LORA") != "LORA":
+        raise ValueError(f"{lora_model} is a {config['peft_type']} adapter, not LoRA")
+    files = glob.glob(os.path.join(lora_dir, "adapter_model.safetensors")) or glob.glob(
+        os.path.join(lora_dir, "adapter_model.bin")
+    )
+    if not files:
+        raise ValueError(f"No adapter_model.safetensors/.bin in {lora_dir}")
+    state_dict = _load_file(files[0])
+
+    r = config["r"]
+    alpha = config.get("lora_alpha", r)
+    scale = weight * (alpha / r ** 0.5 if config.get("use_rslora") else alpha / r)
+    factors = {}
+    for key, tensor in state_dict.items():
+        match = _LORA_KEY.match(key)
+        if not match:
+            raise ValueError(f"{lora_model} has a non-LoRA weight {key}, which cannot be merged")
+        factors.setdefault(match.group(1) + ".weight", {})[match.group(2)] = tensor.float()
+    if config.get("fan_in_fan_out", False):
+        # the base weight is stored transposed: (B @ A).T == A.T @ B.T
+        return {name: (pair["A"].T * scale, pair["B"].T) for name, pair in factors.items()}
+    return {name: (pair["B"] * scale, pair["A"]) for name, pair in factors.items()}
+
+
+def parse_adapters(spec):
+    """
+    `"path_a:0.7,path_b:0.3"` (weight defaults to 1) or a list of paths or
+    `(path, weight)` pairs, as a list of `(path, weight)`.
+    """
+    if isinstance(spec, str):
+        spec = [item for item in spec.split(",") if item.strip()]
+    adapters = []
+    for item in spec:
+        if isinstance(item, (tuple, list)):
+            adapters.append((item[0], float(item[1])))
+            continue
+        path, _, weight = item.strip().rpartition(":")
+        try:
+            adapters.append((path, float(weight)))
+        except ValueError:
+            adapters.append((item.strip(), 1.0))
+    return adapters
+
+
+def load_adapters(adapters):
+    """
+    Combined factors of several weighted adapters: `{base weight name: (L, R)}`
+    where `L @ R` is the weighted sum of their updates, with the factors
+    concatenated along the rank dimension.
+    """
+    combined = {}
+    for path, weight in adapters:
+        for name, (left, right) in load_lora(path, weight).items():
+            combined.setdefault(name, []).append((left, right))
+    return {
+        name: (torch.cat([l for l, _ in pairs], dim=1), torch.cat([r for _, r in pairs], dim=0))
+        for name, pairs in combined.items()
+    }
+
+
+def _merge_tensor(weight, factors, out_dtype):
+    left, right = factors
+    if (left.shape[0], right.shape[1]) != tuple(weight.shape):
+        raise ValueError(
+            f"LoRA update {tuple(left.shape[:1]) + tuple(right.shape[1:])} "
+            f"does not match base weight {tuple(weight.shape)}"
+        )
+    # out of place: the base weight may be a view of a read-only mapping
+    return torch.addmm(weight.float(), left, right).to(out_dtype)
+
+
+# per worker process state for the parallel merge
+_worker = {}
+
+
+def _init_worker(adapters, out_dtype, threads):
+    torch.set_num_threads(threads)
+    _worker.update(factors=load_adapters(adapters), out_dtype=out_dtype, files={})
+
+
+def _merge_in_worker(path, name):
+    files = _worker["files"]
+    if path not in files:
+        files.clear()
+        files[path] = _load_file(path)
+    return _merge_tensor(files[path][name], _worker["factors"][name], _worker["out_dtype"])
+
+
+class ShardWriter:
+
+    """
+    Writes tensors to numbered safetensors shards of at most `max_shard_bytes`
+    (a single larger tensor gets a shard of its own) and the index file
+    `from_pretrained` reads.
+    """
+
+    def __init__(self, output_dir: str, max_shard_bytes: int):
+        self.output_dir = output_dir
+        self.max_shard_bytes = max_shard_bytes
+        self.tensors = {}
+        self.size = 0
+        self.shards = []  # tensor names per written shard
+        self.total_size = 0
+
+    def add(self, name: str, tensor: torch.Tensor):
+        nbytes = tensor.numel() * tensor.element_size()
+        if self.tensors and self.size + nbytes > self.max_shard_bytes:
+            self.flush()
+        self.tensors[name] = tensor.contiguous()
+        self.size += nbytes
+        self.total_size += nbytes
+
+    def flush(self):
+        if not self.tensors:
+            return
+        from safetensors.torch import save_file
+
+        path = os.path.join(self.output_dir, f"model-{len(self.shards) + 1:05d}.safetensors.tmp")
+        save_file(self.tensors, path, metadata={"format": "pt"})
+        self.shards.append(list(self.tensors))
+        self.tensors, self.size = {}, 0
+
+    def close(self):
+        self.flush()
+        count = len(self.shards)
+        weight_map = {}
+        for number, names in enumerate(self.shards, 1):
+            name = f"model-{number:05d}-of-{count:05d}.safetensors"
+            os.replace(
+                os.path.join(self.output_dir, f"model-{number:05d}.safetensors.tmp"),
+                os.path.join(self.output_dir, name),
+            )
+            weight_map.update(dict.fromkeys(names, name))
+        with open(os.path.join(self.output_dir, "model.safetensors.index.json"), "w") as f:
+            json.dump(
+                {"metadata": {"total_size": self.total_size}, "weight_map": weight_map},
+                f,
+                indent=2,
+            )
+
+
+def merge_lora(
+    base_model: str,
+    adapters,
+    output_dir: str,
+    dtype: str = "float16",
+    max_shard_mb: int = 2048,
+    workers: int = 1,
+    dry_run: bool = False,
+):
+    """
+    Merges one or more weighted LoRA adapters (see `parse_adapters`) into
+    `base_model` in a single pass and saves the result with config and
+    tokenizer files to `output_dir`. Base model and adapters may be local
+    directories or hub ids. With `workers > 1` targeted weights are merged
+    in a process pool while the main process writes shards in order. A dry
+    run only reports what would change and the output size. Returns the
+    names of the merged weights.
+    """
+    start = time.perf_counter()
+    adapters = parse_adapters(adapters)
+    out_dtype = getattr(torch, dtype)
+    base_dir = _local_dir(base_model, ["*.json", "*.safetensors", "*.bin", "tokenizer.model"])
+    files = base_weight_files(base_dir)
+    if not files:
+        raise ValueError(f"No *.safetensors or pytorch_model*.bin weights in {base_dir}")
+    factors = load_adapters(adapters)
+
+    if dry_run:
+        return _dry_run(files, factors, adapters, out_dtype, max_shard_mb)
+
+    os.makedirs(output_dir, exist_ok=True)
+    writer = ShardWriter(output_dir, max_shard_mb * 2**20)
+    merged = []
+    pool = None
+    if workers > 1:
+        import multiprocessing
+
+        # merged tensors come back through torch's shared memory pickling;
+        # spawn because forking after torch has started threads can hang
+        pool = ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(adapters, out_dtype, max(1, (os.cpu_count() or 1) // workers)),
+        )
+    try:
+        pending = deque()
+        for path in files:
+            for name, weight in _load_file(path).items():
+                if name not in factors:
+                    pending.append((name, weight.to(out_dtype)))
+                elif pool is None:
+                    pending.append((name, _merge_tensor(weight, factors[name], out_dtype)))
+                else:
+                    pending.append((name, pool.submit(_merge_in_worker, path, name)))
+                if name in factors:
+                    merged.append(name)
+                # bound the merged tensors held in memory; write in file order
+                while pending and (
+                    not isinstance(pending[0][1], Future)
+                    or len(pending) > 2 * workers
+                ):
+                    done_name, tensor = pending.popleft()
+                    writer.add(done_name, tensor.result() if isinstance(tensor, Future) else tensor)
+        while pending:
+            done_name, tensor = pending.popleft()
+            writer.add(done_name, tensor.result() if isinstance(tensor, Future) else tensor)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    writer.close()
+
+    missing = sorted(set(factors) - set(merged))
+    if missing:
+        raise ValueError(f"LoRA weights without a base weight: {missing[:5]}")
+
+    with open(os.path.join(base_dir, "config.json")) as f:
+        config = json.load(f)
+    config["torch_dtype"] = dtype
+    with open(os.path.join(output_dir, "config.json"), "w") as f:
+        json.dump(config, f, indent=2)
+    for name in _COPIED_FILES:
+        if os.path.exists(os.path.join(base_dir, name)):
+            shutil.copy(os.path.join(base_dir, name), os.path.join(output_dir, name))
+
+    print(
+        f"Merged {len(adapters)} adapter(s) into {len(merged)} weights, "
+        f"{len(writer.shards)} shards ({writer.total_size / 2**30:.2f} GiB) "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+    return merged
+
+
+def _dry_run(files, factors, adapters, out_dtype, max_shard_mb):
+    element_size = torch.empty((), dtype=out_dtype).element_size()
+    total, changed = 0, []
+    for path in files:
+        for name, weight in _load_file(path).items():
+            total += weight.numel() * element_size
+            if name in factors:
+                left, right = factors[name]
+                if (left.shape[0], right.shape[1]) != tuple(weight.shape):
+                    raise ValueError(f"LoRA update for {name} does not match {tuple(weight.shape)}")
+                changed.append((name, left.shape[1]))
+    missing = sorted(set(factors) - {name for name, _ in changed})
+    print("Adapters: " + ", ".join(f"{path} x{weight:g}" for path, weight in adapters))
+    for name, rank in changed:
+        print(f"  {name}  (combined rank {rank})")
+    print(
+        f"{len(changed)} weights change; output {total / 2**30:.2f} GiB in {out_dtype}, "
+        f"about {-(-total // (max_shard_mb * 2**20))} shards of {max_shard_mb} MB"
+    )
+    if missing:
+        print(f"LoRA weights without a base weight: {missing}")
+    return [name for name, _ in changed]
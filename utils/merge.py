@@ -1,51 +1,49 @@
-import os
-
-import torch
-import transformers
-from peft import PeftModel
-from transformers import LlamaForCausalLM, LlamaTokenizer  # noqa: F402
-
-BASE_MODEL = os.environ.get("BASE_MODEL", None)
-assert (
-    BASE_MODEL
-), "Please specify a value for BASE_MODEL environment variable, e.g. `export BASE_MODEL=huggyllama/llama-7b`"  # noqa: E501
-
-tokenizer = LlamaTokenizer.from_pretrained(BASE_MODEL)
-
-base_model = LlamaForCausalLM.from_pretrained(
-    BASE_MODEL,
-    load_in_8bit=False,
-    torch_dtype=torch.float16,
-    device_map={"": "cpu"},
-)
-
-first_weight = base_model.model.layers[0].self_attn.q_proj.weight
-first_weight_old = first_weight.clone()
+"""
+Merges a weighted list of LoRA adapters into a base model in one pass,
+e.g. the continued-pretraining adapter from train_clm.py and the
+instruction adapter from finetune.py, with per-tensor work spread over a
+process pool. See utils/lora_merge.py.
 
-lora_model = PeftModel.from_pretrained(
-    base_model,
-    "../outputs/lora-llama-clm-e2",
-    device_map={"": "cpu"},
-    torch_dtype=torch.float16,
-)
+    python -m utils.merge --base_model=minlik/American-llama-7b-merged \
+        --lora_models="./outputs/lora-llama-clm-e2:1.0,./outputs/legal-llama-lora:0.8" \
+        --output_dir=./models/legal-base-7b --workers=4 --dry_run=True
+"""
 
-lora_weight = lora_model.base_model.model.model.layers[0].self_attn.q_proj.weight
-
-assert torch.allclose(first_weight_old, first_weight)
-
-# merge weights - new merging method from peft
-lora_model = lora_model.merge_and_unload()
-
-lora_model.train(False)
-
-# did we do anything?
-assert not torch.allclose(first_weight_old, first_weight)
-
-lora_model_sd = lora_model.state_dict()
-deloreanized_sd = {
-    k.replace("base_model.model.", ""): v
-    for k, v in lora_model_sd.items()
-    if "lora" not in k
-}
+import os
 
-LlamaForCausalLM.save_pretrained(base_model, '../models/legal-base-7b', state_dict=deloreanized_sd, max_shard_size="400MB")
+import fire
+from transformers import LlamaTokenizer
+
+from utils.lora_merge import merge_lora
+
+
+def main(
+    base_model: str = os.environ.get("BASE_MODEL", ""),
+    lora_models: str = "",  # comma-separated adapter paths or hub ids, each optionally path:weight
+    output_dir: str = "",
+    dtype: str = "float16",
+    max_shard_mb: int = 400,
+    workers: int = 1,  # merge processes
+    dry_run: bool = False,  # only list the weights that change and the output size
+):
+    assert (
+        base_model
+    ), "Please specify a --base_model (or the BASE_MODEL environment variable), e.g. --base_model=huggyllama/llama-7b"
+    assert lora_models, "Please specify --lora_models, e.g. --lora_models=./outputs/lora-llama-clm-e2"
+    assert output_dir or dry_run, "Please specify an --output_dir"
+
+    merge_lora(
+        base_model,
+        lora_models,
+        output_dir,
+        dtype=dtype,
+        max_shard_mb=max_shard_mb,
+        workers=workers,
+        dry_run=dry_run,
+    )
+    if not dry_run:
+        LlamaTokenizer.from_pretrained(base_model).save_pretrained(output_dir)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,112 @@
+"""
+Sequence packing for train_clm.py.
+
+Instead of truncating every document to `cutoff_len` and padding batches,
+whole documents (each ending in EOS) are read back to back from the flat
+token array of a utils.dataset_cache split and cut into fixed blocks, so
+every position in a batch is a real token and nothing past `cutoff_len` is
+thrown away. Blocks are views into the memory-mapped array.
+
+With document masking, the collator builds a block-diagonal causal mask
+(a 4D additive mask, which needs a transformers version that accepts them)
+and restarts position ids at every document, so tokens only attend within
+their own document.
+"""
+
+import random
+
+import numpy as np
+import torch
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    def __init__(self, tokenized, block_size: int):
+        self.tokens = tokenized.tokens
+        self.block_size = block_size
+        # the trailing partial block is dropped
+        self.num_blocks = len(self.tokens) // block_size
+
+    def __len__(self):
+        return self.num_blocks
+
+    def __getitem__(self, index):
+        start = index * self.block_size
+        block = np.asarray(self.tokens[start:start + self.block_size], dtype=np.int64)
+        return {"input_ids": torch.from_numpy(block)}
+
+
+class PackedCollator:
+    def __init__(self, eos_token_id: int, mask_documents: bool = False, dtype=torch.float16):
+        self.eos_token_id = eos_token_id
+        self.mask_documents = mask_documents
+        self.dtype = dtype
+
+    def __call__(self, features):
+        input_ids = torch.stack([f["input_ids"] for f in features])
+        labels = input_ids.clone()
+        if not self.mask_documents:
+            return {
+                "input_ids": input_ids,
+                "attention_mask": torch.ones_like(input_ids),
+                "labels": labels,
+            }
+        batch_size, length = input_ids.shape
+        # a document starts at the block start and right after every EOS
+        starts = torch.zeros_like(input_ids, dtype=torch.bool)
+        starts[:, 0] = True
+        starts[:, 1:] = input_ids[:, :-1] == self.eos_token_id
+        index = torch.arange(length).expand(batch_size, length)
+        document = starts.cumsum(dim=1)
+        position_ids = index - torch.where(starts, index, 0).cummax(dim=1).values
+        # the previous document's EOS does not predict this one's first token
+        labels[:, 1:][starts[:, 1:]] = -100
+        allowed = (document[:, :, None] == document[:, None, :]) & torch.ones(
+            length, length, dtype=torch.bool
+        ).tril()
+        attention_mask = torch.zeros(batch_size, 1, length, length, dtype=self.dtype)
+        attention_mask.masked_fill_(~allowed[:, None], torch.finfo(self.dtype).min)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "position_ids": position_ids,
+            "labels": labels,
+        }
+
+
+def padding_ratio(lengths, micro_batch_size: int, cutoff_len: int, pad_to_multiple_of: int = 8, seed: int = 0):
+    """
+    Padding share and truncated token count of the unpacked path: documents
+    cut to `cutoff_len`, shuffled into micro batches and padded to the
+    longest row rounded up to `pad_to_multiple_of`.
+    """
+    lengths = [int(n) for n in lengths]
+    kept = [min(n, cutoff_len) for n in lengths]
+    random.Random(seed).shuffle(kept)
+    padded = 0
+    for start in range(0, len(kept), micro_batch_size):
+        batch = kept[start:start + micro_batch_size]
+        longest = -(-max(batch) // pad_to_multiple_of) * pad_to_multiple_of
+        padded += longest * len(batch)
+    real = sum(kept)
+    return 1 - real / max(padded, 1), sum(lengths) - real
+
+
+def report_packing(lengths, micro_batch_size: int, cutoff_len: int, packed=None):
+    """
+    Prints the padding share of unpacked batches and, given the PackedDataset
+    built from the same (untruncated) lengths, what packing leaves out.
+    """
+    ratio, truncated = padding_ratio(lengths, micro_batch_size, cutoff_len)
+    if packed is None:
+        print(f"Unpacked: {ratio:.1%} of batch positions are padding")
+    else:
+        total = int(sum(int(n) for n in lengths))
+        print(
+            f"Unpacked: {ratio:.1%} of batch positions would be padding, "
+            f"{truncated} of {total} tokens truncated at cutoff_len={cutoff_len}"
+        )
+        dropped = total - len(packed) * packed.block_size
+        print(
+            f"Packed: {len(packed)} blocks of {packed.block_size} tokens, 0.0% padding, "
+            f"{dropped} tokens dropped from the last partial block"
+        )
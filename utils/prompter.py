@@ -4,11 +4,14 @@ A dedicated helper to manage templates and prompt building.
 
 import json
 import os.path as osp
-from typing import Union
+from string import Formatter
+from typing import List, Optional, Sequence, Union
+
+_TEMPLATE_KEYS = ("prompt_input", "prompt_no_input")
 
 
 class Prompter(object):
-    __slots__ = ("template", "_verbose")
+    __slots__ = ("template", "_verbose", "_pieces")
 
     def __init__(self, template_name: str = "", verbose: bool = False):
         self._verbose = verbose
@@ -20,11 +23,19 @@ class Prompter(object):
             raise ValueError(f"Can't read {file_name}")
         with open(file_name) as fp:
             self.template = json.load(fp)
+        # (literal text, field name or None) pairs, parsed once instead of per format() call
+        self._pieces = {
+            key: [(literal, field) for literal, field, _, _ in Formatter().parse(self.template[key])]
+            for key in _TEMPLATE_KEYS
+        }
         if self._verbose:
             print(
                 f"Using prompt template {template_name}: {self.template['description']}"
             )
 
+    def pieces(self, key: str):
+        return self._pieces[key]
+
     def generate_prompt(
         self,
         instruction: str,
@@ -34,13 +45,14 @@ class Prompter(object):
         # returns the full prompt from instruction and optional input
         # if a label (=response, =output) is provided, it's also appended.
         if input:
-            res = self.template["prompt_input"].format(
-                instruction=instruction, input=input
-            )
+            values = {"instruction": instruction, "input": input}
+            pieces = self._pieces["prompt_input"]
         else:
-            res = self.template["prompt_no_input"].format(
-                instruction=instruction
-            )
+            values = {"instruction": instruction}
+            pieces = self._pieces["prompt_no_input"]
+        res = "".join(
+            [literal + ("" if field is None else str(values[field])) for literal, field in pieces]
+        )
         if label:
             res = f"{res}{label}"
         if self._verbose:
@@ -48,4 +60,112 @@ class Prompter(object):
         return res
 
     def get_response(self, output: str) -> str:
-        return output.split(self.template["response_split"])[1].strip()
+        # the text after the response marker, up to a repeated one; "" without it
+        marker = self.template["response_split"]
+        _, _, response = output.partition(marker)
+        return response.partition(marker)[0].strip()
+
+    def template_prefixes(self) -> List[str]:
+        # the constant text in front of the first placeholder of each prompt
+        prefixes = []
+        for key in _TEMPLATE_KEYS:
+            prefix = self._pieces[key][0][0]
+            if prefix and prefix not in prefixes:
+                prefixes.append(prefix)
+        return prefixes
+
+    def compile(self, tokenizer) -> "CompiledTemplate":
+        return CompiledTemplate(self, tokenizer)
+
+
+class CompiledTemplate(object):
+
+    """
+    A Prompter's templates with the static text pre-tokenized for one
+    tokenizer, for serving and batch inference.
+
+    Prompt ids are built by concatenating the cached ids of the template
+    pieces with the ids of the instruction and input, which are the only
+    text tokenized per request (in one tokenizer call for a whole batch).
+    User text is tokenized behind a newline that is stripped again, like
+    responses in utils/tokenization.py: both templates put a newline on
+    each side of every placeholder, so sentencepiece sees the same context
+    at the seams as for the whole prompt. This is checked on a few probe
+    prompts at compile time; a template (or tokenizer) that fails it falls
+    back to tokenizing whole prompts.
+
+    Responses are decoded from the generated ids after the prompt instead
+    of searching the decoded prompt for the response marker.
+    """
+
+    _PROBES = (("请问加班工资怎么算？", None), (" What is theft? ", "A took B's phone.\n"), ("", None))
+
+    def __init__(self, prompter: Prompter, tokenizer):
+        self.prompter = prompter
+        self.tokenizer = tokenizer
+        self.marker = prompter.template["response_split"]
+        self._newline = tokenizer("\n", add_special_tokens=False)["input_ids"]
+        self._pieces = {}
+        for key in _TEMPLATE_KEYS:
+            pieces = prompter.pieces(key)
+            ids = [tokenizer(pieces[0][0])["input_ids"]]
+            ids += self._continuation([literal for literal, _ in pieces[1:]])
+            self._pieces[key] = [(literal_ids, field) for literal_ids, (_, field) in zip(ids, pieces)]
+        self.exact = all(self._splittable(prompter.pieces(key)) for key in _TEMPLATE_KEYS)
+        if self.exact:
+            instructions, inputs = zip(*self._PROBES)
+            self.exact = self.encode_batch(instructions, inputs) == [
+                tokenizer(prompter.generate_prompt(i, x))["input_ids"] for i, x in self._PROBES
+            ]
+
+    @staticmethod
+    def _splittable(pieces):
+        for (literal, field), (following, next_field) in zip(pieces, pieces[1:] + [("", None)]):
+            if field is None:
+                continue
+            if not literal.endswith("\n"):
+                return False
+            if not following.startswith("\n") and (following or next_field is not None):
+                return False
+        return True
+
+    def _continuation(self, texts):
+        # ids of texts as they tokenize after a newline
+        if not texts:
+            return []
+        n = len(self._newline)
+        return [
+            ids[n:] if ids[:n] == self._newline else ids
+            for ids in self.tokenizer(["\n" + text for text in texts], add_special_tokens=False)["input_ids"]
+        ]
+
+    def encode(self, instruction: str, input: Optional[str] = None) -> List[int]:
+        return self.encode_batch([instruction], [input])[0]
+
+    def encode_batch(self, instructions: Sequence[str], inputs: Optional[Sequence[Optional[str]]] = None):
+        """Prompt ids, BOS included, for each instruction and optional input."""
+        inputs = list(inputs) if inputs is not None else [None] * len(instructions)
+        if not self.exact:
+            prompts = [self.prompter.generate_prompt(i, x) for i, x in zip(instructions, inputs)]
+            return self.tokenizer(prompts)["input_ids"] if prompts else []
+        values = {
+            "instruction": iter(self._continuation([str(i) for i in instructions])),
+            "input": iter(self._continuation([str(x) for x in inputs if x])),
+        }
+        batch = []
+        for input in inputs:
+            ids = []
+            for literal_ids, field in self._pieces["prompt_input" if input else "prompt_no_input"]:
+                ids += literal_ids
+                if field is not None:
+                    ids += next(values[field])
+            batch.append(ids)
+        return batch
+
+    def decode_response(self, ids, prompt_length: int = 0) -> str:
+        """The answer in generated `ids` after the first `prompt_length` (the prompt)."""
+        return self.answer(self.tokenizer.decode(ids[prompt_length:], skip_special_tokens=True))
+
+    def answer(self, text: str) -> str:
+        """Generated text up to a repeated response marker, where a model goes on to a new turn."""
+        return text.partition(self.marker)[0].strip()
@@ -0,0 +1,226 @@
+"""
+Weight-only int8 / int4 quantization for CPU inference.
+
+bitsandbytes' `load_in_8bit` needs CUDA, so on CPU a 7B model used to run
+with ~28 GB of fp32 weights. Here every linear layer of the decoder keeps
+its weight as int8 with one scale per output row, or as packed int4 with a
+scale and minimum per group of `group_size` input columns, and
+QuantizedLinear dequantizes on the fly inside the matmul. int8 uses
+PyTorch's fused `_weight_int8pack_mm` CPU kernel when the installed version
+has it. Embeddings, norms and `lm_head` stay in floating point: they are a
+small share of a 7B model and the most sensitive to rounding.
+
+`quantize_checkpoint` converts a merged checkpoint (merge.py output) shard by
+shard into safetensors plus `quantization.json`; `load_quantized` memory-maps
+it back like utils.loader does for plain checkpoints. `quantize_model` does
+the same to an already loaded model.
+
+    python -m utils.quantize --model_dir=./models/base_models/legal_base-7b \
+        --output_dir=./models/base_models/legal_base-7b-int4 --bits=4
+"""
+
+import json
+import os
+import shutil
+import time
+
+import torch
+import torch.nn.functional as F
+
+from utils.lora_merge import ShardWriter, _COPIED_FILES, _load_file, base_weight_files
+from utils.loader import mmap_safetensors
+
+QUANT_FILE = "quantization.json"
+SKIP_MODULES = ("embed_tokens", "lm_head")
+# output rows dequantized at a time, bounding the float copy of a weight
+_CHUNK_ROWS = 1024
+_INT8_MM = hasattr(torch.ops.aten, "_weight_int8pack_mm")
+
+
+def quantize_weight(weight: torch.Tensor, bits: int, group_size: int = 128):
+    """
+    Quantized tensors of a 2D weight: `qweight` and `scales` for int8 (per
+    output row, symmetric), plus `mins` for int4 (per group, asymmetric,
+    two values packed per byte).
+    """
+    weight = weight.float()
+    if bits == 8:
+        scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        qweight = torch.round(weight / scales[:, None]).clamp(-127, 127).to(torch.int8)
+        return {"qweight": qweight, "scales": scales}
+    if bits != 4:
+        raise ValueError(f"Only 8 and 4 bit quantization is supported, not {bits}")
+    rows, columns = weight.shape
+    groups = weight.reshape(rows, columns // group_size, group_size)
+    mins = groups.amin(dim=2)
+    scales = ((groups.amax(dim=2) - mins) / 15).clamp(min=1e-8)
+    q = torch.round((groups - mins[..., None]) / scales[..., None]).clamp(0, 15).to(torch.uint8)
+    q = q.view(rows, columns // 2, 2)
+    return {"qweight": q[..., 0] | (q[..., 1] << 4), "scales": scales, "mins": mins}
+
+
+def can_quantize(name: str, shape, bits: int, group_size: int) -> bool:
+    if len(shape) != 2 or any(skip in name.split(".") for skip in SKIP_MODULES):
+        return False
+    return bits == 8 or shape[1] % group_size == 0
+
+
+class QuantizedLinear(torch.nn.Module):
+    def __init__(self, in_features, out_features, bits, group_size=128, bias=False, device=None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size if bits == 4 else in_features
+        groups = in_features // self.group_size
+        if bits == 8:
+            self.register_buffer("qweight", torch.empty(out_features, in_features, dtype=torch.int8, device=device))
+            self.register_buffer("scales", torch.empty(out_features, device=device))
+        else:
+            self.register_buffer("qweight", torch.empty(out_features, in_features // 2, dtype=torch.uint8, device=device))
+            self.register_buffer("scales", torch.empty(out_features, groups, device=device))
+            self.register_buffer("mins", torch.empty(out_features, groups, device=device))
+        self.bias = torch.nn.Parameter(torch.empty(out_features, device=device)) if bias else None
+
+    @classmethod
+    def from_linear(cls, linear: torch.nn.Linear, bits: int, group_size: int = 128):
+        module = cls(linear.in_features, linear.out_features, bits, group_size, linear.bias is not None)
+        for name, tensor in quantize_weight(linear.weight.data, bits, group_size).items():
+            setattr(module, name, tensor)
+        if linear.bias is not None:
+            module.bias = torch.nn.Parameter(linear.bias.data, requires_grad=False)
+        return module
+
+    def dequantize(self, dtype=torch.float32, rows=slice(None)):
+        qweight = self.qweight[rows]
+        if self.bits == 8:
+            return qweight.to(dtype) * self.scales[rows, None].to(dtype)
+        q = torch.stack((qweight & 15, qweight >> 4), dim=-1)
+        q = q.view(q.shape[0], -1, self.group_size).to(dtype)
+        weight = q * self.scales[rows, :, None].to(dtype) + self.mins[rows, :, None].to(dtype)
+        return weight.view(q.shape[0], self.in_features)
+
+    def forward(self, x):
+        if self.bits == 8 and _INT8_MM and x.dtype in (torch.float32, torch.bfloat16):
+            flat = x.reshape(-1, self.in_features).contiguous()
+            out = torch.ops.aten._weight_int8pack_mm(flat, self.qweight, self.scales.to(x.dtype))
+            out = out.view(*x.shape[:-1], self.out_features)
+        else:
+            chunks = [
+                F.linear(x, self.dequantize(x.dtype, slice(start, start + _CHUNK_ROWS)))
+                for start in range(0, self.out_features, _CHUNK_ROWS)
+            ]
+            out = chunks[0] if len(chunks) == 1 else torch.cat(chunks, dim=-1)
+        return out if self.bias is None else out + self.bias.to(x.dtype)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}, group_size={self.group_size}"
+
+
+def _parent(model, name):
+    module_name, _, child = name.rpartition(".")
+    return model.get_submodule(module_name) if module_name else model, child
+
+
+def quantize_model(model, bits: int, group_size: int = 128):
+    """Replaces the linear layers of a loaded model in place. Returns the quantized module names."""
+    names = [
+        name for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear)
+        and can_quantize(name + ".weight", module.weight.shape, bits, group_size)
+    ]
+    for name in names:
+        parent, child = _parent(model, name)
+        setattr(parent, child, QuantizedLinear.from_linear(getattr(parent, child), bits, group_size))
+    return names
+
+
+def quantize_checkpoint(model_dir: str, output_dir: str, bits: int = 8, group_size: int = 128, max_shard_mb: int = 2048):
+    """
+    Quantizes a local checkpoint tensor by tensor into `output_dir`, with the
+    config and tokenizer files, and writes `quantization.json` so loader.py
+    recognises it.
+    """
+    start = time.perf_counter()
+    files = base_weight_files(model_dir)
+    if not files:
+        raise ValueError(f"No *.safetensors or pytorch_model*.bin weights in {model_dir}")
+    os.makedirs(output_dir, exist_ok=True)
+    writer = ShardWriter(output_dir, max_shard_mb * 2**20)
+    modules = []
+    for path in files:
+        for name, tensor in _load_file(path).items():
+            if name.endswith(".weight") and can_quantize(name, tensor.shape, bits, group_size):
+                module = name[: -len(".weight")]
+                for suffix, quantized in quantize_weight(tensor, bits, group_size).items():
+                    writer.add(f"{module}.{suffix}", quantized)
+                modules.append(module)
+            else:
+                writer.add(name, tensor)
+    writer.close()
+
+    with open(os.path.join(output_dir, QUANT_FILE), "w") as f:
+        json.dump({"bits": bits, "group_size": group_size, "modules": modules}, f, indent=2)
+    for name in ("config.json",) + _COPIED_FILES:
+        if os.path.exists(os.path.join(model_dir, name)):
+            shutil.copy(os.path.join(model_dir, name), os.path.join(output_dir, name))
+    print(
+        f"Quantized {len(modules)} weights to int{bits}, "
+        f"{writer.total_size / 2**30:.2f} GiB in {time.perf_counter() - start:.1f}s"
+    )
+    return modules
+
+
+def is_quantized(model_dir: str) -> bool:
+    return os.path.isfile(os.path.join(model_dir, QUANT_FILE))
+
+
+def load_quantized(model_dir: str, dtype=torch.float32):
+    """
+    A LlamaForCausalLM from `quantize_checkpoint` output. Quantized tensors
+    stay memory-mapped; the remaining float weights are converted to `dtype`.
+    """
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig, LlamaForCausalLM
+
+    with open(os.path.join(model_dir, QUANT_FILE)) as f:
+        spec = json.load(f)
+    config = AutoConfig.from_pretrained(model_dir)
+    with init_empty_weights():
+        model = LlamaForCausalLM(config)
+    for name in spec["modules"]:
+        parent, child = _parent(model, name)
+        linear = getattr(parent, child)
+        setattr(
+            parent,
+            child,
+            QuantizedLinear(
+                linear.in_features, linear.out_features, spec["bits"], spec["group_size"],
+                bias=linear.bias is not None, device="meta",
+            ),
+        )
+
+    state_dict = {}
+    for path in sorted(f for f in os.listdir(model_dir) if f.endswith(".safetensors")):
+        for name, tensor in mmap_safetensors(os.path.join(model_dir, path)).items():
+            if tensor.is_floating_point() and not name.endswith((".scales", ".mins")):
+                tensor = tensor.to(dtype)
+            state_dict[name] = tensor
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+    missing = [n for n, t in list(model.named_parameters()) + list(model.named_buffers()) if t.device.type == "meta"]
+    if missing:
+        raise ValueError(f"{model_dir} has no weights for {missing[:5]}...")
+    return model
+
+
+def weight_bytes(model) -> int:
+    """Bytes held by the parameters and buffers of a model."""
+    tensors = {id(t): t for t in list(model.parameters()) + list(model.buffers())}
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire(quantize_checkpoint)
@@ -0,0 +1,247 @@
+"""
+Draft proposers for speculative decoding in utils.engine.
+
+A drafter guesses the next few tokens of a greedy request; the engine feeds
+them to the main model in a single forward pass and keeps the longest
+prefix the model agrees with, plus the model's own next token. Output is
+identical to plain greedy decoding, only the number of main-model forwards
+changes.
+
+- PromptLookupDrafter copies the continuation of the latest earlier
+  occurrence of the current n-gram suffix. Free to run, and effective here
+  because answers often quote statute text from the question.
+- CorpusDrafter continues known text (statutes, provisions, charge names)
+  once the answer starts quoting it, with drafts long enough to cover a
+  whole clause.
+- ModelDrafter runs a small causal LM that shares the main tokenizer.
+
+Each drafter caps its own draft length; the engine's `num_draft_tokens`
+is an upper bound on top.
+"""
+
+import glob
+import json
+
+import torch
+
+from utils.engine import _from_legacy, _slice_past, _to_legacy
+
+
+class PromptLookupDrafter:
+    def __init__(self, num_tokens: int = 8, max_ngram: int = 3, min_ngram: int = 1):
+        self.num_tokens = num_tokens
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+
+    def propose(self, token_ids, num_tokens):
+        """Up to `num_tokens` draft ids continuing `token_ids`, maybe none."""
+        num_tokens = min(num_tokens, self.num_tokens)
+        length = len(token_ids)
+        for n in range(min(self.max_ngram, length - 1), self.min_ngram - 1, -1):
+            suffix = token_ids[-n:]
+            # latest earlier occurrence first: recent text predicts best
+            for start in range(length - n - 1, -1, -1):
+                if token_ids[start:start + n] == suffix:
+                    return list(token_ids[start + n:start + n + num_tokens])
+        return []
+
+
+class ModelDrafter:
+
+    """
+    Greedy drafts from a small model. Its KV cache is kept between calls and
+    cut back to the common prefix with the new context, so each call only
+    prefills the tokens the main model accepted since the last one.
+    """
+
+    def __init__(self, model, device="cpu", num_tokens: int = 8):
+        self.model = model
+        self.device = device
+        self.num_tokens = num_tokens
+        self.cached_ids = []
+        self.past_key_values = None
+
+    @torch.no_grad()
+    def propose(self, token_ids, num_tokens):
+        num_tokens = min(num_tokens, self.num_tokens)
+        if num_tokens <= 0:
+            return []
+        common = 0
+        for a, b in zip(self.cached_ids, token_ids):
+            if a != b:
+                break
+            common += 1
+        # the last context token must be fed again to get its logits
+        common = min(common, len(token_ids) - 1)
+        past = None
+        if common and self.past_key_values is not None:
+            past = _from_legacy(_slice_past(self.past_key_values, common))
+        else:
+            common = 0
+        input_ids = torch.tensor([token_ids[common:]], device=self.device)
+        draft = []
+        for _ in range(num_tokens):
+            out = self.model(input_ids=input_ids, past_key_values=past, use_cache=True)
+            past = out.past_key_values
+            token = int(out.logits[0, -1].argmax())
+            draft.append(token)
+            input_ids = torch.tensor([[token]], device=self.device)
+        # the cache now covers the context plus all drafts but the last
+        self.cached_ids = list(token_ids) + draft[:-1]
+        self.past_key_values = _to_legacy(past)
+        return draft
+
+
+class CorpusDrafter:
+
+    """
+    Drafts from a fixed corpus indexed by n-gram.
+
+    Documents are tokenized once into a flat token tensor (separated by -1)
+    and every n-gram position is stored under a hash in a sorted tensor, so
+    the index costs 16 bytes per corpus token. A lookup hashes the last
+    `ngram` context tokens, extends each candidate match backwards, and
+    drafts what follows the longest one if it covers `min_match` tokens,
+    stopping at the end of its document.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        texts,
+        num_tokens: int = 32,
+        ngram: int = 3,
+        min_match: int = 5,
+        max_candidates: int = 64,
+    ):
+        self.num_tokens = num_tokens
+        self.ngram = ngram
+        self.min_match = min_match
+        self.max_candidates = max_candidates
+        flat = []
+        for ids in tokenizer(list(texts), add_special_tokens=False)["input_ids"]:
+            flat.extend(ids)
+            flat.append(-1)
+        self.token_list = flat
+        tokens = torch.tensor(flat, dtype=torch.long)
+        if len(flat) < ngram:
+            self.keys = self.positions = tokens.new_empty(0)
+            return
+        windows = tokens.unfold(0, ngram, 1)
+        valid = (windows >= 0).all(dim=1)
+        self.keys, order = torch.sort(self._hash(windows[valid]), stable=True)
+        # index of the token right after each n-gram
+        self.positions = (torch.nonzero(valid).squeeze(1) + ngram)[order]
+        print(f"Indexed {len(flat)} statute corpus tokens for drafting")
+
+    @staticmethod
+    def _hash(windows):
+        # int64 arithmetic wraps, which is fine for a hash
+        keys = torch.zeros(windows.shape[0], dtype=torch.long)
+        for column in windows.unbind(dim=1):
+            keys = keys * 1000003 + column
+        return keys
+
+    def _match_length(self, position, token_ids):
+        n = 0
+        limit = min(len(token_ids), position, 64)
+        while n < limit:
+            token = self.token_list[position - 1 - n]
+            if token < 0 or token != token_ids[-1 - n]:
+                break
+            n += 1
+        return n
+
+    def propose(self, token_ids, num_tokens):
+        num_tokens = min(num_tokens, self.num_tokens)
+        if num_tokens <= 0 or len(token_ids) < self.ngram or not len(self.keys):
+            return []
+        key = self._hash(torch.tensor([token_ids[-self.ngram:]]))
+        lo = int(torch.searchsorted(self.keys, key))
+        hi = int(torch.searchsorted(self.keys, key, right=True))
+        best, best_length = None, self.min_match - 1
+        for position in self.positions[lo:min(hi, lo + self.max_candidates)].tolist():
+            length = self._match_length(position, token_ids)
+            if length > best_length:
+                best, best_length = position, length
+        if best is None:
+            return []
+        draft = []
+        for token in self.token_list[best:best + num_tokens]:
+            if token < 0:
+                break
+            draft.append(token)
+        return draft
+
+
+def load_statute_texts(
+    law_files: str = "",
+    charges_path: str = "resources/criminal_charges.json",
+    provisions=None,
+):
+    """
+    Statute texts for CorpusDrafter: law articles from markdown files matched
+    by the `law_files` glob (parsed with tools/clear_law.py), criminal charge
+    names, and optionally a `{category: [{"title", "provision", "article"}]}`
+    dict such as webapp.US_LEGAL_PROVISIONS.
+    """
+    texts = []
+    if law_files:
+        from tools.clear_law import read_lawfile
+
+        for path in sorted(glob.glob(law_files, recursive=True)):
+            for entries in read_lawfile().read_file(path).values():
+                texts.extend(f"{entry} {text.strip()}" for entry, text in entries.items())
+    if charges_path:
+        with open(charges_path, encoding="utf-8") as f:
+            for charge in json.load(f):
+                texts.append(f"{charge['chapter']} {charge['charge']}")
+    for items in (provisions or {}).values():
+        for item in items:
+            texts.append(f"{item['title']} ({item['article']}): {item['provision']}")
+    return texts
+
+
+class ChainDrafter:
+    """Asks each drafter in turn and uses the first non-empty draft."""
+
+    def __init__(self, drafters):
+        self.drafters = list(drafters)
+
+    def propose(self, token_ids, num_tokens):
+        for drafter in self.drafters:
+            draft = drafter.propose(token_ids, num_tokens)
+            if draft:
+                return draft
+        return []
+
+
+def load_draft_model(draft_model: str, device: str = "cpu"):
+    from transformers import AutoModelForCausalLM
+
+    kwargs = {"torch_dtype": torch.float16} if device != "cpu" else {}
+    model = AutoModelForCausalLM.from_pretrained(draft_model, **kwargs)
+    return model.to(device).eval()
+
+
+def build_drafter(
+    draft_model: str = "",
+    prompt_lookup: bool = False,
+    device: str = "cpu",
+    tokenizer=None,
+    statute_texts=None,
+):
+    """
+    Drafter for the entry points' --draft_model/--prompt_lookup/--statute_lookup
+    flags, or None. Corpus drafts come first since they are the longest.
+    """
+    drafters = []
+    if statute_texts:
+        drafters.append(CorpusDrafter(tokenizer, statute_texts))
+    if prompt_lookup:
+        drafters.append(PromptLookupDrafter())
+    if draft_model:
+        drafters.append(ModelDrafter(load_draft_model(draft_model, device), device))
+    if not drafters:
+        return None
+    return drafters[0] if len(drafters) == 1 else ChainDrafter(drafters)
@@ -0,0 +1,154 @@
+"""
+Streaming training input for corpora larger than host memory.
+
+Records are read lazily with `load_dataset(..., streaming=True)` (JSON Lines
+streams best), passed through a seeded shuffle buffer and handed to the
+DataLoader untokenized; StreamingCollator tokenizes each batch inside the
+DataLoader worker processes, in the background of the training loop. Each
+worker reads its own interleaved slice of the stream, and the Trainer
+splits batches across DDP ranks, so every rank trains on different data
+and nothing is tokenized twice. The stream repeats with a new shuffle seed
+per pass, so training length is set with `max_steps`.
+
+The first `holdout` records are reserved for evaluation. Position is saved
+to `stream_state.json` in every checkpoint by StreamStateCallback; on
+resume the dataset skips the records already trained on before
+tokenization, which only costs reading them, and the Trainer is told not to
+replay batches itself (`ignore_data_skip`).
+"""
+
+import itertools
+import json
+import os
+import random
+
+import torch
+import transformers
+from datasets import load_dataset
+
+STATE_FILE = "stream_state.json"
+
+
+def _stream_files(data_path: str):
+    if data_path.endswith(".json") or data_path.endswith(".jsonl"):
+        return load_dataset("json", data_files=data_path, split="train", streaming=True)
+    return load_dataset(data_path, split="train", streaming=True)
+
+
+def _shuffled(records, buffer_size: int, rng: random.Random):
+    buffer = []
+    for record in records:
+        if len(buffer) < buffer_size:
+            buffer.append(record)
+            continue
+        index = rng.randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = record
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class StreamingDataset(torch.utils.data.IterableDataset):
+    def __init__(
+        self,
+        data_path: str,
+        buffer_size: int = 10000,
+        seed: int = 42,
+        holdout: int = 0,
+    ):
+        self.data_path = data_path
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.holdout = holdout
+        self.skip_batches = 0
+        self.batch_size = 1
+
+    def heldout(self):
+        """The first `holdout` records, for an evaluation set."""
+        return list(itertools.islice(_stream_files(self.data_path), self.holdout))
+
+    def resume(self, state: dict):
+        """Continue after the `batches` DataLoader batches of `batch_size` in `state`."""
+        self.skip_batches = state["batches"]
+        self.batch_size = state["batch_size"]
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        num_workers, worker_id = (worker.num_workers, worker.id) if worker else (1, 0)
+        # the DataLoader takes batches from its workers in turn
+        own_batches = max(0, -(-(self.skip_batches - worker_id) // num_workers))
+        skip = own_batches * self.batch_size
+        for epoch in itertools.count():
+            rng = random.Random(f"{self.seed}-{epoch}-{worker_id}")
+            records = itertools.islice(
+                _stream_files(self.data_path), self.holdout + worker_id, None, num_workers
+            )
+            empty = True
+            for record in _shuffled(records, self.buffer_size, rng):
+                empty = False
+                if skip:
+                    skip -= 1
+                    continue
+                yield record
+            if empty:
+                return
+
+
+class StreamingCollator:
+
+    """
+    Tokenizes raw records and pads them with `collator`. `tokenize_fn` takes
+    one record, or a dict of columns when `batched`, and returns
+    `input_ids`, `attention_mask` and `labels`.
+    """
+
+    def __init__(self, tokenize_fn, collator, batched: bool = False):
+        self.tokenize_fn = tokenize_fn
+        self.collator = collator
+        self.batched = batched
+
+    def __call__(self, records):
+        if self.batched:
+            columns = {key: [record[key] for record in records] for key in records[0]}
+            result = self.tokenize_fn(columns)
+            features = [dict(zip(result, values)) for values in zip(*result.values())]
+        else:
+            features = [self.tokenize_fn(record) for record in records]
+        return self.collator(
+            [
+                {key: f[key] for key in ("input_ids", "attention_mask", "labels")}
+                for f in features
+            ]
+        )
+
+
+class StreamStateCallback(transformers.TrainerCallback):
+
+    """
+    Writes the stream position into each checkpoint. Batches are counted the
+    way rank 0's DataLoader serves them when the Trainer dispatches global
+    batches to the other ranks (the default for iterable datasets).
+    """
+
+    def on_save(self, args, state, control, **kwargs):
+        if not state.is_world_process_zero:
+            return
+        checkpoint = os.path.join(args.output_dir, f"checkpoint-{state.global_step}")
+        with open(os.path.join(checkpoint, STATE_FILE), "w") as f:
+            json.dump(
+                {
+                    "batches": state.global_step * args.gradient_accumulation_steps * args.world_size,
+                    "batch_size": args.per_device_train_batch_size,
+                    "global_step": state.global_step,
+                },
+                f,
+            )
+
+
+def load_stream_state(checkpoint):
+    """The saved stream position of a checkpoint directory, or None."""
+    path = os.path.join(checkpoint or "", STATE_FILE)
+    if not checkpoint or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
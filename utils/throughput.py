@@ -0,0 +1,189 @@
+"""
+Training throughput and memory instrumentation shared by finetune.py and
+train_clm.py, without wandb.
+
+ThroughputCallback times every optimizer step on the main process, split
+into data wait (from the end of the previous micro step to the start of the
+next forward, which covers fetching and collating the batch), forward,
+backward and optimizer, and counts real (attention mask) and padded tokens.
+Forward is timed with hooks on the model and the rest from Trainer
+callbacks; on CUDA each mark synchronizes the device so the split is
+accurate. Transformers versions without `on_pre_optimizer_step` report the
+optimizer time as part of backward.
+
+Each step becomes a row of a JSONL (or CSV, by file suffix) log in the
+output directory, and a summary is printed and written next to it at the
+end of training.
+"""
+
+import csv
+import json
+import os
+import time
+
+import torch
+import transformers
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+_TIMES = ("data_wait", "forward", "backward", "optimizer")
+
+
+def _peak_memory_mb():
+    if torch.cuda.is_available():
+        peak = torch.cuda.max_memory_allocated() / 2**20
+        torch.cuda.reset_peak_memory_stats()
+        return peak
+    if resource is not None:
+        # peak resident set size of the process, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return 0.0
+
+
+class ThroughputCallback(transformers.TrainerCallback):
+    def __init__(self, path: str):
+        self.path = path
+        self.enabled = False
+        self.handles = []
+        self.totals = {}
+
+    def _now(self):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _new_step(self):
+        self.step = {name: 0.0 for name in _TIMES}
+        self.step.update(real_tokens=0, padded_tokens=0, optimizer_marked=False)
+        self.step_start = self.mark
+
+    def _forward_start(self, module, args, kwargs):
+        if not module.training:
+            return
+        now = self._now()
+        self.step["data_wait"] += now - self.mark
+        self.mark = now
+        input_ids = kwargs.get("input_ids", args[0] if args else None)
+        mask = kwargs.get("attention_mask")
+        if input_ids is not None:
+            padded = input_ids.numel()
+            # packed batches pass a 4D mask and have no padding
+            real = int(mask.sum()) if mask is not None and mask.dim() == 2 else padded
+            self.step["padded_tokens"] += padded
+            self.step["real_tokens"] += real
+
+    def _forward_end(self, module, args, output):
+        if not module.training:
+            return
+        now = self._now()
+        self.step["forward"] += now - self.mark
+        self.mark = now
+
+    def _backward_end(self):
+        now = self._now()
+        self.step["backward"] += now - self.mark
+        self.mark = now
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        self.enabled = state.is_world_process_zero and model is not None
+        if not self.enabled:
+            return
+        path = os.path.join(args.output_dir, self.path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, "a", newline="")
+        self.writer = None
+        self.handles = [
+            model.register_forward_pre_hook(self._forward_start, with_kwargs=True),
+            model.register_forward_hook(self._forward_end),
+        ]
+        self.totals = {name: 0.0 for name in _TIMES + ("step_time",)}
+        self.totals.update(steps=0, real_tokens=0, padded_tokens=0, peak_memory_mb=0.0)
+        _peak_memory_mb()
+        self.mark = self._now()
+        self._new_step()
+
+    def on_substep_end(self, args, state, control, **kwargs):
+        if self.enabled:
+            self._backward_end()
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        if self.enabled:
+            self._backward_end()
+            self.step["optimizer_marked"] = True
+
+    def on_step_end(self, args, state, control, **kwargs):
+        if not self.enabled:
+            return
+        now = self._now()
+        self.step["optimizer" if self.step["optimizer_marked"] else "backward"] += now - self.mark
+        self.mark = now
+        step_time = now - self.step_start
+        row = {"step": state.global_step, "step_time": round(step_time, 4)}
+        row.update({name: round(self.step[name], 4) for name in _TIMES})
+        row.update(
+            real_tokens=self.step["real_tokens"],
+            padded_tokens=self.step["padded_tokens"],
+            padding=round(1 - self.step["real_tokens"] / max(self.step["padded_tokens"], 1), 4),
+            tokens_per_sec=round(self.step["real_tokens"] / max(step_time, 1e-9), 1),
+            peak_memory_mb=round(_peak_memory_mb(), 1),
+        )
+        self._write(row)
+        for name in _TIMES + ("step_time", "real_tokens", "padded_tokens"):
+            self.totals[name] += row[name]
+        self.totals["steps"] += 1
+        self.totals["peak_memory_mb"] = max(self.totals["peak_memory_mb"], row["peak_memory_mb"])
+        self._new_step()
+
+    def _write(self, row):
+        if self.path.endswith(".csv"):
+            if self.writer is None:
+                self.writer = csv.DictWriter(self.file, fieldnames=list(row))
+                if self.file.tell() == 0:
+                    self.writer.writeheader()
+            self.writer.writerow(row)
+        else:
+            self.file.write(json.dumps(row) + "\n")
+        self.file.flush()
+
+    def _skip_pause(self, *args, **kwargs):
+        # evaluation, saving and logging between steps are not data wait
+        if self.enabled:
+            self.mark = self._now()
+            self.step_start = self.mark
+
+    on_evaluate = on_save = on_log = _skip_pause
+
+    def summary(self):
+        totals = self.totals
+        elapsed = max(totals.get("step_time", 0.0), 1e-9)
+        return {
+            "steps": totals.get("steps", 0),
+            "mean_step_time": round(elapsed / max(totals.get("steps", 0), 1), 4),
+            "real_tokens_per_sec": round(totals.get("real_tokens", 0) / elapsed, 1),
+            "padded_tokens_per_sec": round(totals.get("padded_tokens", 0) / elapsed, 1),
+            "padding": round(1 - totals.get("real_tokens", 0) / max(totals.get("padded_tokens", 0), 1), 4),
+            **{f"{name}_share": round(totals.get(name, 0.0) / elapsed, 4) for name in _TIMES},
+            "peak_memory_mb": totals.get("peak_memory_mb", 0.0),
+        }
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if not self.enabled:
+            return
+        for handle in self.handles:
+            handle.remove()
+        self.file.close()
+        summary = self.summary()
+        path = os.path.splitext(os.path.join(args.output_dir, self.path))[0] + "_summary.json"
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(
+            f"Throughput over {summary['steps']} steps (main process): "
+            f"{summary['real_tokens_per_sec']} real tokens/sec, {summary['padding']:.1%} padding, "
+            f"{summary['mean_step_time']}s/step "
+            + ", ".join(f"{name} {summary[name + '_share']:.0%}" for name in _TIMES)
+            + f", peak memory {summary['peak_memory_mb']} MiB"
+        )
+        self.enabled = False
@@ -0,0 +1,69 @@
+"""
+Batched tokenization of instruction data for finetune.py.
+
+Each example's user prompt (template + instruction + input) and its response
+are tokenized once each, over the whole batch in two tokenizer calls, and
+concatenated. The user prompt length then gives the masked label prefix
+directly, where the per-example path used to tokenize the full prompt and
+the user prompt separately. Labels are built from one padded id matrix per
+batch.
+
+The response is tokenized behind a newline that is stripped again, because
+both templates end the prompt with one: that way sentencepiece sees the same
+context at the boundary as when tokenizing prompt and response together, and
+the ids match the joint tokenization.
+"""
+
+import itertools
+
+import numpy as np
+
+
+def tokenize_instructions(batch, tokenizer, prompter, cutoff_len: int, train_on_inputs: bool = True):
+    """
+    `datasets.map(batched=True)` function: `input_ids`, `attention_mask` and
+    `labels` for a batch of instruction/input/output rows, truncated to
+    `cutoff_len` with EOS appended when there is room, plus `label_start`,
+    the number of masked prompt tokens.
+    """
+    user_prompts = [
+        prompter.generate_prompt(instruction, input)
+        for instruction, input in zip(batch["instruction"], batch["input"])
+    ]
+    prompt_ids = tokenizer(user_prompts)["input_ids"]
+    newline = tokenizer("\n", add_special_tokens=False)["input_ids"]
+    response_ids = tokenizer(
+        ["\n" + output for output in batch["output"]], add_special_tokens=False
+    )["input_ids"]
+    response_ids = [
+        ids[len(newline):] if ids[:len(newline)] == newline else ids for ids in response_ids
+    ]
+
+    eos = tokenizer.eos_token_id
+    input_ids = []
+    for prompt, response in zip(prompt_ids, response_ids):
+        ids = (prompt + response)[:cutoff_len]
+        if len(ids) < cutoff_len and (not ids or ids[-1] != eos):
+            ids.append(eos)
+        input_ids.append(ids)
+
+    lengths = np.fromiter(map(len, input_ids), dtype=np.int64, count=len(input_ids))
+    if train_on_inputs:
+        label_start = np.zeros_like(lengths)
+    else:
+        prompt_lengths = np.fromiter(map(len, prompt_ids), dtype=np.int64, count=len(prompt_ids))
+        label_start = np.minimum(prompt_lengths, lengths)
+
+    columns = np.arange(int(lengths.max(initial=0)))
+    valid = columns < lengths[:, None]
+    labels = np.full(valid.shape, -100, dtype=np.int64)
+    labels[valid] = np.fromiter(
+        itertools.chain.from_iterable(input_ids), dtype=np.int64, count=int(lengths.sum())
+    )
+    labels[columns < label_start[:, None]] = -100
+    return {
+        "input_ids": input_ids,
+        "attention_mask": [[1] * n for n in lengths.tolist()],
+        "labels": [row[:n].tolist() for row, n in zip(labels, lengths.tolist())],
+        "label_start": label_start.tolist(),
+    }
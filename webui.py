@@ -1,35 +1,43 @@
 import os
-import sys
 
 import fire
 import gradio as gr
 import torch
-import transformers
-from peft import PeftModel
-from transformers import GenerationConfig, LlamaForCausalLM, LlamaTokenizer, AutoModel, AutoTokenizer, AutoModelForCausalLM
+from transformers import GenerationConfig
 
-from utils.callbacks import Iteratorize, Stream
+from utils.adapters import AdapterManager
+from utils.cache import ResponseCache, normalize_instruction
+from utils.callbacks import GenerationExecutor, StreamDetokenizer, stream_beam_search
+from utils.engine import GenerationEngine, gradio_queue_kwargs
+from utils.loader import get_device, load_model
 from utils.prompter import Prompter
+from utils.speculative import build_drafter, load_statute_texts
 
-if torch.cuda.is_available():
-    device = "cuda"
-else:
-    device = "cpu"
-
-try:
-    if torch.backends.mps.is_available():
-        device = "mps"
-except: 
-    pass
+device = get_device()
 
 
 def main(
     load_8bit: bool = False,
+    quantize: str = "",  # "int8" or "int4" weight-only quantization for CPU inference
+    cpu_dtype: str = "auto",  # "bfloat16" or "float32" on CPU; auto picks bf16 where the CPU supports it
+    autotune: bool = False,  # time a short decode per CPU dtype on first start and cache the fastest
+    num_threads: int = 0,  # torch threads on CPU, 0 = physical cores
     base_model: str = "",
     lora_weights: str = "",
     prompt_template: str = "",  # The prompt template to use, will default to alpaca.
     server_name: str = "0.0.0.0",  # Allows to listen on all interfaces by providing '0.
     share_gradio: bool = False,
+    max_batch_size: int = 8,  # concurrent requests sharing one decode batch
+    stream_workers: int = 0,  # threads feeding streamed answers to their buffers, 0 = max_batch_size
+    cache_size: int = 1024,  # in-memory cached answers, 0 disables
+    cache_ttl: float = 3600,  # seconds
+    cache_db: str = "",  # optional SQLite file so the cache survives restarts
+    adapters: dict = None,  # extra LoRA adapters served by name, e.g. '{"v2": "entity303/lawgpt-lora-7b-v2"}'
+    adapter_budget_mb: float = 0,  # LRU-evict adapters above this size, 0 = unlimited
+    draft_model: str = "",  # small model sharing the tokenizer, for speculative decoding
+    prompt_lookup: bool = False,  # draft by copying n-gram continuations from the context
+    statute_lookup: bool = False,  # draft quotes of statutes and charge names
+    law_files: str = "",  # glob of law .md files (tools/clear_law.py format) to quote from
 ):
     base_model = base_model or os.environ.get("BASE_MODEL", "")
     assert (
@@ -37,61 +45,33 @@ def main(
     ), "Please specify a --base_model, e.g. --base_model='huggyllama/llama-7b'"
 
     prompter = Prompter(prompt_template)
-    tokenizer = LlamaTokenizer.from_pretrained(base_model)
-    if device == "cuda":
-        model = LlamaForCausalLM.from_pretrained(
-            base_model,
-            load_in_8bit=load_8bit,
-            torch_dtype=torch.float16,
-            device_map="auto",
-        )
-        try:
-            model = PeftModel.from_pretrained(
-                model,
-                lora_weights,
-                torch_dtype=torch.float16,
-            )
-        except:
-            print("*"*50, "\n Attention! No Lora Weights \n", "*"*50)
-    elif device == "mps":
-        model = LlamaForCausalLM.from_pretrained(
-            base_model,
-            device_map={"": device},
-            torch_dtype=torch.float16,
-        )
-        try:
-            model = PeftModel.from_pretrained(
-                model,
-                lora_weights,
-                device_map={"": device},
-                torch_dtype=torch.float16,
-            )
-        except:
-            print("*"*50, "\n Attention! No Lora Weights \n", "*"*50)
-    else:
-        model = LlamaForCausalLM.from_pretrained(
-            base_model, device_map={"": device}, low_cpu_mem_usage=True
-        )
-        try:
-            model = PeftModel.from_pretrained(
-                model,
-                lora_weights,
-                device_map={"": device},
-            )
-        except:
-            print("*"*50, "\n Attention! No Lora Weights \n", "*"*50)
-
-    # unwind broken decapoda-research config
-    model.config.pad_token_id = tokenizer.pad_token_id = 0  # unk
-    model.config.bos_token_id = 1
-    model.config.eos_token_id = 2
-
-    if not load_8bit:
-        model.half()  # seems to fix bugs for some users.
-
-    model.eval()
-    if torch.__version__ >= "2" and sys.platform != "win32":
-        model = torch.compile(model)
+    model, tokenizer, _ = load_model(
+        base_model, lora_weights, load_8bit=load_8bit, device=device, quantize=quantize,
+        cpu_dtype=cpu_dtype, autotune=autotune, num_threads=num_threads,
+    )
+
+    adapter_manager = None
+    if adapters:
+        adapter_manager = AdapterManager(model, adapters, adapter_budget_mb)
+    engine = GenerationEngine(
+        model,
+        device=device,
+        eos_token_id=tokenizer.eos_token_id,
+        max_batch_size=max_batch_size,
+        adapters=adapter_manager,
+        drafter=build_drafter(
+            draft_model,
+            prompt_lookup,
+            device,
+            tokenizer,
+            load_statute_texts(law_files) if statute_lookup else None,
+        ),
+    )
+    engine.add_template_prefixes(tokenizer, prompter)
+    template = prompter.compile(tokenizer)
+    response_cache = ResponseCache(cache_size, cache_ttl, cache_db)
+    executor = GenerationExecutor(max_workers=stream_workers or max_batch_size)
+    model_id = f"{base_model}|{lora_weights}"
 
     def evaluate(
         instruction,
@@ -102,12 +82,75 @@ def main(
         num_beams=4,
         max_new_tokens=128,
         stream_output=False,
+        adapter="default",
         **kwargs,
     ):
         input=None
         prompt = prompter.generate_prompt(instruction, input)
-        inputs = tokenizer(prompt, return_tensors="pt")
-        input_ids = inputs["input_ids"].to(device)
+        # Only greedy/beam requests get a key; sampling always generates.
+        cache_key = response_cache.make_key(
+            prompter.generate_prompt(normalize_instruction(instruction), input),
+            f"{model_id}|{adapter}",
+            temperature=temperature,
+            top_p=top_p,
+            top_k=int(top_k),
+            num_beams=int(num_beams),
+            max_new_tokens=int(max_new_tokens),
+            **kwargs,
+        )
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            # A hit is rendered the same way streamed or not: the full answer.
+            yield cached
+            return
+
+        prompt_ids = template.encode(instruction, input)
+
+        if int(num_beams) == 1:
+            # Greedy/sampling requests join the engine's shared decode batch.
+            request = engine.submit(
+                prompt_ids,
+                max_new_tokens=int(max_new_tokens),
+                do_sample=kwargs.get("do_sample", False),
+                temperature=temperature,
+                top_p=top_p,
+                top_k=int(top_k),
+                adapter=adapter,
+            )
+            try:
+                if stream_output:
+                    # Only the new tokens are decoded; the textbox still needs
+                    # the accumulated answer on every yield.
+                    detokenizer = StreamDetokenizer(tokenizer, request.input_ids)
+                    response = ""
+                    for token in request:
+                        delta = detokenizer.put([token])
+                        if delta:
+                            response += delta if response else delta.lstrip()
+                            yield response
+                    tail = detokenizer.flush()
+                    if tail:
+                        response += tail
+                        yield response
+                    # cached like the non-streaming answer, cut at a repeated marker
+                    response_cache.put(cache_key, template.decode_response(request.output_ids))
+                    print(prompt + response)
+                    print(request.timing_summary())
+                    return
+                # gradio drops this generator on a disconnect or Stop, but
+                # only between yields, so keep yielding no-op updates.
+                while not request.done.wait(0.5):
+                    yield gr.update()
+                response = template.decode_response(request.result())
+                print(prompt + response)
+                print(request.timing_summary())
+                response_cache.put(cache_key, response)
+                yield response
+                return
+            finally:
+                request.cancel()  # no-op unless the client went away
+
+        input_ids = torch.tensor([prompt_ids], device=device)
         generation_config = GenerationConfig(
             temperature=temperature,
             top_p=top_p,
@@ -126,38 +169,19 @@ def main(
 
         if stream_output:
             # Stream the reply 1 token at a time.
-            # This is based on the trick of using 'stopping_criteria' to create an iterator,
-            # from https://github.com/oobabooga/text-generation-webui/blob/ad37f396fc8bcbab90e11ecf17c56c97bfbd4a9c/modules/text_generation.py#L216-L243.
-
-            def generate_with_callback(callback=None, **kwargs):
-                kwargs.setdefault(
-                    "stopping_criteria", transformers.StoppingCriteriaList()
-                )
-                kwargs["stopping_criteria"].append(
-                    Stream(callback_func=callback)
-                )
-                with torch.no_grad():
-                    model.generate(**kwargs)
-
-            def generate_with_streaming(**kwargs):
-                return Iteratorize(
-                    generate_with_callback, kwargs, callback=None
-                )
-
-            with generate_with_streaming(**generate_params) as generator:
-                for output in generator:
-                    # new_tokens = len(output) - len(input_ids[0])
-                    decoded_output = tokenizer.decode(output)
-
-                    if output[-1] in [tokenizer.eos_token_id]:
-                        break
-
-                    yield prompter.get_response(decoded_output)
-            print(decoded_output)
+            # Partial beams are shown while generate runs; only the finished
+            # best sequence, the last value, is cached like a non-streamed answer.
+            for response in stream_beam_search(
+                model, tokenizer, template, prompt_ids, generate_params,
+                lock=engine.exclusive(adapter), executor=executor,
+            ):
+                yield response
+            response_cache.put(cache_key, response)
+            print(prompt + response)
             return  # early return for stream_output
 
         # Without streaming
-        with torch.no_grad():
+        with torch.no_grad(), engine.exclusive(adapter):
             generation_output = model.generate(
                 input_ids=input_ids,
                 generation_config=generation_config,
@@ -166,11 +190,12 @@ def main(
                 max_new_tokens=max_new_tokens,
             )
         s = generation_output.sequences[0]
-        output = tokenizer.decode(s)
-        print(output)
-        yield prompter.get_response(output)
+        response = template.decode_response(s, len(prompt_ids))
+        print(prompt + response)
+        response_cache.put(cache_key, response)
+        yield response
 
-    gr.Interface(
+    demo = gr.Interface(
         fn=evaluate,
         inputs=[
             gr.components.Textbox(
@@ -195,6 +220,12 @@ def main(
                 minimum=1, maximum=2000, step=1, value=256, label="Max tokens"
             ),
             gr.components.Checkbox(label="Stream output",  value=True),
+            gr.components.Dropdown(
+                choices=["default"] + list(adapters or {}),
+                value="default",
+                label="LoRA adapter",
+                visible=bool(adapters),
+            ),
         ],
         outputs=[
             gr.inputs.Textbox(
@@ -204,7 +235,10 @@ def main(
         ],
         title="🦙🌲 LaWGPT",
         description="",
-    ).queue().launch(server_name="0.0.0.0", share=share_gradio)
+    )
+    demo.queue(**gradio_queue_kwargs(demo.queue, max_batch_size)).launch(
+        server_name="0.0.0.0", share=share_gradio
+    )
 
 
 if __name__ == "__main__":